@@ -13,6 +13,50 @@ max_steps = 50000 #1000000
 log_device_placement = False
 # How often to log results to the console.
 log_frequency = 100
+# Synchronous data-parallel training (sm_train.py): number of replicas, each on its own CPU device
+# (e.g. one per socket) with its own shard of the training set and a batch of batch_size.
+NUM_REPLICAS = 1
+# Gradient accumulation: number of batches of batch_size (per replica) whose gradients are summed
+# before one update, for an effective batch of ACCUMULATION_STEPS * NUM_REPLICAS * batch_size. The
+# global step, max_steps and the learning rate schedule count updates.
+ACCUMULATION_STEPS = 1
+# How the initial learning rate scales with the effective batch size: 'linear', 'sqrt' or 'none'.
+LEARNING_RATE_SCALING = 'linear'
+# Number of training steps per Session.run of sm_train.py, run by a tf.while_loop in the graph (see
+# sm.train_loop()), which sums the loss: the global step and the mean loss are fetched, and the
+# checkpoints, the logs and the end of the training checked, every STEPS_PER_FETCH steps. Make
+# log_frequency a multiple of it. The moving averages of the variables and the summaries are computed
+# once per run. Not with DISTILL_FROM.
+STEPS_PER_FETCH = 1
+# Step profiling (sm_train.py, see step_profiler.py): every PROFILE_STEPS runs of the train op, one run
+# is traced, its Chrome trace written to train_dir/profile and its time split by phase (input, forward,
+# backward, update, summaries, checkpoint), with a summary over the last PROFILE_WINDOW traced runs. 0
+# disables it. Make it a multiple of STEPS_PER_FETCH.
+PROFILE_STEPS = 0
+PROFILE_WINDOW = 10
+# Memory profiling (sm_train.py, see memory_monitor.py): every MEMORY_PROFILE_SECS seconds, the RSS of the
+# process and the bytes held by the queues of the input pipeline are sampled, and train_dir/memory.json
+# attributes the peak RSS to the queues, the tensors of the traced steps (PROFILE_STEPS) and the rest.
+# 0 disables it.
+MEMORY_PROFILE_SECS = 0
+# Live metrics of sm_train.py in the Prometheus text format (see metrics.py): served on
+# http://localhost:METRICS_PORT/metrics (plus the index of the worker in a cluster), and/or rewritten to
+# METRICS_FILE every METRICS_FILE_SECS seconds. 0 and '' disable them.
+METRICS_PORT = 0
+METRICS_FILE = ''
+METRICS_FILE_SECS = 10
+# Summaries written by the trainer on logging steps: 'scalars', or 'histograms' for scalars and the
+# histograms of the activations, variables and gradients.
+SUMMARY_LEVEL = 'histograms'
+
+# Read the training set in an order which only depends on INPUT_SEED, and save the position in it
+# with the checkpoints, so that a resumed run reads the same examples as an uninterrupted one. The
+# seed of a resumed run is the one of its checkpoint.
+DETERMINISTIC_INPUT = True
+INPUT_SEED = 42
+# Seconds which sm_train.py has to write a final checkpoint after a SIGTERM, before its scheduler
+# kills it.
+PREEMPTION_DEADLINE_SECS = 20
 
 # Global constants describing the MSHAPES data set.
 IMAGE_SIZE = 100
@@ -38,8 +82,19 @@ NOTIFICATION_EMAIL = 'qc_zhao@outlook.com'
 
 CHECK_DATASET = True
 
-RESTORE = False
-RESTORE_FROM = 'summaries/netstate/saved_state-3000'
+# Resume sm_train.py from the latest checkpoint of train_dir (global step and learning rate schedule
+# included), or from the checkpoint RESTORE_FROM if train_dir has none. Otherwise train_dir is
+# cleaned up and the training starts from scratch.
+RESTORE = True
+RESTORE_FROM = ''
+# Checkpoints of sm_train.py, written in the background every CHECKPOINT_STEPS global steps or
+# CHECKPOINT_SECS seconds, whichever comes first (0 disables either).
+CHECKPOINT_STEPS = 1000
+CHECKPOINT_SECS = 600
+# Number of most recent checkpoints to keep in train_dir.
+KEEP_CHECKPOINTS = 5
+# Number of checkpoints with the lowest training loss to keep in train_dir/best.
+KEEP_BEST_CHECKPOINTS = 1
 
 # The version of model to use.
 #   0: CIFAR-10 model
@@ -50,3 +105,54 @@ model_version = 2
 # Architecture parameters
 CONVOLUTIONAL_LAYER_DEPTH = 16
 KEEP_PROB = 0.5
+# Normalization of the convolutional layers of versions 0, 1 and 2:
+#   'lrn': local response normalization after each convolution block
+#   'batch_norm': batch normalization between each convolution and its ReLU, folded into the
+#                 convolution by sm_export.py
+NORMALIZATION = 'lrn'
+# Build the graph with the batch normalizations folded into the convolutions (set by sm_export.py).
+FOLD_BATCH_NORM = False
+# Feature extraction towers of version 1:
+#   'standard': two 5x5 convolutions at stride 1 (input_process)
+#   'separable': strided stem and depthwise-separable convolutions (separable_input_process)
+TOWER = 'standard'
+# Scales the depths of the 'separable' towers.
+WIDTH_MULTIPLIER = 1.0
+# Number of channels of the convolutions pruned by sm_prune.py, by variable scope, e.g.
+# {'input/input_L/conv': 12}. Other convolutions keep their full depth. To use a pruned
+# checkpoint, set it to the dictionary sm_prune.py writes next to the checkpoint (channels.json).
+CHANNELS = {}
+
+# Directory where graph_cache.py keeps the built train and eval graphs, empty to always build them.
+GRAPH_CACHE_DIR = './MSHAPES_graph_cache'
+# Thread pools of the sessions and number of input threads of sm_train.py and sm_eval.py, as tuned
+# by sm_autotune.py (see thread_config.py). Without the file, TensorFlow's defaults are used.
+THREAD_CONFIG = './MSHAPES_thread_config.json'
+
+# Geometric prefilter (sm_prefilter.py): pairs whose edge correlation is below this are rejected.
+PREFILTER_THRESHOLD = 0.95
+
+# Convolutions with a stride of 1 and kernels at least this wide are computed with FFTs (e.g. the 27x27
+# canonical convolutions of version 2), the others directly; 0 computes them all directly. Set it to the
+# crossover sm_fft_benchmark.py measures on the machine.
+FFT_MIN_KERNEL_SIZE = 0
+
+# Compute the convolutional and fully connected layers in 8 bits (inference only, see sm_quantize.py).
+QUANTIZE = False
+
+# Early exit of version 1 with the standard towers (sm.inference_v1_early_exit): examples whose early
+# prediction, after the first convolution blocks, is at least EARLY_EXIT_THRESHOLD confident skip the
+# rest of the model at inference time. sm_early_exit.py calibrates the threshold.
+EARLY_EXIT = False
+EARLY_EXIT_THRESHOLD = 0.99
+# Weight of the loss of the early exit in training.
+EARLY_EXIT_WEIGHT = 0.5
+
+# Knowledge distillation (sm_train.py): directory of the teacher's checkpoint, empty to train on the labels only.
+DISTILL_FROM = ''
+# Architecture of the teacher, overriding the constants above while it is built, e.g.
+# {'CONVOLUTIONAL_LAYER_DEPTH': 32, 'TOWER': 'standard'}.
+TEACHER = {}
+# Temperature of the softened logits, and weight of the teacher's targets in the loss (the labels get the rest).
+DISTILLATION_TEMPERATURE = 4.0
+DISTILLATION_WEIGHT = 0.5
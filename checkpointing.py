@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Checkpoints written in the background, so that saving them does not hold up the training loop.
+
+The training graph holds a shadow copy of every variable to save (snapshot()). When a checkpoint is
+due, the training loop copies the variables into their shadow copies, which takes one short
+session run, and a background thread saves the copies under the names of the variables, while
+the training goes on. The checkpoints are restored with a regular Saver of the variables.
+
+The last checkpoints are kept by the Saver (max_to_keep), and the ones with the lowest training
+loss are copied to the 'best' subdirectory, which has its own checkpoint state file so that
+tf.train.get_checkpoint_state() finds the best one.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import tensorflow as tf
+
+# Name scope of the shadow copies of the variables.
+SNAPSHOT_SCOPE = 'checkpoint_snapshot'
+
+# Subdirectory of the checkpoint directory which keeps the best checkpoints.
+BEST_DIR = 'best'
+
+
+def snapshot(var_list, max_to_keep=5, sharded=False):
+    """
+    Builds shadow copies of variables in the default graph, on the devices of the variables. The
+    copies are in no collection: they are neither initialized nor saved with the variables.
+
+    :param var_list: the variables to save
+    :param max_to_keep: (optional) number of most recent checkpoints to keep
+    :param sharded: (optional) whether to save one shard per device, see tf.train.Saver
+    :return: the op which copies the variables into their shadow copies, and the Saver of the copies
+        under the names of the variables
+    """
+    copies = {}
+    assigns = []
+    with tf.name_scope(SNAPSHOT_SCOPE):
+        for v in var_list:
+            with tf.device(v.device):
+                copy = tf.Variable(tf.zeros(v.get_shape(), v.dtype.base_dtype), trainable=False, collections=[],
+                                   name=v.op.name)
+                assigns.append(tf.assign(copy, v.read_value()))
+            copies[v.op.name] = copy
+
+    return tf.group(*assigns, name='snapshot'), tf.train.Saver(var_list=copies, max_to_keep=max_to_keep,
+                                                                sharded=sharded)
+
+
+class AsyncCheckpointer(object):
+    """Saves checkpoints of snapshot() from a background thread, every few steps or seconds."""
+
+    def __init__(self, sess, snapshot_op, saver, save_path, every_steps=0, every_secs=0, keep_best=0):
+        """
+        :param sess: the training session
+        :param snapshot_op: the op which copies the variables, from snapshot()
+        :param saver: the Saver of the copies, from snapshot()
+        :param save_path: prefix of the checkpoints, which get the global step as a suffix
+        :param every_steps: (optional) number of global steps between checkpoints, 0 for no limit
+        :param every_secs: (optional) number of seconds between checkpoints, 0 for no limit
+        :param keep_best: (optional) number of checkpoints with the lowest loss to keep
+        """
+        self._sess = sess
+        self._snapshot_op = snapshot_op
+        self._saver = saver
+        self._save_path = save_path
+        self._every_steps = every_steps
+        self._every_secs = every_secs
+        self._keep_best = keep_best
+
+        # When resuming, the older checkpoints are still subject to retention.
+        checkpoint_dir = os.path.dirname(save_path)
+        ckpt = tf.train.get_checkpoint_state(checkpoint_dir)
+        if ckpt and ckpt.all_model_checkpoint_paths:
+            saver.recover_last_checkpoints(list(ckpt.all_model_checkpoint_paths))
+        self._best_dir = os.path.join(checkpoint_dir, BEST_DIR)
+        self._best_index = os.path.join(self._best_dir, 'best.json')
+        self._best = []
+        if tf.gfile.Exists(self._best_index):
+            with tf.gfile.GFile(self._best_index) as f:
+                self._best = json.load(f)
+
+        self._last_step = None
+        self._last_time = time.time()
+        self._losses = []
+        self._pending = None
+        self._idle = threading.Event()
+        self._idle.set()
+        self._done = False
+        self._wake = threading.Condition()
+        # Durations in seconds of the last snapshot, which holds up the training loop, and of the
+        # last save, which does not.
+        self.snapshot_secs = None
+        self.save_secs = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def step(self, global_step, loss):
+        """
+        Called after every training step: takes a snapshot if a checkpoint is due and the previous
+        one is written, else carries on.
+
+        :param global_step: the global step after the training step
+        :param loss: the training loss of the step, whose mean between checkpoints ranks them
+        """
+        self._losses.append(loss)
+        if self._last_step is None:
+            self._last_step = global_step
+        due = (self._every_steps and global_step - self._last_step >= self._every_steps) or \
+              (self._every_secs and time.time() - self._last_time >= self._every_secs)
+        if due and self._idle.is_set():
+            self.save(global_step)
+
+    def save(self, global_step):
+        """Takes a snapshot and hands it to the background thread, once the previous one is written."""
+        self._idle.wait()
+        self._idle.clear()
+        start = time.time()
+        self._sess.run(self._snapshot_op)
+        self.snapshot_secs = time.time() - start
+        with self._wake:
+            self._pending = (global_step, float(np.mean(self._losses)) if self._losses else None)
+            self._wake.notify()
+        self._last_step = global_step
+        self._last_time = time.time()
+        self._losses = []
+
+    def _run(self):
+        while True:
+            with self._wake:
+                while self._pending is None and not self._done:
+                    self._wake.wait()
+                if self._pending is None:
+                    return
+                global_step, loss = self._pending
+                self._pending = None
+            start = time.time()
+            path = self._saver.save(self._sess, self._save_path, global_step=global_step, write_meta_graph=False)
+            self.save_secs = time.time() - start
+            if self._keep_best and loss is not None:
+                self._update_best(path, global_step, loss)
+            self._idle.set()
+
+    def _update_best(self, path, global_step, loss):
+        """Copies a checkpoint to the best ones if its loss is among the keep_best lowest."""
+        if len(self._best) >= self._keep_best and loss >= self._best[-1]['loss']:
+            return
+
+        if not tf.gfile.Exists(self._best_dir):
+            tf.gfile.MakeDirs(self._best_dir)
+        best_path = os.path.join(self._best_dir, os.path.basename(path))
+        for filename in tf.gfile.Glob(path + '.*'):
+            tf.gfile.Copy(filename, os.path.join(self._best_dir, os.path.basename(filename)), overwrite=True)
+        self._best.append({'path': best_path, 'global_step': global_step, 'loss': loss})
+        self._best.sort(key=lambda checkpoint: checkpoint['loss'])
+        for evicted in self._best[self._keep_best:]:
+            for filename in tf.gfile.Glob(evicted['path'] + '.*'):
+                tf.gfile.Remove(filename)
+        self._best = self._best[:self._keep_best]
+
+        with tf.gfile.GFile(self._best_index, 'w') as f:
+            json.dump(self._best, f, indent=2)
+        tf.train.update_checkpoint_state(self._best_dir, self._best[0]['path'],
+                                         [checkpoint['path'] for checkpoint in self._best])
+
+    def close(self, global_step=None, timeout=None):
+        """
+        Writes the pending checkpoint and stops the background thread.
+
+        :param global_step: (optional) the last global step, to save a final checkpoint at
+        :param timeout: (optional) number of seconds to give up after. A checkpoint still being
+            written is then lost, but not the previous ones.
+        :return: whether every checkpoint was written
+        """
+        deadline = None if timeout is None else time.time() + timeout
+
+        def remaining():
+            return None if deadline is None else max(0.0, deadline - time.time())
+
+        if global_step is not None and global_step != self._last_step and self._idle.wait(remaining()):
+            self.save(global_step)
+        if not self._idle.wait(remaining()):
+            return False
+        with self._wake:
+            self._done = True
+            self._wake.notify()
+        self._thread.join(remaining())
+
+        return True
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Cache of built graphs, to skip graph construction when a trainer or an evaluator starts.
+
+A graph is exported as a MetaGraph in FLAGS.GRAPH_CACHE_DIR under a key which hashes its kind, the
+constants of FLAGS.py, the sources of the repository and the TensorFlow version, so that any change
+which could change the graph builds it anew. The tensors and ops to fetch are kept in collections,
+the savers in the SAVERS collection, and the variables, queue runners and summaries in their usual
+collections, so that the imported graph is used as the built one.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import glob
+import hashlib
+import json
+import os
+import time
+
+import tensorflow as tf
+
+import FLAGS
+import thread_config
+
+# Prefix of the collections holding the tensors and ops to fetch.
+FETCHES_PREFIX = 'graph_cache/'
+
+# Ops which live in tf.contrib and are only registered once their module is imported.
+CONTRIB_OPS = {'ImageProjectiveTransform': 'tensorflow.contrib.image',
+               'ImageProjectiveTransformV2': 'tensorflow.contrib.image'}
+
+
+def import_contrib_ops(graph_def):
+    """Imports the tf.contrib modules which register the ops of a GraphDef."""
+    for module in set(CONTRIB_OPS[node.op] for node in graph_def.node if node.op in CONTRIB_OPS):
+        __import__(module)
+
+
+def cache_key(kind):
+    """
+    :param kind: the kind of graph, e.g. 'train'
+    :return: the hash of everything the graph depends on
+    """
+    settings = dict((name, value) for name, value in vars(FLAGS).items()
+                    if not name.startswith('_') and isinstance(value, (bool, int, float, str, list, dict)))
+    # The number of input threads is built into the queue runners and the input loops.
+    threads = [thread_config.load(k)['input_threads'] for k in thread_config.KINDS]
+    key = hashlib.sha1(json.dumps([kind, tf.__version__, settings, threads], sort_keys=True).encode('utf-8'))
+    for path in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '*.py'))):
+        with open(path, 'rb') as f:
+            key.update(f.read())
+
+    return key.hexdigest()
+
+
+def load_or_build(kind, build):
+    """
+    Imports a graph from the cache into the default graph, or builds it and adds it to the cache.
+
+    :param kind: the kind of graph, e.g. 'train'
+    :param build: function which builds the graph in the default graph, and returns a dictionary
+        from names to the tensors and ops to fetch, and a list of savers
+    :return: the dictionary of tensors and ops to fetch, and the list of savers
+    """
+    if not FLAGS.GRAPH_CACHE_DIR:
+        return build()
+
+    path = os.path.join(FLAGS.GRAPH_CACHE_DIR, '%s-%s.meta' % (kind, cache_key(kind)))
+    start_time = time.time()
+
+    if tf.gfile.Exists(path):
+        meta_graph_def = tf.MetaGraphDef()
+        with tf.gfile.GFile(path, 'rb') as f:
+            meta_graph_def.ParseFromString(f.read())
+        import_contrib_ops(meta_graph_def.graph_def)
+        tf.train.import_meta_graph(meta_graph_def)
+
+        graph = tf.get_default_graph()
+        fetches = dict((name[len(FETCHES_PREFIX):], graph.get_collection(name)[0])
+                       for name in graph.get_all_collection_keys() if name.startswith(FETCHES_PREFIX))
+        savers = tf.get_collection(tf.GraphKeys.SAVERS)
+        print('Imported the %s graph from %s in %.2f sec' % (kind, path, time.time() - start_time))
+        return fetches, savers
+
+    fetches, savers = build()
+    for name, fetch in fetches.items():
+        tf.add_to_collection(FETCHES_PREFIX + name, fetch)
+    for saver in savers:
+        tf.add_to_collection(tf.GraphKeys.SAVERS, saver)
+    build_time = time.time() - start_time
+
+    if not tf.gfile.Exists(FLAGS.GRAPH_CACHE_DIR):
+        tf.gfile.MakeDirs(FLAGS.GRAPH_CACHE_DIR)
+    # Exported to a temporary file which is renamed once complete: an interrupted export is never
+    # imported.
+    tmp_path = path + '.tmp'
+    tf.train.export_meta_graph(filename=tmp_path)
+    tf.gfile.Rename(tmp_path, path, overwrite=True)
+    print('Built the %s graph in %.2f sec, cached in %s' % (kind, build_time, path))
+
+    return fetches, savers
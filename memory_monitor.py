@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Memory profiling of the training process.
+
+A background thread samples, every few seconds, the resident set size (RSS) of the process and the
+number of elements of every queue of the graph, e.g. the shuffling example queue or the batches
+prefetched by the deterministic input pipeline, which it converts to bytes from the shapes of the
+queue. The traced runs of step_profiler.py add the allocator statistics of the step: the largest number
+of bytes in use by every allocator, as recorded after every op of the step, and the bytes allocated for
+the outputs of the ops, by phase and by op type (e.g. the rotated maps of version 2).
+
+Every sample rewrites a report, which attributes the peak RSS to the queues (at the time of the peak),
+the tensors of a step (the bytes in use by the allocators, at their largest over the traced runs) and
+the rest of the process (variables, graph, runtime).
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.ops import gen_data_flow_ops
+
+import step_profiler
+
+# Types of the queue ops, with whether they are resources (V2) or references.
+QUEUE_TYPES = {
+    'FIFOQueue': False, 'FIFOQueueV2': True,
+    'PaddingFIFOQueue': False, 'PaddingFIFOQueueV2': True,
+    'RandomShuffleQueue': False, 'RandomShuffleQueueV2': True,
+    'PriorityQueue': False, 'PriorityQueueV2': True,
+}
+
+# Number of op types by allocated bytes written to the report.
+NUM_TOP_OPS = 10
+
+
+def rss_bytes():
+    """:return: the resident set size of this process, or its peak where the current one is not available"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError):
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def element_bytes(queue_op):
+    """
+    :param queue_op: a queue op
+    :return: the number of bytes of an element of the queue, or None if its shapes or types do not say
+    """
+    shapes = queue_op.get_attr('shapes')
+    types = [tf.as_dtype(dtype) for dtype in queue_op.get_attr('component_types')]
+    if not shapes or any(dtype == tf.string for dtype in types):
+        return None
+    sizes = [tf.TensorShape(shape) for shape in shapes]
+    if not all(size.is_fully_defined() for size in sizes):
+        return None
+
+    return sum(int(np.prod(size.as_list())) * dtype.size for size, dtype in zip(sizes, types))
+
+
+def queue_sizes(graph):
+    """
+    Builds ops returning the number of elements of every queue of a graph, next to the queues.
+
+    :param graph: the graph
+    :return: a list of (name of the queue, size op, bytes of an element or None, capacity)
+    """
+    queues = []
+    with graph.as_default(), tf.name_scope('queue_sizes'):
+        for op in graph.get_operations():
+            if op.type not in QUEUE_TYPES:
+                continue
+            with tf.colocate_with(op):
+                if QUEUE_TYPES[op.type]:
+                    size = gen_data_flow_ops.queue_size_v2(op.outputs[0])
+                else:
+                    size = gen_data_flow_ops.queue_size(op.outputs[0])
+            queues.append((op.name, size, element_bytes(op), op.get_attr('capacity')))
+
+    return queues
+
+
+def allocations(step_stats):
+    """
+    :param step_stats: the StepStats of a traced run
+    :return: the largest number of bytes in use by every allocator after an op of the run (the
+        peak_bytes of an op are only its own), and the bytes allocated for the outputs of the ops by
+        phase (see step_profiler.phase()) and by op type
+    """
+    in_use = collections.defaultdict(int)
+    phases = collections.defaultdict(int)
+    ops = collections.defaultdict(int)
+    for dev_stats in step_stats.dev_stats:
+        if '/stream:' in dev_stats.device or '/memcpy' in dev_stats.device:
+            continue
+        for node_stats in dev_stats.node_stats:
+            for memory in node_stats.memory:
+                in_use[memory.allocator_name] = max(in_use[memory.allocator_name], memory.allocator_bytes_in_use)
+            allocated = sum(output.tensor_description.allocation_description.allocated_bytes
+                            for output in node_stats.output)
+            phases[step_profiler.phase(node_stats)] += allocated
+            ops[step_profiler.op_type(node_stats)] += allocated
+
+    return dict(in_use), dict(phases), dict(ops)
+
+
+class MemoryMonitor(object):
+    """Samples the memory of the process and of the queues of the graph from a background thread."""
+
+    def __init__(self, sess, queues, report_path, interval_secs):
+        """
+        :param sess: the session
+        :param queues: the queues of its graph, see queue_sizes()
+        :param report_path: the JSON file of the report, rewritten at every sample
+        :param interval_secs: number of seconds between samples
+        """
+        self._sess = sess
+        self._report_path = report_path
+        self._interval_secs = interval_secs
+
+        self._queues = queues
+        self._size_ops = [size for _, size, _, _ in self._queues]
+
+        self._lock = threading.Lock()
+        self._peak_rss = 0
+        self._queues_at_peak = 0
+        self._queue_peaks = collections.defaultdict(int)
+        self._allocator_max_in_use = collections.defaultdict(int)
+        self._phase_peaks = collections.defaultdict(int)
+        self._op_peaks = collections.defaultdict(int)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add_step_stats(self, step_stats):
+        """Adds the allocator statistics of a traced run, see step_profiler.StepProfiler.run_kwargs()."""
+        in_use, phases, ops = allocations(step_stats)
+        with self._lock:
+            for peaks_so_far, values in [(self._allocator_max_in_use, in_use), (self._phase_peaks, phases),
+                                         (self._op_peaks, ops)]:
+                for name, value in values.items():
+                    peaks_so_far[name] = max(peaks_so_far[name], value)
+
+    def sample(self):
+        """
+        Samples the memory, rewrites the report and prints its summary.
+
+        :return: the report
+        """
+        rss = rss_bytes()
+        sizes = self._sess.run(self._size_ops) if self._size_ops else []
+        queues = {}
+        for (name, _, size_bytes, capacity), elements in zip(self._queues, sizes):
+            queues[name] = {'elements': int(elements), 'capacity': capacity,
+                            'bytes': None if size_bytes is None else int(elements) * size_bytes}
+
+        with self._lock:
+            queue_bytes = sum(queue['bytes'] or 0 for queue in queues.values())
+            for name, queue in queues.items():
+                self._queue_peaks[name] = max(self._queue_peaks[name], queue['bytes'] or 0)
+                queue['peak_bytes'] = self._queue_peaks[name]
+            if rss >= self._peak_rss:
+                self._peak_rss, self._queues_at_peak = rss, queue_bytes
+            # The allocators hold separate memory.
+            step_bytes = sum(self._allocator_max_in_use.values())
+            report = {
+                'time': time.time(),
+                'rss': rss,
+                'peak_rss': self._peak_rss,
+                'queues': queues,
+                'step': {
+                    'allocator_max_bytes_in_use': dict(self._allocator_max_in_use),
+                    'output_bytes_by_phase': dict(self._phase_peaks),
+                    'top_ops_by_output_bytes': sorted(self._op_peaks.items(), key=lambda item: -item[1])[:NUM_TOP_OPS],
+                },
+                'peak_rss_attribution': {
+                    'input_queues': self._queues_at_peak,
+                    'step_tensors': step_bytes,
+                    'other': max(0, self._peak_rss - self._queues_at_peak - step_bytes),
+                },
+            }
+
+        with tf.gfile.GFile(self._report_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        attribution = report['peak_rss_attribution']
+        print('%s: memory: RSS %.0f MB (peak %.0f MB: input queues %.0f MB, step tensors %.0f MB, other %.0f MB)' % (
+            datetime.now(), rss / 2 ** 20, self._peak_rss / 2 ** 20, attribution['input_queues'] / 2 ** 20,
+            attribution['step_tensors'] / 2 ** 20, attribution['other'] / 2 ** 20))
+
+        return report
+
+    def _run(self):
+        while not self._stop.wait(self._interval_secs):
+            self.sample()
+
+    def close(self):
+        """Stops the sampling and writes a last report."""
+        self._stop.set()
+        self._thread.join()
+        self.sample()
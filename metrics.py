@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Live metrics of a run in the Prometheus text format, served over HTTP on localhost and/or rewritten
+periodically to a file (e.g. for the textfile collector of the node exporter).
+
+The run sets the values as it goes, which only takes a lock; they are rendered by the thread of the
+server or of the file. Collectors are called at rendering time for the values which cost something to
+get, e.g. the sizes of the queues of a session. Only uses the standard library, as the shape generator
+imports it too.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in sorted(labels.items())]
+    return '{%s}' % ','.join('%s="%s"' % item for item in escaped)
+
+
+class Registry(object):
+    """Metrics of a process: gauges and counters, with optional labels."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._descriptions = []
+        self._kinds = {}
+        self._values = {}
+        self._collectors = []
+        self._server = None
+        self._stop = threading.Event()
+        self._threads = []
+
+    def describe(self, name, help_text, kind='gauge'):
+        """
+        Declares a metric, which is rendered once it has a value.
+
+        :param name: the name of the metric, e.g. 'sm_train_loss'
+        :param help_text: its description
+        :param kind: (optional) 'gauge' or 'counter'
+        """
+        with self._lock:
+            self._descriptions.append((name, help_text))
+            self._kinds[name] = kind
+
+    def set(self, name, value, labels=None):
+        """Sets the value of a metric, for some labels."""
+        with self._lock:
+            self._values[(name, _format_labels(labels))] = value
+
+    def inc(self, name, amount=1, labels=None):
+        """Increments a counter, for some labels."""
+        key = (name, _format_labels(labels))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def add_collector(self, collect):
+        """
+        :param collect: a function called at rendering time, which returns a list of (name, value,
+            labels) of described metrics
+        """
+        self._collectors.append(collect)
+
+    def render(self):
+        """:return: the metrics in the Prometheus text format"""
+        collected = {}
+        for collect in self._collectors:
+            try:
+                for name, value, labels in collect():
+                    collected[(name, _format_labels(labels))] = value
+            except Exception as e:  # pylint: disable=broad-except
+                # e.g. the session is closing: the other metrics are still worth exporting.
+                print('Metrics collector failed: %s' % e)
+
+        with self._lock:
+            values = dict(self._values)
+            descriptions = list(self._descriptions)
+        values.update(collected)
+
+        lines = []
+        for name, help_text in descriptions:
+            samples = sorted((labels, value) for (sample_name, labels), value in values.items() if sample_name == name)
+            if not samples:
+                continue
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, self._kinds[name]))
+            lines.extend('%s%s %r' % (name, labels, float(value)) for labels, value in samples)
+
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='127.0.0.1'):
+        """Serves the metrics over HTTP from a background thread, at any path."""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):  # pylint: disable=invalid-name
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                pass
+
+        self._server = HTTPServer((host, port), Handler)
+        self._start(self._server.serve_forever)
+        print('Serving metrics on http://%s:%d/metrics' % (host, port))
+
+    def write_periodically(self, path, interval_secs):
+        """Rewrites the metrics to a file every few seconds from a background thread, atomically."""
+        def write():
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(self.render())
+            os.rename(tmp_path, path)
+
+        def run():
+            while not self._stop.wait(interval_secs):
+                write()
+            write()
+
+        self._start(run)
+
+    def _start(self, target):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def close(self):
+        """Stops the server and writes the metrics to the file a last time."""
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        for thread in self._threads:
+            thread.join()
@@ -1,7 +1,11 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import json
 import math
+import os
+import resource
+import time
 from random import randint
 
 import numpy as np
@@ -10,6 +14,15 @@ from PIL import Image, ImageDraw
 
 import nshapegenflags
 
+# metrics.py is shared with the trainer, in the directory above
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import metrics
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
 
 
 DIM = nshapegenflags.DIM  # Shorter
@@ -25,11 +38,85 @@ def set_color(color):
     nshapegenflags.COLOR = color
 
 
-def generate_image_pairs(n):
+def generate_image_pairs(n, memory_every=nshapegenflags.MEMORY_PROFILE_EVERY):
+    if memory_every and tracemalloc:
+        tracemalloc.start()
+    baseline = tracemalloc.take_snapshot() if memory_every and tracemalloc else None
+    exporter = start_metrics()
+    last_time, last_i = time.time(), 0
+
     print_progress_bar(0, n, prefix="Generating images: ", suffix="Done!", decimals=2, length=100)
-    for i in range(1, n + 1):
-        print_progress_bar(i, n, prefix="Generating images: ", suffix="Done!", decimals=2, length=100)
-        save_image_pair(randint(0, 2), i)
+    try:
+        for i in range(1, n + 1):
+            print_progress_bar(i, n, prefix="Generating images: ", suffix="Done!", decimals=2, length=100)
+            save_image_pair(randint(0, 2), i)
+            if memory_every and i % memory_every == 0:
+                report_memory(i, baseline)
+            if exporter:
+                exporter.inc("shapegen_pairs_total")
+                # The rate is updated about once a second
+                now = time.time()
+                if now - last_time >= 1.0 or i == n:
+                    exporter.set("shapegen_pairs_per_second", (i - last_i) / max(now - last_time, 1e-6))
+                    last_time, last_i = now, i
+    finally:
+        # Tracing slows down every allocation of the rest of the process
+        if baseline is not None:
+            tracemalloc.stop()
+
+    if exporter:
+        exporter.close()
+
+
+def start_metrics():
+    # Exports the metrics of the generator as nshapegenflags says, returns the registry or None
+    if not nshapegenflags.METRICS_PORT and not nshapegenflags.METRICS_FILE:
+        return None
+
+    registry = metrics.Registry()
+    registry.describe("shapegen_pairs_total", "Image pairs generated.", "counter")
+    registry.describe("shapegen_pairs_per_second", "Image pairs generated per second over the last second.")
+    if nshapegenflags.METRICS_PORT:
+        registry.serve(nshapegenflags.METRICS_PORT)
+    if nshapegenflags.METRICS_FILE:
+        registry.write_periodically(nshapegenflags.METRICS_FILE, nshapegenflags.METRICS_FILE_SECS)
+
+    return registry
+
+
+def rss_bytes():
+    # Current RSS from /proc, else the peak (ru_maxrss is in kilobytes on Linux, in bytes on macOS)
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError):
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def report_memory(num_pairs, baseline, num_lines=10):
+    """
+    Appends a report of the memory of the generator to MEMORY_REPORT: the RSS, split into the Python
+    heap traced by tracemalloc (Python 3) and the rest (PIL's image buffers, numpy, the interpreter),
+    and the lines whose allocations grew the most since the baseline snapshot.
+    """
+    rss = rss_bytes()
+    report = {"time": time.time(), "pairs": num_pairs, "rss": rss}
+    if baseline is not None:
+        current, peak = tracemalloc.get_traced_memory()
+        growth = tracemalloc.take_snapshot().compare_to(baseline, "lineno")[:num_lines]
+        report.update({"python_heap": current, "python_heap_peak": peak, "native_and_other": max(0, rss - current),
+                       "top_growth": [{"line": str(stat.traceback), "size_diff": stat.size_diff, "size": stat.size}
+                                      for stat in growth]})
+
+    with open(nshapegenflags.MEMORY_REPORT, "a") as f:
+        f.write(json.dumps(report) + "\n")
+    print()
+    message = "%d pairs: RSS %.1f MB" % (num_pairs, rss / 2.0 ** 20)
+    if baseline is not None:
+        message += ", Python heap %.1f MB (peak %.1f MB)" % (report["python_heap"] / 2.0 ** 20,
+                                                            report["python_heap_peak"] / 2.0 ** 20)
+    print(message)
 
 
 def save_image_pair(shape, id):
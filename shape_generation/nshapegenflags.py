@@ -8,3 +8,15 @@ RANDOM_COLOR = False
 
 ROTATE = True
 ROTATE_MAX_DEGREES = 180  # 0 <= x <= 180
+
+# Every MEMORY_PROFILE_EVERY pairs, append the RSS of the generator and, on Python 3, its Python heap
+# (tracemalloc) with the lines whose allocations grew the most to MEMORY_REPORT. 0 disables it.
+MEMORY_PROFILE_EVERY = 0
+MEMORY_REPORT = "memory.jsonl"
+
+# Live metrics of the generator in the Prometheus text format (see metrics.py in the directory above):
+# served on http://localhost:METRICS_PORT/metrics and/or rewritten to METRICS_FILE every
+# METRICS_FILE_SECS seconds. 0 and "" disable them.
+METRICS_PORT = 0
+METRICS_FILE = ""
+METRICS_FILE_SECS = 10
@@ -25,36 +25,93 @@ NUM_EXAMPLES_PER_EPOCH_FOR_TRAIN = FLAGS.NUM_EXAMPLES_PER_EPOCH_FOR_TRAIN
 NUM_EXAMPLES_PER_EPOCH_FOR_EVAL = FLAGS.NUM_EXAMPLES_PER_EPOCH_FOR_EVAL
 TOWER_NAME = FLAGS.TOWER_NAME
 
+# Collections of the inputs of the convolutional and fully connected layers, and of the
+# [input_min, input_max] variables of the layers quantized with FLAGS.QUANTIZE.
+LAYER_INPUTS = 'layer_inputs'
+QUANTIZATION_RANGES = 'quantization_ranges'
+# Collection of (float kernel, uint8 kernel, kernel_min, kernel_max) of the layers quantized with
+# FLAGS.QUANTIZE: the float kernels are then neither initialized nor saved, see _quantized_conv2d().
+QUANTIZED_KERNELS = 'quantized_kernels'
+# Collection of (layer name, FLOPs per example, parameters) of the convolutional and fully
+# connected layers, and of the rotations of version 2, see print_cost_report().
+LAYER_COSTS = 'layer_costs'
+# FLOPs of a value rotated by tf.contrib.image.rotate: its projective coordinates (3 dot products
+# of 2 multiply-adds and 2 divisions) and the bilinear interpolation (3 lerps of 3 FLOPs).
+ROTATION_FLOPS = 23
+# Variable scope of the teacher of knowledge distillation, see teacher_inference().
+TEACHER_SCOPE = 'teacher'
+# Logits of the early exit of version 1, see early_exit_head().
+EARLY_EXIT_LOGITS = 'early_exit_logits'
+
 # Constants describing the training process.
 MOVING_AVERAGE_DECAY = FLAGS.MOVING_AVERAGE_DECAY  # The decay to use for the moving average.
 NUM_EPOCHS_PER_DECAY = FLAGS.NUM_EPOCHS_PER_DECAY  # Epochs after which learning rate decays.
 LEARNING_RATE_DECAY_FACTOR = FLAGS.LEARNING_RATE_DECAY_FACTOR  # Learning rate decay factor.
 INITIAL_LEARNING_RATE = FLAGS.INITIAL_LEARNING_RATE  # Initial learning rate.
+BATCH_NORM_DECAY = 0.99  # The decay of the moving statistics of the batch normalizations.
+BATCH_NORM_EPSILON = 1e-3
 
 
-def inputs(eval_data):
+def inputs(eval_data, shard=0, num_shards=1):
     """Construct input for MSHAPES evaluation using the Reader ops.
     Args:
       eval_data: bool, indicating if one should use the train or eval data set.
+      shard: index of the shard of the data set to read, see num_shards
+      num_shards: number of shards the data set is split into, one per replica of data-parallel training
     Returns:
       images: Images. 4D tensor of [batch_size, IMAGE_SIZE, IMAGE_SIZE, 6] size.
       labels: Labels. 1D tensor of [batch_size] size.
     Raises:
       ValueError: If no data_dir
     """
-    with tf.variable_scope('READ'):
+    return input_pipeline(eval_data, shard, num_shards)()
+
+
+def input_pipeline(eval_data, shard=0, num_shards=1):
+    """Construct the input pipeline of MSHAPES, to dequeue batches from, see inputs().
+    Args:
+      eval_data: bool, indicating if one should use the train or eval data set.
+      shard: index of the shard of the data set to read, see num_shards
+      num_shards: number of shards the data set is split into, one per replica of data-parallel training
+    Returns:
+      function which dequeues a batch and returns its images and labels, as inputs(); every call
+      builds new dequeue ops, e.g. in the body of a tf.while_loop (see train_loop())
+    Raises:
+      ValueError: If no data_dir
+    """
+    # The pipelines of the replicas share the variables of the input order (input_seed, input_positions).
+    with tf.variable_scope('READ', reuse=tf.AUTO_REUSE):
         if not FLAGS.data_dir:
             raise ValueError('Please supply a data_dir')
         data_dir = os.path.join(FLAGS.data_dir, '')
-        images, labels = sm_input.inputs(eval_data=eval_data,
-                                         data_dir=data_dir,
-                                         batch_size=FLAGS.batch_size)
+        dequeue = sm_input.input_pipeline(eval_data=eval_data,
+                                          data_dir=data_dir,
+                                          batch_size=FLAGS.batch_size,
+                                          shard=shard,
+                                          num_shards=num_shards)
+
+    def dequeue_batch():
+        with tf.name_scope('READ'):
+            images, labels = dequeue()
 
-        if FLAGS.use_fp16:
-            images = tf.cast(images, tf.float16)
-            labels = tf.cast(labels, tf.float16)
+            if FLAGS.use_fp16:
+                images = tf.cast(images, tf.float16)
+                labels = tf.cast(labels, tf.float16)
 
-        return images, labels
+            return images, labels
+
+    return dequeue_batch
+
+
+def placeholder_inputs(batch_size=None):
+    """Construct an input placeholder to feed examples to inference() directly.
+    Args:
+      batch_size: the batch size, None for a dynamic batch size.
+    Returns:
+      images: Images. 4D placeholder of [batch_size, IMAGE_SIZE, IMAGE_SIZE, 6] size.
+    """
+    dtype = tf.float16 if FLAGS.use_fp16 else tf.float32
+    return tf.placeholder(dtype, [batch_size, IMAGE_SIZE, IMAGE_SIZE, 6], name='images')
 
 
 def rotation_invariant_net(name, images):
@@ -78,7 +135,7 @@ def rotation_invariant_net(name, images):
                                                  shape=[filter_size, filter_size, 3, ROTATION_GROUP_NUMBER],  # the size of the kernel is larger than those are typically used
                                                  stddev=5e-3,
                                                  wd=0.0)
-            conv = tf.nn.conv2d(images, kernel, [1, 1, 1, 1], padding='VALID')
+            conv = _conv2d(images, kernel, [1, 1, 1, 1], padding='VALID')
             biases = _variable_on_cpu('biases', [ROTATION_GROUP_NUMBER], tf.constant_initializer(1e-2))
             canonical_conv = tf.nn.bias_add(conv, biases)
 
@@ -100,6 +157,9 @@ def rotation_invariant_net(name, images):
                 groups.append(rotation_reduce_max)
             # shape: [batch_size, width, height, ROTATION_GROUP_NUMBER]
             oriented_max_pool = tf.concat(groups, axis=3)
+            # every output value is the max of its DISCRETE_ORIENTATION_NUMBER rotated values
+            _add_op_cost(oriented_max_pool,
+                         DISCRETE_ORIENTATION_NUMBER * ROTATION_FLOPS + DISCRETE_ORIENTATION_NUMBER - 1)
 
         with tf.variable_scope('spatial_max_pool') as scope:
             spatial_max_pool = tf.nn.max_pool(oriented_max_pool,
@@ -111,62 +171,141 @@ def rotation_invariant_net(name, images):
         return activated
 
 
-def input_process(name, images):
+def input_process(name, images, training=False):
     """
     Model to extract features from one of the input image. Two layers of convolution and pool
     :param name: name of the input
     :param input_image: tensor_shape = [batch_size, width, height, 3]
+    :param training: if the graph is built for training, see _batch_norm()
     :return: feature logits
     """
+    with tf.variable_scope(name):
+        norm1 = input_block1(images, training)
+        pool2 = input_block2(norm1, training)
+
+    return pool2
+
+
+def input_block1(images, training=False):
+    """
+    First convolution block of input_process(), to be built in the variable scope of the input.
+    :param images: tensor_shape = [batch_size, width, height, 3]
+    :param training: if the graph is built for training, see _batch_norm()
+    :return: features, tensor_shape = [batch_size, width / 2, height / 2, depth]
+    """
     CONV1_DEPTH = FLAGS.CONVOLUTIONAL_LAYER_DEPTH
-    CONV2_DEPTH = FLAGS.CONVOLUTIONAL_LAYER_DEPTH
 
     channel_num = images.get_shape().as_list()[3]
     # conv1
-    with tf.variable_scope(name):
-        with tf.variable_scope('conv') as scope:
-            kernel = _variable_with_weight_decay('weights',
-                                                 shape=[5, 5, channel_num, CONV1_DEPTH],
-                                                 stddev=5e-3,
-                                                 wd=0.0)
-            conv = tf.nn.conv2d(images, kernel, [1, 1, 1, 1], padding='SAME')
-            biases = _variable_on_cpu('biases', [CONV1_DEPTH], tf.constant_initializer(1e-2))
-            pre_activation = tf.nn.bias_add(conv, biases)
-            conv1 = tf.nn.relu(pre_activation, name=scope.name)
-            _activation_summary(conv1)
-
-            # pool1
-            pool1 = tf.nn.max_pool(conv1, ksize=[1, 3, 3, 1], strides=[1, 2, 2, 1],
-                                   padding='SAME', name='pool')
-            # norm1
-            norm1 = tf.nn.lrn(pool1, 4, bias=1.0, alpha=0.001 / 9.0, beta=0.75,
-                              name='norm')
-
-        # conv2
-        with tf.variable_scope('conv2') as scope:
-            kernel = _variable_with_weight_decay('weights',
-                                                 shape=[5, 5, CONV1_DEPTH, CONV2_DEPTH],
-                                                 stddev=5e-2,
-                                                 wd=0.0)
-            conv = tf.nn.conv2d(norm1, kernel, [1, 1, 1, 1], padding='SAME')
-            biases = _variable_on_cpu('biases', [CONV2_DEPTH], tf.constant_initializer(0.1))
-            pre_activation = tf.nn.bias_add(conv, biases)
-            conv2 = tf.nn.relu(pre_activation, name=scope.name)
-            _activation_summary(conv2)
-
-            # norm2
-            norm2 = tf.nn.lrn(conv2, 4, bias=1.0, alpha=0.001 / 9.0, beta=0.75,
-                              name='norm1')
-            # pool2
-            pool2 = tf.nn.max_pool(norm2, ksize=[1, 3, 3, 1],
-                                   strides=[1, 2, 2, 1], padding='SAME', name='pool1')
+    with tf.variable_scope('conv') as scope:
+        CONV1_DEPTH = _num_channels(CONV1_DEPTH)
+        kernel = _variable_with_weight_decay('weights',
+                                             shape=[5, 5, channel_num, CONV1_DEPTH],
+                                             stddev=5e-3,
+                                             wd=0.0)
+        conv = _conv2d(images, kernel, [1, 1, 1, 1], padding='SAME')
+        biases = _variable_on_cpu('biases', [CONV1_DEPTH], tf.constant_initializer(1e-2))
+        pre_activation = _batch_norm(tf.nn.bias_add(conv, biases), training)
+        conv1 = tf.nn.relu(pre_activation, name=scope.name)
+        _activation_summary(conv1)
+
+        # pool1
+        pool1 = tf.nn.max_pool(conv1, ksize=[1, 3, 3, 1], strides=[1, 2, 2, 1],
+                               padding='SAME', name='pool')
+        # norm1
+        norm1 = _lrn(pool1, name='norm')
+
+    return norm1
+
+
+def input_block2(features, training=False):
+    """
+    Second convolution block of input_process(), to be built in the variable scope of the input.
+    :param features: output of input_block1()
+    :param training: if the graph is built for training, see _batch_norm()
+    :return: feature logits
+    """
+    CONV1_DEPTH = features.get_shape().as_list()[3]
+    CONV2_DEPTH = FLAGS.CONVOLUTIONAL_LAYER_DEPTH
+
+    # conv2
+    with tf.variable_scope('conv2') as scope:
+        CONV2_DEPTH = _num_channels(CONV2_DEPTH)
+        kernel = _variable_with_weight_decay('weights',
+                                             shape=[5, 5, CONV1_DEPTH, CONV2_DEPTH],
+                                             stddev=5e-2,
+                                             wd=0.0)
+        conv = _conv2d(features, kernel, [1, 1, 1, 1], padding='SAME')
+        biases = _variable_on_cpu('biases', [CONV2_DEPTH], tf.constant_initializer(0.1))
+        pre_activation = _batch_norm(tf.nn.bias_add(conv, biases), training)
+        conv2 = tf.nn.relu(pre_activation, name=scope.name)
+        _activation_summary(conv2)
+
+        # norm2
+        norm2 = _lrn(conv2, name='norm1')
+        # pool2
+        pool2 = tf.nn.max_pool(norm2, ksize=[1, 3, 3, 1],
+                               strides=[1, 2, 2, 1], padding='SAME', name='pool1')
 
     return pool2
 
 
-def input_process_with_rotation(name, images):
+def separable_input_process(name, images, training=False):
+    """
+    Lightweight alternative to input_process(), selected with FLAGS.TOWER = 'separable': a strided
+    3x3 stem followed by depthwise-separable convolutions (a 3x3 depthwise convolution, then a 1x1
+    pointwise one). The depths are FLAGS.CONVOLUTIONAL_LAYER_DEPTH scaled by FLAGS.WIDTH_MULTIPLIER.
+    :param name: name of the input
+    :param images: tensor_shape = [batch_size, width, height, 3]
+    :param training: if the graph is built for training, see _batch_norm()
+    :return: features, tensor_shape = [batch_size, width / 8, height / 8, 2 * depth]
+    """
+    depth = max(int(round(FLAGS.CONVOLUTIONAL_LAYER_DEPTH * FLAGS.WIDTH_MULTIPLIER)), 1)
+    # (stride, output depth) of the separable blocks
+    blocks = [(1, depth), (2, 2 * depth), (2, 2 * depth)]
+
+    channel_num = images.get_shape().as_list()[3]
+    with tf.variable_scope(name):
+        with tf.variable_scope('stem') as scope:
+            kernel = _variable_with_weight_decay('weights',
+                                                 shape=[3, 3, channel_num, depth],
+                                                 stddev=5e-3,
+                                                 wd=0.0)
+            conv = _conv2d(images, kernel, [1, 2, 2, 1], padding='SAME')
+            biases = _variable_on_cpu('biases', [depth], tf.constant_initializer(1e-2))
+            pre_activation = _batch_norm(tf.nn.bias_add(conv, biases), training)
+            features = tf.nn.relu(pre_activation, name=scope.name)
+            _activation_summary(features)
+
+        for i, (stride, block_depth) in enumerate(blocks):
+            in_depth = features.get_shape().as_list()[3]
+            with tf.variable_scope('separable%d' % (i + 1)):
+                with tf.variable_scope('depthwise') as scope:
+                    kernel = _variable_with_weight_decay('weights',
+                                                         shape=[3, 3, in_depth, 1],
+                                                         stddev=5e-2,
+                                                         wd=0.0)
+                    conv = _depthwise_conv2d(features, kernel, [1, stride, stride, 1], padding='SAME')
+                    biases = _variable_on_cpu('biases', [in_depth], tf.constant_initializer(0.1))
+                    depthwise = tf.nn.relu(tf.nn.bias_add(conv, biases), name=scope.name)
+
+                with tf.variable_scope('pointwise') as scope:
+                    kernel = _variable_with_weight_decay('weights',
+                                                         shape=[1, 1, in_depth, block_depth],
+                                                         stddev=5e-2,
+                                                         wd=0.0)
+                    conv = _conv2d(depthwise, kernel, [1, 1, 1, 1], padding='SAME')
+                    biases = _variable_on_cpu('biases', [block_depth], tf.constant_initializer(0.1))
+                    pre_activation = _batch_norm(tf.nn.bias_add(conv, biases), training)
+                    features = tf.nn.relu(pre_activation, name=scope.name)
+                    _activation_summary(features)
+
+    return features
+
+
+def input_process_with_rotation(name, images, training=False):
     rotation_invariant = rotation_invariant_net(name, images)
-    return input_process(name, rotation_invariant)
+    return input_process(name, rotation_invariant, training)
 
 
 # Full connection layer
@@ -176,12 +315,13 @@ def full_connection_layer(features, eval=False):
     # FC1
     with tf.variable_scope('FC1') as scope:
         # Move everything into depth so we can perform a single matrix multiply.
-        reshape = tf.reshape(features, [FLAGS.batch_size, -1])
-        dim = reshape.get_shape()[1].value
+        # The batch dimension is left dynamic so that the same graph serves any batch size.
+        dim = features.get_shape()[1:].num_elements()
+        reshape = tf.reshape(features, [-1, dim])
         weights = _variable_with_weight_decay('weights', shape=[dim, FC1_NUM],
                                               stddev=0.04, wd=0.004)
         biases = _variable_on_cpu('biases', [FC1_NUM], tf.constant_initializer(0.1))
-        fc1 = tf.nn.relu(tf.matmul(reshape, weights) + biases, name=scope.name)
+        fc1 = tf.nn.relu(_matmul(reshape, weights) + biases, name=scope.name)
         _activation_summary(fc1)
         keep_prob = FLAGS.KEEP_PROB if eval else 1.0
         fc1_dropout = tf.nn.dropout(fc1, keep_prob=keep_prob)
@@ -191,7 +331,7 @@ def full_connection_layer(features, eval=False):
         weights = _variable_with_weight_decay('weights', shape=[FC1_NUM, FC2_NUM],  # 192
                                               stddev=0.04, wd=0.004)
         biases = _variable_on_cpu('biases', [FC2_NUM], tf.constant_initializer(0.1))
-        fc2 = tf.nn.relu(tf.matmul(fc1_dropout, weights) + biases, name=scope.name)
+        fc2 = tf.nn.relu(_matmul(fc1_dropout, weights) + biases, name=scope.name)
         _activation_summary(fc2)
 
     # linear layer(WX + b),
@@ -203,17 +343,18 @@ def full_connection_layer(features, eval=False):
                                               stddev=1 / float(FC2_NUM), wd=0.0)
         biases = _variable_on_cpu('biases', [NUM_CLASSES],
                                   tf.constant_initializer(0.0))
-        softmax_linear = tf.add(tf.matmul(fc2, weights), biases, name=scope.name)
+        softmax_linear = tf.add(_matmul(fc2, weights), biases, name=scope.name)
         _activation_summary(softmax_linear)
 
     return softmax_linear
 
 
-def inference(images, eval=False):
+def inference(images, eval=False, training=False):
     """
     Build the model in which firstly extract features from both input images first. Then concat them together
 
     :param images: Images reterned from distored_inputs() or inputs(), tensor_shape = [batch_size, width, height, 6]
+    :param training: if the graph is built for training, see _batch_norm()
     :return: Logits
     """
 
@@ -224,62 +365,180 @@ def inference(images, eval=False):
         3: inference_v3
     }
 
-    return inference_model[FLAGS.model_version](images, eval)
+    num_layers = len(tf.get_collection(LAYER_COSTS))
+    logits = inference_model[FLAGS.model_version](images, eval, training)
+    print_cost_report(tf.get_collection(LAYER_COSTS)[num_layers:])
+
+    return logits
+
+
+def teacher_inference(images):
+    """
+    Builds the frozen teacher of knowledge distillation on the same images as the student, so that
+    both share one input batch. Its architecture is FLAGS.TEACHER, which overrides FLAGS while it is
+    built; its variables are in TEACHER_SCOPE and are not trained.
+
+    :param images: Images returned from inputs(), tensor_shape = [batch_size, width, height, 6]
+    :return: the logits of the teacher, and a Saver which restores it from one of its own checkpoints
+    """
+    defaults = dict((name, getattr(FLAGS, name)) for name in FLAGS.TEACHER)
+    for name, value in FLAGS.TEACHER.items():
+        setattr(FLAGS, name, value)
+    try:
+        with tf.variable_scope(TEACHER_SCOPE):
+            logits = inference(images)
+    finally:
+        for name, value in defaults.items():
+            setattr(FLAGS, name, value)
+
+    teacher_variables = [v for v in tf.global_variables() if v.op.name.startswith(TEACHER_SCOPE + '/')]
+    trainable_variables = tf.get_collection_ref(tf.GraphKeys.TRAINABLE_VARIABLES)
+    trainable_variables[:] = [v for v in trainable_variables if v not in teacher_variables]
+    saver = tf.train.Saver(var_list=dict((v.op.name[len(TEACHER_SCOPE) + 1:], v) for v in teacher_variables))
 
+    return tf.stop_gradient(logits), saver
 
-def inference_v3(images, eval=False):
+
+def inference_v3(images, eval=False, training=False):
     """
     Version 3, cross product two input images
 
     :param images: returned from inputs(). shape=[batch_size, IMAGE_SIZE, IMAGE_SIZE, 6]
     :param eval: if evaluate
+    :param training: if the graph is built for training
     :return: logits
     """
     with tf.variable_scope('cross_prod') as scope:
         cross_prod = tf.cross(images[:,:,:,:3], images[:,:,:,3:])
-    return inference_v0(cross_prod, eval)
+    return inference_v0(cross_prod, eval, training)
 
 
-def inference_v2(images, eval=False):
+def inference_v2(images, eval=False, training=False):
     """
     Version 2, preprocess two input images with rotation variance respectively.
 
     :param images: returned from inputs(). shape=[batch_size, IMAGE_SIZE, IMAGE_SIZE, 6]
     :param eval: if evaluate
+    :param training: if the graph is built for training
     :return: logits
     """
     with tf.variable_scope('input') as scope:
-        input_feature_L = input_process_with_rotation('input_L', images[:,:,:,:3])
-        input_feature_K = input_process_with_rotation('input_K', images[:,:,:,3:])
+        input_feature_L = input_process_with_rotation('input_L', images[:,:,:,:3], training)
+        input_feature_K = input_process_with_rotation('input_K', images[:,:,:,3:], training)
         sh = images.get_shape().as_list()
         input_concat = tf.concat([input_feature_L, input_feature_K], axis=len(sh)-1)
 
     return full_connection_layer(input_concat, eval)
 
 
-def inference_v1(images, eval=False):
+def inference_v1(images, eval=False, training=False):
     """
     Version 1, preprocess two input images respectively.
 
     :param images: returned from inputs(). shape=[batch_size, IMAGE_SIZE, IMAGE_SIZE, 6]
     :param eval: if evaluate
+    :param training: if the graph is built for training
     :return: logits
     """
+    if FLAGS.EARLY_EXIT:
+        return inference_v1_early_exit(images, eval, training)
+
+    tower = separable_input_process if FLAGS.TOWER == 'separable' else input_process
     with tf.variable_scope('input') as scope:
-        input_feature_L = input_process('input_L', images[:,:,:,:3])
-        input_feature_K = input_process('input_K', images[:,:,:,3:])
+        input_feature_L = tower('input_L', images[:,:,:,:3], training)
+        input_feature_K = tower('input_K', images[:,:,:,3:], training)
         sh = images.get_shape().as_list()
         input_concat = tf.concat([input_feature_L, input_feature_K], axis=len(sh)-1)
 
     return full_connection_layer(input_concat, eval)
 
 
-def inference_v0(images, eval=False):
+def inference_v1_early_exit(images, eval=False, training=False):
+    """
+    Version 1 with an early exit (FLAGS.EARLY_EXIT): early_exit_head() classifies the pairs from
+    the features of the first convolution blocks of the towers. At inference time, the examples
+    whose early exit prediction is at least FLAGS.EARLY_EXIT_THRESHOLD confident take it, and only
+    the others go through the second convolution blocks and the fully connected layers. When
+    training, all the examples go through both, see loss().
+
+    :param images: returned from inputs(). shape=[batch_size, IMAGE_SIZE, IMAGE_SIZE, 6]
+    :param eval: if evaluate
+    :param training: if the graph is built for training
+    :return: logits
+    """
+    if FLAGS.TOWER != 'standard':
+        raise ValueError('The early exit needs the standard towers, not the %s ones' % FLAGS.TOWER)
+
+    with tf.variable_scope('input'):
+        with tf.variable_scope('input_L'):
+            block1_L = input_block1(images[:,:,:,:3], training)
+        with tf.variable_scope('input_K'):
+            block1_K = input_block1(images[:,:,:,3:], training)
+    exit_logits = early_exit_head(block1_L, block1_K)
+
+    def remaining_layers(features_L, features_K):
+        with tf.variable_scope('input'):
+            with tf.variable_scope('input_L'):
+                input_feature_L = input_block2(features_L, training)
+            with tf.variable_scope('input_K'):
+                input_feature_K = input_block2(features_K, training)
+            input_concat = tf.concat([input_feature_L, input_feature_K], axis=3)
+        return full_connection_layer(input_concat, eval)
+
+    if training:
+        return remaining_layers(block1_L, block1_K)
+
+    # Per-example routing: the exits and the other examples are stitched back in batch order.
+    confidence = tf.reduce_max(tf.nn.softmax(exit_logits), axis=1)
+    exits = tf.greater_equal(confidence, FLAGS.EARLY_EXIT_THRESHOLD, name='early_exits')
+    exit_indices = tf.to_int32(tf.reshape(tf.where(exits), [-1]))
+    remaining_indices = tf.to_int32(tf.reshape(tf.where(tf.logical_not(exits)), [-1]))
+    remaining_logits = remaining_layers(tf.gather(block1_L, remaining_indices),
+                                        tf.gather(block1_K, remaining_indices))
+
+    return tf.dynamic_stitch([exit_indices, remaining_indices],
+                             [tf.gather(exit_logits, exit_indices), remaining_logits])
+
+
+def early_exit_head(features_L, features_K):
+    """
+    Small classifier of the early exit of inference_v1_early_exit(). Its logits are added to the
+    EARLY_EXIT_LOGITS collection.
+
+    :param features_L: output of input_block1() for the lock
+    :param features_K: output of input_block1() for the key
+    :return: logits
+    """
+    EXIT_FC_NUM = 64
+    with tf.variable_scope('early_exit') as scope:
+        features = tf.concat([features_L, features_K], axis=3)
+        pool = tf.nn.max_pool(features, ksize=[1, 5, 5, 1], strides=[1, 5, 5, 1], padding='SAME', name='pool')
+        dim = pool.get_shape()[1:].num_elements()
+        reshape = tf.reshape(pool, [-1, dim])
+
+        with tf.variable_scope('FC'):
+            weights = _variable_with_weight_decay('weights', shape=[dim, EXIT_FC_NUM], stddev=0.04, wd=0.004)
+            biases = _variable_on_cpu('biases', [EXIT_FC_NUM], tf.constant_initializer(0.1))
+            fc = tf.nn.relu(_matmul(reshape, weights) + biases, name='FC')
+            _activation_summary(fc)
+
+        with tf.variable_scope('softmax_linear'):
+            weights = _variable_with_weight_decay('weights', [EXIT_FC_NUM, NUM_CLASSES],
+                                                  stddev=1 / float(EXIT_FC_NUM), wd=0.0)
+            biases = _variable_on_cpu('biases', [NUM_CLASSES], tf.constant_initializer(0.0))
+            exit_logits = tf.add(_matmul(fc, weights), biases, name=scope.name)
+
+    tf.add_to_collection(EARLY_EXIT_LOGITS, exit_logits)
+    return exit_logits
+
+
+def inference_v0(images, eval=False, training=False):
     """
     Version 0, CIFAR-10 model.
 
     :param images: returned from inputs(). shape=[batch_size, IMAGE_SIZE, IMAGE_SIZE, 6]
     :param eval: if evaluate
+    :param training: if the graph is built for training
     :return: logits
     """
 
@@ -289,13 +548,14 @@ def inference_v0(images, eval=False):
 
     # conv1
     with tf.variable_scope('conv1') as scope:
+        CONV1_DEPTH = _num_channels(CONV1_DEPTH)
         kernel = _variable_with_weight_decay('weights',
                                              shape=[5, 5, channel_num, CONV1_DEPTH],
                                              stddev=5e-3,
                                              wd=0.0)
-        conv = tf.nn.conv2d(images, kernel, [1, 1, 1, 1], padding='SAME')
+        conv = _conv2d(images, kernel, [1, 1, 1, 1], padding='SAME')
         biases = _variable_on_cpu('biases', [CONV1_DEPTH], tf.constant_initializer(1e-2))
-        pre_activation = tf.nn.bias_add(conv, biases)
+        pre_activation = _batch_norm(tf.nn.bias_add(conv, biases), training)
         conv1 = tf.nn.relu(pre_activation, name=scope.name)
         _activation_summary(conv1)
 
@@ -303,24 +563,23 @@ def inference_v0(images, eval=False):
         pool1 = tf.nn.max_pool(conv1, ksize=[1, 3, 3, 1], strides=[1, 2, 2, 1],
                                padding='SAME', name='pool1')
         # norm1
-        norm1 = tf.nn.lrn(pool1, 4, bias=1.0, alpha=0.001 / 9.0, beta=0.75,
-                          name='norm1')
+        norm1 = _lrn(pool1, name='norm1')
 
     # conv2
     with tf.variable_scope('conv2') as scope:
+        CONV2_DEPTH = _num_channels(CONV2_DEPTH)
         kernel = _variable_with_weight_decay('weights',
                                              shape=[5, 5, CONV1_DEPTH, CONV2_DEPTH],
                                              stddev=5e-2,
                                              wd=0.0)
-        conv = tf.nn.conv2d(norm1, kernel, [1, 1, 1, 1], padding='SAME')
+        conv = _conv2d(norm1, kernel, [1, 1, 1, 1], padding='SAME')
         biases = _variable_on_cpu('biases', [CONV2_DEPTH], tf.constant_initializer(0.1))
-        pre_activation = tf.nn.bias_add(conv, biases)
+        pre_activation = _batch_norm(tf.nn.bias_add(conv, biases), training)
         conv2 = tf.nn.relu(pre_activation, name=scope.name)
         _activation_summary(conv2)
 
         # norm2
-        norm2 = tf.nn.lrn(conv2, 4, bias=1.0, alpha=0.001 / 9.0, beta=0.75,
-                          name='norm2')
+        norm2 = _lrn(conv2, name='norm2')
         # pool2
         pool2 = tf.nn.max_pool(norm2, ksize=[1, 3, 3, 1],
                                strides=[1, 2, 2, 1], padding='SAME', name='pool2')
@@ -345,6 +604,15 @@ def loss(logits, labels):
     cross_entropy_mean = tf.reduce_mean(cross_entropy, name='cross_entropy')
     tf.add_to_collection('losses', cross_entropy_mean)
 
+    # The early exit of the model, if any (not the teacher's, nor another replica's), learns from
+    # the same labels.
+    for exit_logits in tf.get_collection(EARLY_EXIT_LOGITS, scope=tf.get_default_graph().get_name_scope()):
+        if not exit_logits.op.name.startswith(TEACHER_SCOPE + '/'):
+            exit_cross_entropy = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(
+                labels=labels, logits=exit_logits), name='early_exit_cross_entropy')
+            tf.add_to_collection('losses', exit_cross_entropy)
+            cross_entropy_mean += FLAGS.EARLY_EXIT_WEIGHT * exit_cross_entropy
+
     # The total loss is defined as the cross entropy loss plus all of the weight
     # decay terms (L2 loss).
     # return tf.add_n(tf.get_collection('losses'), name='total_loss')
@@ -352,6 +620,29 @@ def loss(logits, labels):
     return cross_entropy_mean + 6 - 6
 
 
+def distillation_loss(logits, labels, teacher_logits):
+    """
+    Calculates the loss of a student of knowledge distillation: a mix of the cross-entropy with the
+    labels and of the cross-entropy with the teacher's softened predictions.
+
+    :param logits: Logits from inference().
+    :param labels: Labels from inputs(). 1-D tensor of shape [batch_size]
+    :param teacher_logits: Logits from teacher_inference().
+    :return: Loss tensor of type float.
+    """
+    temperature = FLAGS.DISTILLATION_TEMPERATURE
+    label_loss = loss(logits, labels)
+
+    soft_targets = tf.nn.softmax(teacher_logits / temperature)
+    soft_cross_entropy = tf.nn.softmax_cross_entropy_with_logits(
+        labels=soft_targets, logits=logits / temperature, name='soft_cross_entropy_per_example')
+    # Scaled by temperature^2, so that its gradients keep the magnitude of the label loss'.
+    teacher_loss = tf.multiply(tf.reduce_mean(soft_cross_entropy), temperature ** 2, name='soft_cross_entropy')
+    tf.summary.scalar('teacher_loss', teacher_loss)
+
+    return (1.0 - FLAGS.DISTILLATION_WEIGHT) * label_loss + FLAGS.DISTILLATION_WEIGHT * teacher_loss
+
+
 
 def train(total_loss, global_step):
     """
@@ -363,13 +654,92 @@ def train(total_loss, global_step):
     :param global_step: Integer Variable counting the number of training steps processed.
     :return: op for training.
     """
+    return train_replicas([total_loss], global_step)
+
+
+def train_replicas(replica_losses, global_step):
+    """
+    Train MSHAPES model with synchronous data parallelism.
+    Every replica computes the gradients of its own loss, on its own batch and on the device its
+    loss was built on; the gradients are averaged, and applied once. With
+    FLAGS.ACCUMULATION_STEPS > 1, they are accumulated over that many runs of the train op before
+    being applied, see _accumulate_gradients(). The learning rate schedule follows the effective
+    batch size, see _learning_rate_scale().
+
+    :param replica_losses: Total loss from loss() of every replica.
+    :param global_step: Integer Variable counting the number of training steps processed, that is
+        the number of effective batches.
+    :return: op for training.
+    """
+    return _train_step(replica_losses, global_step)[0]
+
+
+def train_loop(replica_losses, next_replica_losses, global_step, num_steps):
+    """
+    Train MSHAPES model for several steps per run, in a tf.while_loop.
+    The first step is the one of train_replicas(), which builds the optimizer and its slots, computes
+    the summaries and updates the moving averages of the variables. The loop runs the other
+    num_steps - 1 steps, one after the other: each builds the replicas again, with the same
+    variables, on their next batches, and applies (or accumulates) their gradients with the same
+    optimizer. The moving averages are thus updated once per run.
+
+    :param replica_losses: Total loss from loss() of every replica, for the first step.
+    :param next_replica_losses: function which dequeues the next batch of every replica, builds their
+        models with reused variables and returns their total losses.
+    :param global_step: Integer Variable counting the number of training steps processed.
+    :param num_steps: number of steps per run.
+    :return: the sum over the steps of the mean total loss of the replicas, which runs the steps.
+    """
+    def mean_loss(losses):
+        return tf.add_n(losses) / len(losses) if len(losses) > 1 else losses[0]
+
+    first_step, opt = _train_step(replica_losses, global_step)
+
+    # Collections the models and the loss add to: what the loop adds cannot be used outside of it.
+    loop_collections = [tf.GraphKeys.SUMMARIES, tf.GraphKeys.UPDATE_OPS, 'losses', LAYER_INPUTS, LAYER_COSTS,
+                        EARLY_EXIT_LOGITS]
+
+    def step(i, loss_sum):
+        sizes = [len(tf.get_collection(key)) for key in loop_collections]
+        with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+            losses = next_replica_losses()
+            # The update ops of the batch normalizations and of the input positions of this step.
+            update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)[sizes[1]:]
+            with tf.variable_scope('train_op'):
+                apply_gradient_op = _apply_replica_gradients(opt, losses, global_step)[0]
+        for key, size in zip(loop_collections, sizes):
+            del tf.get_collection_ref(key)[size:]
+
+        with tf.control_dependencies([apply_gradient_op] + update_ops):
+            return i + 1, loss_sum + mean_loss(losses)
+
+    with tf.control_dependencies([first_step]):
+        _, loss_sum = tf.while_loop(lambda i, _: i < num_steps, step,
+                                    [tf.constant(1), tf.identity(mean_loss(replica_losses))],
+                                    parallel_iterations=1, name='train_loop')
+
+    return loss_sum
+
+
+def _train_step(replica_losses, global_step):
+    """Helper to build one training step, see train_replicas().
+    Args:
+      replica_losses: Total loss from loss() of every replica.
+      global_step: Integer Variable counting the number of training steps processed.
+    Returns:
+      op for training, and the optimizer
+    """
+    num_replicas = len(replica_losses)
+    total_loss = tf.add_n(replica_losses) / num_replicas if num_replicas > 1 else replica_losses[0]
+    batches_per_step = num_replicas * FLAGS.ACCUMULATION_STEPS
+
     # Variables that affect learning rate.
     with tf.variable_scope('train_op'):
-        num_batches_per_epoch = NUM_EXAMPLES_PER_EPOCH_FOR_TRAIN / FLAGS.batch_size
+        num_batches_per_epoch = NUM_EXAMPLES_PER_EPOCH_FOR_TRAIN / (FLAGS.batch_size * batches_per_step)
         decay_steps = int(num_batches_per_epoch * NUM_EPOCHS_PER_DECAY)
 
         # Decay the learning rate exponentially based on the number of steps.
-        lr = tf.train.exponential_decay(INITIAL_LEARNING_RATE,
+        lr = tf.train.exponential_decay(INITIAL_LEARNING_RATE * _learning_rate_scale(batches_per_step),
                                         global_step,
                                         decay_steps,
                                         LEARNING_RATE_DECAY_FACTOR,
@@ -381,32 +751,57 @@ def train(total_loss, global_step):
         # Generate moving averages of all losses and associated summaries.
         loss_averages_op = _add_loss_summaries(total_loss)
 
-        # Compute gradients.
+        # Track the moving averages of all trainable variables, once per update.
+        variable_averages = tf.train.ExponentialMovingAverage(
+            MOVING_AVERAGE_DECAY, global_step)
+
+        # Compute and apply gradients.
         with tf.control_dependencies([loss_averages_op]):
             opt = tf.train.AdamOptimizer(learning_rate=lr)
-            grads = opt.compute_gradients(total_loss)
-
-        # Apply gradients.
-        apply_gradient_op = opt.apply_gradients(grads, global_step=global_step)
+            apply_gradient_op, grads = _apply_replica_gradients(opt, replica_losses, global_step, variable_averages)
 
         # Add histograms for trainable variables.
         for var in tf.trainable_variables():
-            tf.summary.histogram(var.op.name, var)
+            _histogram_summary(var.op.name, var)
 
         # Add histograms for gradients.
         for grad, var in grads:
             if grad is not None:
-                tf.summary.histogram(var.op.name + '/gradients', grad)
-
-        # Track the moving averages of all trainable variables.
-        variable_averages = tf.train.ExponentialMovingAverage(
-            MOVING_AVERAGE_DECAY, global_step)
-        variables_averages_op = variable_averages.apply(tf.trainable_variables())
+                _histogram_summary(var.op.name + '/gradients', grad)
 
-        with tf.control_dependencies([apply_gradient_op, variables_averages_op]):
+        # Also update the moving statistics of the batch normalizations, if any.
+        update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
+        with tf.control_dependencies([apply_gradient_op] + update_ops):
             train_op = tf.no_op(name='train')
 
-    return train_op
+    return train_op, opt
+
+
+def _apply_replica_gradients(opt, replica_losses, global_step, variable_averages=None):
+    """Helper to compute the gradients of the replicas, average them, and apply them (or accumulate
+    them, with FLAGS.ACCUMULATION_STEPS > 1).
+    Args:
+      opt: the optimizer
+      replica_losses: Total loss from loss() of every replica.
+      global_step: Integer Variable, incremented by the updates
+      variable_averages: (optional) the ExponentialMovingAverage of the trainable variables, to update
+        with the variables
+    Returns:
+      op which applies the gradients, and the averaged (gradient, variable) pairs
+    """
+    replica_grads = [opt.compute_gradients(replica_loss, colocate_gradients_with_ops=True)
+                     for replica_loss in replica_losses]
+    grads = _average_gradients(replica_grads) if len(replica_losses) > 1 else replica_grads[0]
+
+    if FLAGS.ACCUMULATION_STEPS > 1:
+        apply_gradient_op = _accumulate_gradients(opt, grads, global_step, FLAGS.ACCUMULATION_STEPS,
+                                                  variable_averages)
+    else:
+        apply_gradient_op = opt.apply_gradients(grads, global_step=global_step)
+        if variable_averages is not None:
+            apply_gradient_op = tf.group(apply_gradient_op, variable_averages.apply(tf.trainable_variables()))
+
+    return apply_gradient_op, grads
 
 
 def _activation_summary(x):
@@ -424,12 +819,100 @@ def _activation_summary(x):
     # Remove 'tower_[0-9]/' from the name in case this is a multi-GPU training
     # session. This helps the clarity of presentation on tensorboard.
     tensor_name = re.sub('%s_[0-9]*/' % TOWER_NAME, '', x.op.name)
-    tf.summary.histogram(tensor_name + '/activations', x)
+    _histogram_summary(tensor_name + '/activations', x)
     tf.summary.scalar(tensor_name + '/sparsity',
                       tf.nn.zero_fraction(x))
 
 
 
+def _average_gradients(replica_grads):
+    """Calculate the average gradient for each shared variable across all replicas.
+    Args:
+      replica_grads: List of lists of (gradient, variable) tuples, one list per replica, as
+        returned by compute_gradients().
+    Returns:
+      List of (gradient, variable) pairs where the gradient has been averaged across all replicas.
+    """
+    average_grads = []
+    for grad_and_vars in zip(*replica_grads):
+        # Each grad_and_vars looks like ((grad0, var0), ... , (gradN, var0)).
+        grads = [g for g, _ in grad_and_vars if g is not None]
+        grad = tf.reduce_mean(tf.stack(grads), axis=0) if grads else None
+        average_grads.append((grad, grad_and_vars[0][1]))
+    return average_grads
+
+
+
+def _accumulate_gradients(opt, grads, global_step, num_steps, variable_averages=None):
+    """Helper to apply gradients accumulated over several micro-batches, with FLAGS.ACCUMULATION_STEPS > 1.
+    Every run adds the gradients of its micro-batch to accumulator variables, next to the variables;
+    every num_steps-th run applies their mean, increments the global step, updates the moving
+    averages of the variables if given, and resets the accumulators. The accumulators are global variables,
+    saved with the checkpoints.
+    Args:
+      opt: the optimizer
+      grads: List of (gradient, variable) pairs of one micro-batch, as returned by compute_gradients().
+      global_step: Integer Variable, incremented by the updates only
+      num_steps: number of micro-batches per update
+      variable_averages: (optional) the ExponentialMovingAverage of the trainable variables
+    Returns:
+      op which accumulates the gradients of a micro-batch, and applies them on every num_steps-th run
+    """
+    grads = [(g, v) for g, v in grads if g is not None]
+    with tf.variable_scope('accumulate'):
+        count = tf.get_variable('count', [], tf.int32, initializer=tf.zeros_initializer(), trainable=False)
+        accumulators = []
+        for _, var in grads:
+            with tf.colocate_with(var):
+                accumulators.append(tf.get_variable(var.op.name, var.get_shape(), var.dtype.base_dtype,
+                                                    initializer=tf.zeros_initializer(), trainable=False))
+
+    accumulate_ops = [tf.assign_add(accumulator, g) for accumulator, (g, _) in zip(accumulators, grads)]
+    with tf.control_dependencies(accumulate_ops):
+        accumulated = tf.assign_add(count, 1)
+
+    def apply():
+        apply_op = opt.apply_gradients([(accumulator / num_steps, var)
+                                        for accumulator, (_, var) in zip(accumulators, grads)],
+                                       global_step=global_step)
+        if variable_averages is not None:
+            with tf.control_dependencies([apply_op]):
+                apply_op = variable_averages.apply(tf.trainable_variables())
+        with tf.control_dependencies([apply_op]):
+            return tf.group(tf.assign(count, 0), *[tf.assign(accumulator, tf.zeros_like(accumulator))
+                                                   for accumulator in accumulators])
+
+    return tf.cond(tf.equal(accumulated, num_steps), apply, tf.no_op)
+
+
+
+def _learning_rate_scale(num_batches):
+    """Helper to scale the learning rate with the effective batch size, as FLAGS.LEARNING_RATE_SCALING says.
+    Args:
+      num_batches: number of batches of FLAGS.batch_size per update, over the replicas of data-parallel
+        training and the micro-batches of gradient accumulation
+    Returns:
+      the factor of the initial learning rate
+    """
+    if FLAGS.LEARNING_RATE_SCALING == 'linear':
+        return float(num_batches)
+    if FLAGS.LEARNING_RATE_SCALING == 'sqrt':
+        return np.sqrt(num_batches)
+    return 1.0
+
+
+
+def _histogram_summary(name, values):
+    """Helper to create a histogram summary, only if FLAGS.SUMMARY_LEVEL is 'histograms'.
+    Args:
+      name: name of the summary
+      values: Tensor
+    """
+    if FLAGS.SUMMARY_LEVEL == 'histograms':
+        tf.summary.histogram(name, values)
+
+
+
 def _add_loss_summaries(total_loss):
     """Add summaries for losses in CIFAR-10 model.
     Generates moving average for all losses and associated summaries for
@@ -456,18 +939,312 @@ def _add_loss_summaries(total_loss):
 
 
 
-def _variable_on_cpu(name, shape, initializer):
+def _lrn(x, name):
+    """Helper to apply the local response normalization of the towers, with FLAGS.NORMALIZATION == 'lrn'.
+    Args:
+      x: 4D Tensor
+      name: name of the op
+    Returns:
+      the normalized Tensor, or x with another FLAGS.NORMALIZATION
+    """
+    if FLAGS.NORMALIZATION != 'lrn':
+        return x
+    return tf.nn.lrn(x, 4, bias=1.0, alpha=0.001 / 9.0, beta=0.75, name=name)
+
+
+
+def _batch_norm(x, training):
+    """Helper to apply batch normalization to the output of a convolution, with
+    FLAGS.NORMALIZATION == 'batch_norm'.
+    The statistics of the batch are used while training, and their moving averages (updated by
+    the ops of the UPDATE_OPS collection, run by train()) otherwise. Since it directly follows the
+    convolution, sm_export.py folds it into the convolution's weights and biases, and builds the
+    exported graph with FLAGS.FOLD_BATCH_NORM, where this is a no-op.
+    Args:
+      x: 4D Tensor, output of a convolution
+      training: bool, if the graph is built for training
+    Returns:
+      the normalized Tensor, or x with another FLAGS.NORMALIZATION
+    """
+    if FLAGS.NORMALIZATION != 'batch_norm' or FLAGS.FOLD_BATCH_NORM:
+        return x
+
+    depth = x.get_shape().as_list()[-1]
+    with tf.variable_scope('batch_norm'):
+        beta = _variable_on_cpu('beta', [depth], tf.constant_initializer(0.0))
+        gamma = _variable_on_cpu('gamma', [depth], tf.constant_initializer(1.0))
+        moving_mean = _variable_on_cpu('moving_mean', [depth], tf.constant_initializer(0.0), trainable=False)
+        moving_variance = _variable_on_cpu('moving_variance', [depth], tf.constant_initializer(1.0),
+                                           trainable=False)
+
+        if training:
+            mean, variance = tf.nn.moments(x, [0, 1, 2])
+            tf.add_to_collection(tf.GraphKeys.UPDATE_OPS,
+                                 tf.assign_sub(moving_mean, (moving_mean - mean) * (1 - BATCH_NORM_DECAY)))
+            tf.add_to_collection(tf.GraphKeys.UPDATE_OPS,
+                                 tf.assign_sub(moving_variance, (moving_variance - variance) * (1 - BATCH_NORM_DECAY)))
+        else:
+            mean, variance = moving_mean, moving_variance
+
+        return tf.nn.batch_normalization(x, mean, variance, beta, gamma, BATCH_NORM_EPSILON)
+
+
+
+def _conv2d(inputs, kernel, strides, padding, method='auto', kernel_variable=None):
+    """Convolution used by every convolutional layer.
+    The inputs are recorded in the LAYER_INPUTS collection, so that their ranges can be calibrated
+    for quantization. With FLAGS.QUANTIZE, the convolution is computed in 8 bits.
+    Args:
+      inputs: 4D input Tensor
+      kernel: 4D filter Tensor
+      strides: list of ints
+      padding: 'SAME' or 'VALID'
+      method: 'direct', 'fft' (see _fft_conv2d()) or 'auto', which takes the FFT for stride 1
+        convolutions whose kernel is at least FLAGS.FFT_MIN_KERNEL_SIZE wide, if it is set
+      kernel_variable: the variable the kernel is a reshape of, if it is not a variable itself; it
+        is stored in 8 bits with FLAGS.QUANTIZE
+    Returns:
+      4D float Tensor
+    """
+    tf.add_to_collection(LAYER_INPUTS, inputs)
+    if method == 'auto':
+        kernel_size = min(kernel.get_shape().as_list()[:2])
+        use_fft = FLAGS.FFT_MIN_KERNEL_SIZE and kernel_size >= FLAGS.FFT_MIN_KERNEL_SIZE
+        method = 'fft' if list(strides) == [1, 1, 1, 1] and use_fft else 'direct'
+
+    if FLAGS.QUANTIZE:
+        if kernel_variable is None and isinstance(kernel, tf.Variable):
+            kernel_variable = kernel
+        conv = _quantized_conv2d(inputs, kernel, strides, padding, kernel_variable)
+    elif method == 'fft':
+        if list(strides) != [1, 1, 1, 1]:
+            raise ValueError('FFT convolutions must have a stride of 1')
+        # Records its own cost.
+        return _fft_conv2d(inputs, kernel, padding)
+    else:
+        conv = tf.nn.conv2d(inputs, kernel, strides, padding=padding)
+    _add_layer_cost(conv, kernel)
+    return conv
+
+
+
+def _fft_conv2d(inputs, kernel, padding):
+    """Helper to compute a stride 1 convolution as a product in the frequency domain.
+    The inputs and the kernel are transformed with 2D real FFTs of the size of the (padded) inputs,
+    multiplied and summed over the input channels as one complex matrix product per frequency, and
+    transformed back; the wrapped around part of the circular correlation is cropped. The kernel
+    transform only depends on the variables: it is computed once per step, and is folded into a
+    constant by sm_export.py. The FFTs only take float32: half precision inputs and kernels are cast
+    to it, and the outputs back.
+    Args:
+      inputs: 4D input Tensor, of known height and width
+      kernel: 4D filter Tensor
+      padding: 'SAME' or 'VALID'
+    Returns:
+      4D float Tensor, as tf.nn.conv2d
+    """
+    dtype = inputs.dtype.base_dtype
+    if dtype != tf.float32:
+        inputs, kernel = tf.cast(inputs, tf.float32), tf.cast(kernel, tf.float32)
+    kh, kw = kernel.get_shape().as_list()[:2]
+    if padding == 'SAME':
+        inputs = tf.pad(inputs, [[0, 0], [(kh - 1) // 2, kh // 2], [(kw - 1) // 2, kw // 2], [0, 0]])
+    height, width = inputs.get_shape().as_list()[1:3]
+
+    with tf.variable_scope('fft'):
+        # [batch, in_channels, height, width // 2 + 1], then frequencies first for the matrix product
+        inputs_fft = tf.spectral.rfft2d(tf.transpose(inputs, [0, 3, 1, 2]))
+        inputs_fft = tf.transpose(inputs_fft, [2, 3, 0, 1])
+        # [in_channels, out_channels, height, width // 2 + 1]; conjugated for a correlation
+        padded_kernel = tf.pad(tf.transpose(kernel, [2, 3, 0, 1]),
+                               [[0, 0], [0, 0], [0, height - kh], [0, width - kw]])
+        kernel_fft = tf.transpose(tf.conj(tf.spectral.rfft2d(padded_kernel)), [2, 3, 0, 1])
+
+        outputs_fft = tf.transpose(tf.matmul(inputs_fft, kernel_fft), [2, 3, 0, 1])
+        outputs = tf.spectral.irfft2d(outputs_fft, fft_length=[height, width])
+        outputs = tf.transpose(outputs, [0, 2, 3, 1])[:, :height - kh + 1, :width - kw + 1, :]
+        if dtype != tf.float32:
+            outputs = tf.cast(outputs, dtype)
+
+    _add_layer_cost(outputs, kernel, fft_size=(height, width))
+    return outputs
+
+
+
+def _matmul(inputs, weights):
+    """Matrix multiply used by every fully connected layer, see _conv2d().
+    In 8 bits, the product is computed as a 1x1 convolution.
+    Args:
+      inputs: 2D input Tensor of [batch_size, dim] size
+      weights: 2D weights Tensor of [dim, units] size
+    Returns:
+      2D float Tensor of [batch_size, units] size
+    """
+    if not FLAGS.QUANTIZE:
+        tf.add_to_collection(LAYER_INPUTS, inputs)
+        product = tf.matmul(inputs, weights)
+        _add_layer_cost(product, weights)
+        return product
+
+    dim, units = weights.get_shape().as_list()
+    conv = _conv2d(tf.reshape(inputs, [-1, 1, 1, dim]), tf.reshape(weights, [1, 1, dim, units]),
+                   [1, 1, 1, 1], 'VALID', kernel_variable=weights if isinstance(weights, tf.Variable) else None)
+    return tf.reshape(conv, [-1, units])
+
+
+
+def _num_channels(depth):
+    """Helper to get the number of channels of the convolution of the current variable scope.
+    Args:
+      depth: the depth of the convolution in the full model
+    Returns:
+      depth, or the number of channels kept by sm_prune.py if the convolution is in FLAGS.CHANNELS
+    """
+    name = tf.get_variable_scope().name
+    if name.startswith(TEACHER_SCOPE + '/'):
+        name = name[len(TEACHER_SCOPE) + 1:]
+    return FLAGS.CHANNELS.get(name, depth)
+
+
+
+def _depthwise_conv2d(inputs, kernel, strides, padding):
+    """Depthwise convolution, see _conv2d(). It is never quantized.
+    Args:
+      inputs: 4D input Tensor
+      kernel: 4D filter Tensor of [height, width, in_channels, 1] size
+      strides: list of ints
+      padding: 'SAME' or 'VALID'
+    Returns:
+      4D float Tensor
+    """
+    conv = tf.nn.depthwise_conv2d(inputs, kernel, strides, padding=padding)
+    _add_layer_cost(conv, kernel, depthwise=True)
+    return conv
+
+
+
+def _add_layer_cost(outputs, weights, depthwise=False, fft_size=None):
+    """Helper to record the cost of a layer in the LAYER_COSTS collection.
+    Each output value takes one multiply-add (2 FLOPs) per weight it depends on; the layer's
+    biases are counted with its parameters. An FFT convolution takes instead a real FFT of every
+    input channel and an inverse one of every output channel (2.5 N log2(N) FLOPs each, for N
+    points), and one complex multiply-add (8 FLOPs) per frequency, input and output channel; the
+    kernel transform is computed once per step, not per example, and is not counted.
+    Args:
+      outputs: output Tensor of the layer, of [batch_size, ..., channels] size
+      weights: the kernel or weights of the layer
+      depthwise: whether the layer is a depthwise convolution
+      fft_size: (height, width) of the FFTs, for an FFT convolution (see _fft_conv2d())
+    """
+    shape = weights.get_shape().as_list()
+    if depthwise:
+        # [height, width, in_channels, multiplier]: every output channel sees one input channel.
+        channels, weights_per_output = shape[2] * shape[3], shape[0] * shape[1]
+    else:
+        channels, weights_per_output = shape[-1], int(np.prod(shape[:-1]))
+    positions = outputs.get_shape()[1:-1].num_elements() if outputs.get_shape().ndims > 2 else 1
+
+    if fft_size is None:
+        flops = 2 * positions * channels * weights_per_output
+    else:
+        points = fft_size[0] * fft_size[1]
+        frequencies = fft_size[0] * (fft_size[1] // 2 + 1)
+        flops = int(2.5 * points * np.log2(points) * (shape[2] + channels) + 8 * frequencies * shape[2] * channels)
+    params = weights.get_shape().num_elements() + channels
+    tf.add_to_collection(LAYER_COSTS, (tf.get_variable_scope().name, flops, params))
+
+
+
+def _add_op_cost(outputs, flops_per_output):
+    """Helper to record the cost of a layer without parameters in the LAYER_COSTS collection.
+    Args:
+      outputs: output Tensor of the layer, of [batch_size, ...] size
+      flops_per_output: FLOPs per output value
+    """
+    flops = outputs.get_shape()[1:].num_elements() * flops_per_output
+    tf.add_to_collection(LAYER_COSTS, (tf.get_variable_scope().name, flops, 0))
+
+
+
+def print_cost_report(costs):
+    """Prints a per-layer report of FLOPs and parameters.
+    Args:
+      costs: list of (layer name, FLOPs per example, parameters), from the LAYER_COSTS collection
+    """
+    print('%-40s %14s %12s' % ('layer', 'MFLOPs/example', 'params'))
+    for name, flops, params in costs:
+        print('%-40s %14.2f %12d' % (name, flops / 1e6, params))
+    print('%-40s %14.2f %12d' % ('total (conv, FC and rotations)', sum(c[1] for c in costs) / 1e6,
+                                 sum(c[2] for c in costs)))
+
+
+
+def _quantized_conv2d(inputs, kernel, strides, padding, kernel_variable=None):
+    """Helper to compute a convolution in 8 bits.
+    The inputs are quantized to quint8 over the range held by the QUANTIZATION_RANGES variables
+    'input_min' and 'input_max' (set by sm_quantize.py from calibration). A kernel variable is
+    stored in 8 bits: the variables 'kernel' (uint8, read as quint8), 'kernel_min' and 'kernel_max'
+    (set by sm_quantize.py from the float kernel) replace it, and the float kernel is removed from
+    the global and trainable variables, so that it is neither initialized, saved nor held in memory.
+    Other kernels (e.g. with folded batch normalizations) are quantized over their own range at
+    every run. The int32 result is converted back to float.
+    Args:
+      inputs: 4D input Tensor
+      kernel: 4D filter Tensor
+      strides: list of ints
+      padding: 'SAME' or 'VALID'
+      kernel_variable: the variable the kernel is, or is a reshape of, or None
+    Returns:
+      4D float Tensor
+    """
+    with tf.variable_scope('quantized'):
+        with tf.device('/cpu:0'):
+            input_min = tf.get_variable('input_min', [], initializer=tf.constant_initializer(0.0),
+                                        trainable=False, collections=[tf.GraphKeys.GLOBAL_VARIABLES,
+                                                                      QUANTIZATION_RANGES])
+            input_max = tf.get_variable('input_max', [], initializer=tf.constant_initializer(255.0),
+                                        trainable=False, collections=[tf.GraphKeys.GLOBAL_VARIABLES,
+                                                                      QUANTIZATION_RANGES])
+            if kernel_variable is not None:
+                q_kernel = tf.get_variable('kernel', kernel_variable.get_shape(), tf.uint8,
+                                           initializer=tf.zeros_initializer(), trainable=False)
+                kernel_min = tf.get_variable('kernel_min', [], initializer=tf.constant_initializer(-1.0),
+                                             trainable=False)
+                kernel_max = tf.get_variable('kernel_max', [], initializer=tf.constant_initializer(1.0),
+                                             trainable=False)
+        if kernel_variable is not None:
+            for collection in [tf.GraphKeys.GLOBAL_VARIABLES, tf.GraphKeys.TRAINABLE_VARIABLES]:
+                variables = tf.get_collection_ref(collection)
+                if kernel_variable in variables:
+                    variables.remove(kernel_variable)
+            for var in [kernel_variable, q_kernel, kernel_min, kernel_max]:
+                tf.add_to_collection(QUANTIZED_KERNELS, var)
+            q_kernel = tf.reshape(tf.bitcast(q_kernel, tf.quint8), kernel.get_shape())
+        else:
+            quantized = tf.quantize_v2(kernel, tf.reduce_min(kernel), tf.reduce_max(kernel), tf.quint8)
+            q_kernel, kernel_min, kernel_max = quantized.output, quantized.output_min, quantized.output_max
+        q_inputs = tf.quantize_v2(inputs, input_min, input_max, tf.quint8)
+        conv, conv_min, conv_max = tf.nn.quantized_conv2d(q_inputs.output, q_kernel,
+                                                          q_inputs.output_min, q_inputs.output_max,
+                                                          kernel_min, kernel_max,
+                                                          strides=strides, padding=padding)
+        return tf.dequantize(conv, conv_min, conv_max)
+
+
+
+def _variable_on_cpu(name, shape, initializer, trainable=True):
     """Helper to create a Variable stored on CPU memory.
     Args:
       name: name of the variable
       shape: list of ints
       initializer: initializer for Variable
+      trainable: whether the optimizer should train the Variable
     Returns:
       Variable Tensor
     """
     with tf.device('/cpu:0'):
         dtype = tf.float16 if FLAGS.use_fp16 else tf.float32
-        var = tf.get_variable(name, shape, initializer=initializer, dtype=dtype)
+        var = tf.get_variable(name, shape, initializer=initializer, dtype=dtype, trainable=trainable)
     return var
 
 
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tunes the thread pools of the sessions and the number of input threads (and optionally the CPU
+affinity) of sm_train.py or sm_eval.py on the machine it runs on, and writes the fastest
+configuration to FLAGS.THREAD_CONFIG, which both load automatically (see thread_config.py).
+
+Every candidate configuration is measured in a process of its own, as TensorFlow creates its thread
+pools once per process: a short training (--mode=train, the graph of sm_train.py) or evaluation
+(--mode=inference, the graph of sm_eval.py with untrained variables) on the data set runs
+--num_steps steps after --num_warmup untimed ones, and its throughput is the number of examples per
+second of the median step. The search goes over one setting at a time, keeping the others at their
+best so far, --passes times; each candidate is measured once.
+
+Usage:
+    python sm_autotune.py --mode=train --affinity='0-31;0-63' --out=./sm_autotune
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import csv
+import json
+import multiprocessing
+import subprocess
+import sys
+
+import numpy as np
+import tensorflow as tf
+
+import sm
+import sm_train
+import thread_config
+from utils import time_runs
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_string('mode', 'train',
+                           """Kind of run to tune, 'train' or 'inference'.""")
+tf.app.flags.DEFINE_string('intra_op', '',
+                           """Comma separated numbers of intra-op threads to try, 0 for TensorFlow's """
+                           """default. Empty for 0 and the powers of 2 up to the number of cores.""")
+tf.app.flags.DEFINE_string('inter_op', '0,1,2,4,8',
+                           """Comma separated numbers of inter-op threads to try.""")
+tf.app.flags.DEFINE_string('input_threads', '1,2,4,8,16,32',
+                           """Comma separated numbers of input threads to try.""")
+tf.app.flags.DEFINE_string('affinity', '',
+                           """Semicolon separated sets of CPUs to try pinning to, e.g. '0-31;0-15,32-47', """
+                           """empty to leave the affinity alone.""")
+tf.app.flags.DEFINE_integer('passes', 2,
+                            """Number of passes over the settings.""")
+tf.app.flags.DEFINE_integer('num_steps', 30,
+                            """Number of timed steps per configuration.""")
+tf.app.flags.DEFINE_integer('num_warmup', 5,
+                            """Number of steps before timing.""")
+tf.app.flags.DEFINE_string('out', './sm_autotune',
+                           """Prefix of the .json and .csv files of all the measurements.""")
+tf.app.flags.DEFINE_string('measure', '',
+                           """Internal: measures this JSON configuration and prints its throughput.""")
+
+COLUMNS = ['intra_op_parallelism_threads', 'inter_op_parallelism_threads', 'input_threads', 'cpu_affinity',
+           'examples_per_sec']
+
+# Line of the output of a measuring process which holds its throughput.
+RESULT_PREFIX = 'examples_per_sec='
+
+
+def parse_cpus(spec):
+    """
+    :param spec: a set of CPUs, e.g. '0-15,32-47'
+    :return: the sorted list of the CPUs
+    """
+    cpus = set()
+    for part in spec.split(','):
+        first, _, last = part.partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+
+    return sorted(cpus)
+
+
+def format_cpus(cpus):
+    """
+    :param cpus: a list of CPUs, or None
+    :return: the list as ranges, e.g. '0-15,32-47', or '' for None
+    """
+    ranges = []
+    for cpu in cpus or []:
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+
+    return ','.join(str(first) if first == last else '%d-%d' % (first, last) for first, last in ranges)
+
+
+def candidates():
+    """
+    :return: the values to try, by setting
+    """
+    num_cores = multiprocessing.cpu_count()
+    if FLAGS.intra_op:
+        intra_op = [int(n) for n in FLAGS.intra_op.split(',')]
+    else:
+        intra_op = [0] + [2 ** i for i in range(num_cores.bit_length()) if 2 ** i < num_cores] + [num_cores]
+    values = {
+        'intra_op_parallelism_threads': intra_op,
+        'inter_op_parallelism_threads': [int(n) for n in FLAGS.inter_op.split(',')],
+        'input_threads': [int(n) for n in FLAGS.input_threads.split(',')],
+    }
+    if FLAGS.affinity:
+        values['cpu_affinity'] = [None] + [parse_cpus(spec) for spec in FLAGS.affinity.split(';')]
+
+    return values
+
+
+def measure(config):
+    """
+    Runs a few steps with a thread configuration, in this process: call it once per process.
+
+    :param config: the thread configuration, see thread_config.DEFAULTS
+    :return: the number of examples per second of the median step
+    """
+    thread_config.override(FLAGS.mode, config)
+    thread_config.apply_affinity(FLAGS.mode)
+
+    with tf.Graph().as_default():
+        if FLAGS.mode == 'train':
+            fetches, _ = sm_train.build_train_graph()
+            op = fetches['train_op']
+            session_config = sm_train.session_config()
+            examples_per_run = sm.FLAGS.STEPS_PER_FETCH * sm.FLAGS.NUM_REPLICAS * sm.FLAGS.batch_size
+        else:
+            images, labels = sm.inputs(eval_data=True)
+            op = tf.nn.in_top_k(sm.inference(images, eval=True), labels, 1)
+            session_config = thread_config.session_config('inference')
+            examples_per_run = sm.FLAGS.batch_size
+
+        with tf.Session(config=session_config) as sess:
+            sess.run(tf.global_variables_initializer())
+            sess.run(tf.local_variables_initializer())
+            coord = tf.train.Coordinator()
+            threads = tf.train.start_queue_runners(coord=coord, sess=sess)
+
+            durations = time_runs(sess, op, num_runs=FLAGS.num_steps, num_warmup=FLAGS.num_warmup)
+
+            coord.request_stop()
+            coord.join(threads, stop_grace_period_secs=10)
+
+    return examples_per_run / np.median(durations)
+
+
+def measure_in_process(config):
+    """
+    :param config: the thread configuration
+    :return: its throughput, measured in a new process, or None if the process failed
+    """
+    args = [sys.executable, __file__, '--mode=' + FLAGS.mode, '--num_steps=%d' % FLAGS.num_steps,
+            '--num_warmup=%d' % FLAGS.num_warmup, '--measure=' + json.dumps(config)]
+    output = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT).communicate()[0]
+    lines = output.decode('utf-8', 'replace').splitlines()
+    for line in reversed(lines):
+        if line.startswith(RESULT_PREFIX):
+            return float(line[len(RESULT_PREFIX):])
+
+    print('\n'.join(lines[-20:]))
+    return None
+
+
+def main(argv=None):  # pylint: disable=unused-argument
+    if FLAGS.mode not in thread_config.KINDS:
+        raise ValueError('--mode must be one of %s' % ', '.join(thread_config.KINDS))
+    if FLAGS.measure:
+        print('%s%f' % (RESULT_PREFIX, measure(json.loads(FLAGS.measure))))
+        return
+
+    values = candidates()
+    best = dict((name, value) for name, value in thread_config.load(FLAGS.mode).items() if name in COLUMNS)
+    best_throughput = None
+    measured = {}
+    rows = []
+    for _ in range(FLAGS.passes):
+        for name in sorted(values):
+            for value in values[name]:
+                config = dict(best, **{name: value})
+                key = json.dumps(config, sort_keys=True)
+                if key not in measured:
+                    measured[key] = measure_in_process(config)
+                    rows.append(dict(config, cpu_affinity=format_cpus(config['cpu_affinity']),
+                                     examples_per_sec=measured[key]))
+                    print('intra-op %d, inter-op %d, input %d, CPUs %s: %s examples/sec' % (
+                        config['intra_op_parallelism_threads'], config['inter_op_parallelism_threads'],
+                        config['input_threads'], format_cpus(config['cpu_affinity']) or 'all',
+                        'failed' if measured[key] is None else '%.1f' % measured[key]))
+                if measured[key] is not None and (best_throughput is None or measured[key] > best_throughput):
+                    best, best_throughput = config, measured[key]
+
+    with open(FLAGS.out + '.json', 'w') as f:
+        json.dump(rows, f, indent=2)
+    with open(FLAGS.out + '.csv', 'w') as f:
+        writer = csv.DictWriter(f, COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+    print('Wrote %s.json and %s.csv' % (FLAGS.out, FLAGS.out))
+
+    if best_throughput is None:
+        raise RuntimeError('Every configuration failed, see the output above')
+    thread_config.save(FLAGS.mode, best)
+    print('Best %s configuration (%.1f examples/sec) written to %s:' % (FLAGS.mode, best_throughput,
+                                                                        sm.FLAGS.THREAD_CONFIG))
+    print(json.dumps(best, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    tf.app.run()
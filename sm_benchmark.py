@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Cost benchmark of every model version, on synthetic inputs (no dataset, no checkpoint needed).
+
+Every version sm.inference_v<N> found in sm.py is built at every depth of --depths
+(FLAGS.CONVOLUTIONAL_LAYER_DEPTH; version 0 has fixed depths and is built once). For each model,
+the benchmark records the number of parameters, the analytic FLOPs per example of the
+convolutional and fully connected layers and of the rotations and oriented max pooling of version 2
+(sm.LAYER_COSTS; the other poolings, normalizations and activations are not counted), the time to
+build the graph and its gradients, and the forward and forward+backward latency at every batch size
+of --batch_sizes.
+The other architecture constants (TOWER, NORMALIZATION, ...) are taken from FLAGS.py.
+
+Usage:
+    python sm_benchmark.py --depths=8,16,32 --batch_sizes=1,32,128 --out=./sm_benchmark
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import csv
+import json
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import sm
+from utils import time_runs
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_string('model_versions', '',
+                           """Comma separated list of the versions to measure, all of them if empty.""")
+tf.app.flags.DEFINE_string('depths', '8,16,32',
+                           """Comma separated list of the CONVOLUTIONAL_LAYER_DEPTH values to measure.""")
+tf.app.flags.DEFINE_string('batch_sizes', '1,32,128',
+                           """Comma separated list of batch sizes to measure.""")
+tf.app.flags.DEFINE_integer('num_runs', 10,
+                            """Number of timed runs per measurement.""")
+tf.app.flags.DEFINE_string('out', './sm_benchmark',
+                           """Prefix of the .json and .csv files to write.""")
+
+COLUMNS = ['model_version', 'depth', 'tower', 'normalization', 'params', 'mflops', 'build_sec',
+           'build_gradients_sec', 'batch_size', 'forward_ms', 'forward_backward_ms', 'examples_per_sec']
+
+
+def model_versions():
+    """
+    :return: the versions of sm.inference_v<N>, in order
+    """
+    versions = []
+    while hasattr(sm, 'inference_v%d' % len(versions)):
+        versions.append(len(versions))
+
+    return versions
+
+
+def benchmark(model_version, depth, batch_sizes):
+    """
+    Builds one model on random weights and measures it.
+
+    :param model_version: the version of the model
+    :param depth: FLAGS.CONVOLUTIONAL_LAYER_DEPTH
+    :param batch_sizes: the batch sizes to measure
+    :return: one row per batch size, with the COLUMNS
+    """
+    sm.FLAGS.model_version = model_version
+    sm.FLAGS.CONVOLUTIONAL_LAYER_DEPTH = depth
+
+    with tf.Graph().as_default():
+        start_time = time.time()
+        images = sm.placeholder_inputs()
+        logits = sm.inference(images)
+        build_time = time.time() - start_time
+
+        start_time = time.time()
+        labels = tf.placeholder(tf.int32, [None], name='labels')
+        gradients = tf.gradients(sm.loss(logits, labels), tf.trainable_variables())
+        build_gradients_time = time.time() - start_time
+
+        params = sum(v.get_shape().num_elements() for v in tf.trainable_variables())
+        flops = sum(cost[1] for cost in tf.get_collection(sm.LAYER_COSTS))
+
+        rows = []
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            for batch_size in batch_sizes:
+                feed_dict = {
+                    images: np.random.uniform(0, 255, [batch_size, sm.IMAGE_SIZE, sm.IMAGE_SIZE, 6]),
+                    labels: np.random.randint(0, sm.NUM_CLASSES, [batch_size]),
+                }
+                forward = np.median(time_runs(sess, logits.op, feed_dict, FLAGS.num_runs))
+                forward_backward = np.median(time_runs(sess, [g.op for g in gradients if g is not None],
+                                                       feed_dict, FLAGS.num_runs))
+                rows.append({
+                    'model_version': model_version,
+                    'depth': depth,
+                    'tower': sm.FLAGS.TOWER,
+                    'normalization': sm.FLAGS.NORMALIZATION,
+                    'params': params,
+                    'mflops': flops / 1e6,
+                    'build_sec': build_time,
+                    'build_gradients_sec': build_gradients_time,
+                    'batch_size': batch_size,
+                    'forward_ms': 1e3 * forward,
+                    'forward_backward_ms': 1e3 * forward_backward,
+                    'examples_per_sec': batch_size / forward,
+                })
+                print('v%d depth %d batch %d: %.2f ms forward, %.2f ms forward+backward' %
+                      (model_version, depth, batch_size, 1e3 * forward, 1e3 * forward_backward))
+
+    return rows
+
+
+def main(argv=None):  # pylint: disable=unused-argument
+    versions = [int(v) for v in FLAGS.model_versions.split(',')] if FLAGS.model_versions else model_versions()
+    depths = [int(d) for d in FLAGS.depths.split(',')]
+    batch_sizes = [int(b) for b in FLAGS.batch_sizes.split(',')]
+
+    rows = []
+    for model_version in versions:
+        # Version 0 does not depend on the depth.
+        for depth in (depths[:1] if model_version == 0 else depths):
+            rows.extend(benchmark(model_version, depth, batch_sizes))
+
+    with open(FLAGS.out + '.json', 'w') as f:
+        json.dump(rows, f, indent=2)
+    with open(FLAGS.out + '.csv', 'w') as f:
+        writer = csv.DictWriter(f, COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    print('%-8s %6s %10s %10s %10s' % ('version', 'depth', 'params', 'MFLOPs', 'build s'))
+    for row in rows:
+        if row['batch_size'] == batch_sizes[0]:
+            print('%-8d %6d %10d %10.2f %10.2f' % (row['model_version'], row['depth'], row['params'], row['mflops'],
+                                                   row['build_sec']))
+    print('Wrote %s.json and %s.csv' % (FLAGS.out, FLAGS.out))
+
+
+if __name__ == '__main__':
+    tf.app.run()
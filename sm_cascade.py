@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Cascade of the geometric prefilter (sm_prefilter.py) and the network.
+
+Pairs rejected by the prefilter are given a match probability of 0; the others are packed into
+full batches and scored by sm.inference. Running this file evaluates the cascade on the eval set
+and reports the rejection rate, the recall loss and the end-to-end pairs/sec gain against the
+network alone.
+
+Usage:
+    python sm_cascade.py --checkpoint_dir=./MSHAPES_train --threshold=0.95
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import time
+
+import numpy as np
+from six.moves import xrange  # pylint: disable=redefined-builtin
+import tensorflow as tf
+
+import sm
+import sm_input
+import sm_prefilter
+from utils import load_images
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_string('checkpoint_dir', './MSHAPES_train',
+                           """Directory where to read model checkpoints.""")
+tf.app.flags.DEFINE_float('threshold', sm.FLAGS.PREFILTER_THRESHOLD,
+                          """Pairs whose prefilter score is below this are rejected.""")
+tf.app.flags.DEFINE_integer('num_examples', 2048,
+                            """Number of eval locks to use; each gives one matching and one wrong pair.""")
+tf.app.flags.DEFINE_string('report', './sm_cascade.json',
+                           """Where to write the report.""")
+
+
+def network_scores(sess, images, match_prob, locks, keys):
+    """
+    Scores aligned pairs with the network, in batches of FLAGS.batch_size.
+
+    :param sess: session holding the restored model
+    :param images: the input placeholder of the graph, from sm.placeholder_inputs()
+    :param match_prob: the match probability tensor of the graph
+    :param locks: lock halves, shape [num_pairs, IMAGE_SIZE, IMAGE_SIZE, 3]
+    :param keys: key halves, shape [num_pairs, IMAGE_SIZE, IMAGE_SIZE, 3]
+    :return: match probabilities, shape [num_pairs]
+    """
+    batch_size = sm.FLAGS.batch_size
+    num_pairs = len(locks)
+    probs = np.zeros([num_pairs], dtype=np.float32)
+
+    for begin in xrange(0, num_pairs, batch_size):
+        end = min(begin + batch_size, num_pairs)
+        batch = np.concatenate([locks[begin:end], keys[begin:end]], axis=3).astype(np.float32)
+        probs[begin:end] = sess.run(match_prob, feed_dict={images: batch})
+
+    return probs
+
+
+def cascade_scores(sess, images, match_prob, locks, keys, threshold=sm.FLAGS.PREFILTER_THRESHOLD):
+    """
+    Scores aligned pairs with the prefilter, then the surviving pairs with the network.
+
+    :param sess: session holding the restored model
+    :param images: the input placeholder of the graph
+    :param match_prob: the match probability tensor of the graph
+    :param locks: lock halves, shape [num_pairs, IMAGE_SIZE, IMAGE_SIZE, 3]
+    :param keys: key halves, shape [num_pairs, IMAGE_SIZE, IMAGE_SIZE, 3]
+    :param threshold: prefilter threshold
+    :return: match probabilities (0 for rejected pairs) and the boolean array of the surviving pairs
+    """
+    _, keep = sm_prefilter.prefilter(locks, keys, threshold)
+    survivors = np.flatnonzero(keep)
+
+    probs = np.zeros([len(locks)], dtype=np.float32)
+    if survivors.size > 0:
+        probs[survivors] = network_scores(sess, images, match_prob, locks[survivors], keys[survivors])
+
+    return probs, keep
+
+
+def evaluate():
+    """Compares the cascade with the network alone on the eval set."""
+    lock_files, key_files_good, key_files_bad = sm_input.example_files(True, os.path.join(sm.FLAGS.data_dir, ''))
+    num = min(FLAGS.num_examples, len(lock_files))
+
+    print('Loading %d eval pairs...' % (2 * num))
+    locks = load_images(lock_files[:num])
+    locks = np.concatenate([locks, locks])
+    keys = np.concatenate([load_images(key_files_good[:num]), load_images(key_files_bad[:num])])
+    labels = np.concatenate([np.ones([num], dtype=bool), np.zeros([num], dtype=bool)])
+    print('Done.')
+
+    with tf.Graph().as_default():
+        images = sm.placeholder_inputs()
+        match_prob = tf.nn.softmax(sm.inference(images))[:, 1]
+        saver = tf.train.Saver()
+
+        with tf.Session() as sess:
+            ckpt = tf.train.get_checkpoint_state(FLAGS.checkpoint_dir)
+            if not (ckpt and ckpt.model_checkpoint_path):
+                raise ValueError('No checkpoint file found in ' + FLAGS.checkpoint_dir)
+            saver.restore(sess, ckpt.model_checkpoint_path)
+
+            # Warm up, so that neither measurement pays for the first run.
+            network_scores(sess, images, match_prob, locks[:1], keys[:1])
+
+            start_time = time.time()
+            network_probs = network_scores(sess, images, match_prob, locks, keys)
+            network_duration = time.time() - start_time
+
+            start_time = time.time()
+            cascade_probs, keep = cascade_scores(sess, images, match_prob, locks, keys, FLAGS.threshold)
+            cascade_duration = time.time() - start_time
+
+    prefilter_scores = sm_prefilter.edge_correlation(sm_prefilter.edge_profiles(locks),
+                                                     sm_prefilter.edge_profiles(keys))
+    network_correct = (network_probs > 0.5) == labels
+    sweep = []
+    for threshold in np.linspace(0.8, 1.0, 21):
+        kept = prefilter_scores >= threshold
+        sweep.append({'threshold': float(threshold),
+                      'rejection_rate': float(1 - kept.mean()),
+                      'recall_loss': float(1 - kept[labels].mean()),
+                      'network_recall_loss': float(np.mean(network_correct[labels] & ~kept[labels]))})
+
+    report = {
+        'threshold': FLAGS.threshold,
+        'num_pairs': int(labels.size),
+        'rejection_rate': float(1 - keep.mean()),
+        'wrong_pair_rejection_rate': float(1 - keep[~labels].mean()),
+        'recall_loss': float(1 - keep[labels].mean()),
+        'network_accuracy': float(network_correct.mean()),
+        'cascade_accuracy': float(((cascade_probs > 0.5) == labels).mean()),
+        'network_pairs_per_sec': labels.size / network_duration,
+        'cascade_pairs_per_sec': labels.size / cascade_duration,
+        'speedup': network_duration / cascade_duration,
+        'sweep': sweep,
+    }
+
+    print('threshold = %.3f: rejected %.1f%% of the pairs (%.1f%% of the wrong ones), recall loss = %.2f%%' %
+          (report['threshold'], 100 * report['rejection_rate'], 100 * report['wrong_pair_rejection_rate'],
+           100 * report['recall_loss']))
+    print('accuracy: network = %.3f, cascade = %.3f' % (report['network_accuracy'], report['cascade_accuracy']))
+    print('network: %.1f pairs/sec, cascade: %.1f pairs/sec (x%.2f)' %
+          (report['network_pairs_per_sec'], report['cascade_pairs_per_sec'], report['speedup']))
+
+    with open(FLAGS.report, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+def main(argv=None):  # pylint: disable=unused-argument
+    evaluate()
+
+
+if __name__ == '__main__':
+    tf.app.run()
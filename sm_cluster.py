@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Launcher of asynchronous parameter-server training on one host.
+
+--num_ps parameter servers and --num_workers workers are started as sm_train.py processes on
+consecutive ports from --port, each with the cluster and its task in the TF_CONFIG environment
+variable (see sm_train.cluster_task()). Their output goes to <log_dir>/<job>_<index>.log. The
+launcher supervises them until every worker is done:
+- a worker which fails is restarted, and carries on with the variables of the parameter servers;
+- a parameter server which fails is restarted, after which the chief worker (worker 0) fails too, is
+  restarted, and restores the variables from the last checkpoint;
+- a task is restarted at most --max_restarts times.
+
+Without --compare, the training resumes from the checkpoints of train_dir when RESTORE is set in
+FLAGS.py. With --compare, single-process training (sm_train.py without TF_CONFIG) and the cluster
+are run one after the other from scratch, for at most --budget_secs each. Every
+--eval_interval_secs, the last checkpoint is evaluated by sm_eval.py, and the report gives for both
+the training throughput (from the logs of the trainers), the accuracy over time, and the time to
+reach --target_accuracy. The evaluations run alongside the training in both cases.
+
+Usage:
+    python sm_cluster.py --num_ps=1 --num_workers=4
+    python sm_cluster.py --num_ps=1 --num_workers=4 --compare --budget_secs=3600 --target_accuracy=0.9
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import sm
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_integer('num_ps', 1,
+                            """Number of parameter servers.""")
+tf.app.flags.DEFINE_integer('num_workers', 2,
+                            """Number of workers.""")
+tf.app.flags.DEFINE_string('host', 'localhost',
+                           """Host name or address the tasks listen on.""")
+tf.app.flags.DEFINE_integer('port', 2222,
+                            """Port of the first task, the others use the next ones.""")
+tf.app.flags.DEFINE_integer('max_restarts', 3,
+                            """Number of times a failed task is restarted.""")
+tf.app.flags.DEFINE_string('log_dir', './sm_cluster',
+                           """Directory where to write the output of the tasks.""")
+tf.app.flags.DEFINE_boolean('compare', False,
+                            """Whether to compare the cluster with single-process training.""")
+tf.app.flags.DEFINE_integer('budget_secs', 3600,
+                            """With --compare, longest training time of each run.""")
+tf.app.flags.DEFINE_integer('eval_interval_secs', 300,
+                            """With --compare, how often to evaluate the last checkpoint.""")
+tf.app.flags.DEFINE_integer('num_examples', 2048,
+                            """With --compare, number of eval examples per evaluation.""")
+tf.app.flags.DEFINE_float('target_accuracy', 0.9,
+                          """With --compare, accuracy of the time-to-accuracy.""")
+tf.app.flags.DEFINE_string('report', './sm_cluster.json',
+                           """With --compare, where to write the report.""")
+
+TRAINER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sm_train.py')
+EVALUATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sm_eval.py')
+
+
+class LocalCluster(object):
+    """Parameter servers and workers of sm_train.py, as local processes."""
+
+    def __init__(self, num_ps, num_workers, host, port, log_dir, max_restarts):
+        """
+        :param num_ps: number of parameter servers
+        :param num_workers: number of workers
+        :param host: host name or address the tasks listen on
+        :param port: port of the first task
+        :param log_dir: directory where to write the output of the tasks
+        :param max_restarts: number of times a failed task is restarted
+        """
+        addresses = ['%s:%d' % (host, port + i) for i in range(num_ps + num_workers)]
+        self.cluster = {'ps': addresses[:num_ps], 'worker': addresses[num_ps:]}
+        self.tasks = [(job, index) for job in ('ps', 'worker') for index in range(len(self.cluster[job]))]
+        self.log_dir = log_dir
+        self.max_restarts = max_restarts
+        self.processes = {}
+        self.restarts = dict((task, 0) for task in self.tasks)
+
+    def log_path(self, task):
+        return os.path.join(self.log_dir, '%s_%d.log' % task)
+
+    def _start(self, task, mode):
+        env = dict(os.environ)
+        env['TF_CONFIG'] = json.dumps({'cluster': self.cluster, 'task': {'type': task[0], 'index': task[1]}})
+        with open(self.log_path(task), mode) as log:
+            self.processes[task] = subprocess.Popen([sys.executable, TRAINER], env=env, stdout=log,
+                                                    stderr=subprocess.STDOUT)
+
+    def start(self):
+        """Starts every task."""
+        if not tf.gfile.Exists(self.log_dir):
+            tf.gfile.MakeDirs(self.log_dir)
+
+        for task in self.tasks:
+            self._start(task, 'w')
+        print('Started %d parameter server(s) and %d worker(s), logging to %s' %
+              (len(self.cluster['ps']), len(self.cluster['worker']), self.log_dir))
+
+    def poll(self):
+        """
+        Restarts the tasks which failed.
+
+        :return: whether every worker is done
+        """
+        for task in self.tasks:
+            return_code = self.processes[task].poll()
+            # The workers exit with 0 when they are done, the parameter servers never do.
+            if return_code is None or (task[0] == 'worker' and return_code == 0):
+                continue
+            if self.restarts[task] >= self.max_restarts:
+                self.stop()
+                raise RuntimeError('%s %d failed %d times, see %s' %
+                                   (task[0], task[1], self.restarts[task] + 1, self.log_path(task)))
+            self.restarts[task] += 1
+            print('%s %d exited with %d, restarting it (%d/%d)' %
+                  (task[0], task[1], return_code, self.restarts[task], self.max_restarts))
+            self._start(task, 'a')
+
+        return all(self.processes[('worker', index)].poll() == 0 for index in range(len(self.cluster['worker'])))
+
+    def stop(self):
+        """
+        Stops every task still running: the workers first, since the chief reads the variables from the
+        parameter servers to save its last checkpoint when it is stopped, then the parameter servers.
+        """
+        for job in ('worker', 'ps'):
+            processes = [process for task, process in self.processes.items() if task[0] == job]
+            for process in processes:
+                if process.poll() is None:
+                    process.terminate()
+            for process in processes:
+                process.wait()
+
+    def log_paths(self):
+        return [self.log_path(('worker', index)) for index in range(len(self.cluster['worker']))]
+
+
+class SingleProcess(object):
+    """Single-process training with sm_train.py, with the interface of LocalCluster."""
+
+    def __init__(self, log_dir):
+        self.log_dir = log_dir
+        self.restarts = {}
+        self.process = None
+
+    def start(self):
+        if not tf.gfile.Exists(self.log_dir):
+            tf.gfile.MakeDirs(self.log_dir)
+        env = dict(os.environ)
+        env.pop('TF_CONFIG', None)
+        with open(self.log_paths()[0], 'w') as log:
+            self.process = subprocess.Popen([sys.executable, TRAINER], env=env, stdout=log,
+                                            stderr=subprocess.STDOUT)
+
+    def poll(self):
+        return_code = self.process.poll()
+        if return_code not in (None, 0):
+            raise RuntimeError('Training failed, see ' + self.log_paths()[0])
+        return return_code == 0
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+        self.process.wait()
+
+    def log_paths(self):
+        return [os.path.join(self.log_dir, 'single.log')]
+
+
+def evaluate():
+    """
+    Evaluates the last checkpoint with sm_eval.py.
+
+    :return: the precision @ 1, or None if there is no checkpoint yet
+    """
+    output = subprocess.Popen([sys.executable, EVALUATOR, '--run_once', '--num_examples=%d' % FLAGS.num_examples,
+                               '--checkpoint_dir=' + sm.FLAGS.train_dir],
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT).communicate()[0]
+    match = re.search(r'precision @ 1 = ([0-9.]+)', output.decode('utf-8', 'replace'))
+
+    return float(match.group(1)) if match else None
+
+
+def throughput(log_paths):
+    """
+    :return: the training throughput in examples per second, summed over the trainers of the logs
+    """
+    total = 0.0
+    for path in log_paths:
+        with open(path) as f:
+            rates = [float(rate) for rate in re.findall(r'\(([0-9.]+) examples/sec', f.read())]
+        if rates:
+            total += np.mean(rates)
+
+    return total
+
+
+def supervise(run, fresh, budget_secs=None, eval_interval_secs=None):
+    """
+    Starts a training run and supervises it until it is done or out of time.
+
+    :param run: a LocalCluster or a SingleProcess
+    :param fresh: whether to train from scratch, in a new training directory, rather than resume
+    :param budget_secs: (optional) longest training time
+    :param eval_interval_secs: (optional) how often to evaluate the last checkpoint
+    :return: the training time, and the list of (time, accuracy) of the evaluations
+    """
+    start_time = time.time()
+    next_eval = start_time + eval_interval_secs if eval_interval_secs else None
+    accuracies = []
+    if fresh and tf.gfile.Exists(sm.FLAGS.train_dir):
+        tf.gfile.DeleteRecursively(sm.FLAGS.train_dir)
+    if not tf.gfile.Exists(sm.FLAGS.train_dir):
+        tf.gfile.MakeDirs(sm.FLAGS.train_dir)
+    run.start()
+    try:
+        while not run.poll():
+            if budget_secs and time.time() - start_time > budget_secs:
+                print('Out of time')
+                break
+            if next_eval is not None and time.time() >= next_eval:
+                accuracy = evaluate()
+                if accuracy is not None:
+                    accuracies.append((time.time() - start_time, accuracy))
+                    print('%.0f sec: accuracy %.4f' % accuracies[-1])
+                next_eval += eval_interval_secs
+            time.sleep(1)
+    finally:
+        run.stop()
+
+    elapsed = time.time() - start_time
+    if eval_interval_secs:
+        accuracy = evaluate()
+        if accuracy is not None:
+            accuracies.append((elapsed, accuracy))
+
+    return elapsed, accuracies
+
+
+def summarize(run, elapsed, accuracies):
+    """
+    :return: the report of a training run
+    """
+    reached = [t for t, accuracy in accuracies if accuracy >= FLAGS.target_accuracy]
+
+    return {
+        'training_sec': elapsed,
+        'examples_per_sec': throughput(run.log_paths()),
+        'accuracy': [{'sec': t, 'accuracy': accuracy} for t, accuracy in accuracies],
+        'final_accuracy': accuracies[-1][1] if accuracies else None,
+        'time_to_accuracy_sec': reached[0] if reached else None,
+        'restarts': sum(run.restarts.values()),
+    }
+
+
+def main(argv=None):  # pylint: disable=unused-argument
+    cluster = LocalCluster(FLAGS.num_ps, FLAGS.num_workers, FLAGS.host, FLAGS.port, FLAGS.log_dir,
+                           FLAGS.max_restarts)
+    if not FLAGS.compare:
+        elapsed, _ = supervise(cluster, fresh=not sm.FLAGS.RESTORE)
+        print('Finished in %.0f sec, %.1f examples/sec' % (elapsed, throughput(cluster.log_paths())))
+        return
+
+    report = {
+        'num_ps': FLAGS.num_ps,
+        'num_workers': FLAGS.num_workers,
+        'target_accuracy': FLAGS.target_accuracy,
+    }
+    print('Single-process training...')
+    single = SingleProcess(FLAGS.log_dir)
+    report['single'] = summarize(single, *supervise(single, True, FLAGS.budget_secs, FLAGS.eval_interval_secs))
+    print('Asynchronous training with %d parameter server(s) and %d worker(s)...' % (FLAGS.num_ps, FLAGS.num_workers))
+    report['cluster'] = summarize(cluster, *supervise(cluster, True, FLAGS.budget_secs, FLAGS.eval_interval_secs))
+
+    with open(FLAGS.report, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    def format_time(t):
+        return 'not reached' if t is None else '%.0f sec' % t
+
+    print('%-8s %14s %14s %20s' % ('run', 'examples/sec', 'final acc.', 'time to %.3f' % FLAGS.target_accuracy))
+    for name in ('single', 'cluster'):
+        run = report[name]
+        print('%-8s %14.1f %14s %20s' % (name, run['examples_per_sec'],
+                                         '-' if run['final_accuracy'] is None else '%.4f' % run['final_accuracy'],
+                                         format_time(run['time_to_accuracy_sec'])))
+    print('Wrote ' + FLAGS.report)
+
+
+if __name__ == '__main__':
+    tf.app.run()
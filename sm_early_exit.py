@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Calibration and evaluation of the early exit of version 1 (FLAGS.EARLY_EXIT).
+
+1. The model is run without exits on a calibration slice of the eval set, recording the early exit
+   and the full predictions of every pair.
+2. The threshold is the lowest confidence at which taking the early exit costs at most
+   --max_accuracy_drop of accuracy on the calibration slice.
+3. On another slice, the report gives the exit rate, the accuracy with and without exits, the
+   average FLOPs per pair saved (from the layer costs of sm.LAYER_COSTS), and the latency of a batch
+   with and without exits.
+
+Set EARLY_EXIT_THRESHOLD in FLAGS.py to the printed threshold to use it.
+
+Usage:
+    python sm_early_exit.py --checkpoint_dir=./MSHAPES_train --max_accuracy_drop=0.002
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+
+import sm
+import sm_input
+from utils import time_runs
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_string('checkpoint_dir', './MSHAPES_train',
+                           """Directory where to read model checkpoints.""")
+tf.app.flags.DEFINE_float('max_accuracy_drop', 0.002,
+                          """Largest accuracy loss allowed on the calibration pairs.""")
+tf.app.flags.DEFINE_integer('num_calibration', 2048,
+                            """Number of eval pairs used to calibrate the threshold.""")
+tf.app.flags.DEFINE_integer('num_examples', 2048,
+                            """Number of eval pairs used for the report.""")
+tf.app.flags.DEFINE_integer('num_runs', 20,
+                            """Number of timed runs for the latency.""")
+tf.app.flags.DEFINE_string('report', './sm_early_exit.json',
+                           """Where to write the report.""")
+
+# Variable scopes of the layers which the examples taking the early exit skip.
+SKIPPED_LAYERS = ('input/input_L/conv2', 'input/input_K/conv2', 'FC1', 'FC2', 'softmax_linear')
+
+
+def predictions(sess, images, logits, exit_logits, locks, keys):
+    """
+    :return: the full and the early exit probabilities of the pairs, each of shape [num_pairs, NUM_CLASSES]
+    """
+    full, early = [], []
+    for batch in sm_input.pair_batches(locks, keys, sm.FLAGS.batch_size):
+        full_logits, early_logits = sess.run([logits, exit_logits], feed_dict={images: batch})
+        full.append(full_logits)
+        early.append(early_logits)
+
+    def softmax(x):
+        e = np.exp(x - x.max(axis=1, keepdims=True))
+        return e / e.sum(axis=1, keepdims=True)
+
+    return softmax(np.concatenate(full)), softmax(np.concatenate(early))
+
+
+def routed_accuracy(full, early, labels, threshold):
+    """
+    :return: the accuracy and the exit rate of the pairs when the early exit is taken at a threshold
+    """
+    exits = early.max(axis=1) >= threshold
+    predicted = np.where(exits, early.argmax(axis=1), full.argmax(axis=1)) == 1
+
+    return np.mean(predicted == labels), np.mean(exits)
+
+
+def calibrate(full, early, labels, max_accuracy_drop):
+    """
+    :return: the lowest threshold at which the accuracy drops by at most max_accuracy_drop
+    """
+    full_accuracy = np.mean((full.argmax(axis=1) == 1) == labels)
+    for threshold in np.sort(np.unique(early.max(axis=1))):
+        accuracy, _ = routed_accuracy(full, early, labels, threshold)
+        if accuracy >= full_accuracy - max_accuracy_drop:
+            return float(threshold)
+
+    return 1.0
+
+
+def build(threshold):
+    """
+    Builds the model with an early exit threshold in the default graph.
+
+    :return: the input placeholder, the logits, the early exit logits, and the FLOPs per pair of
+        all the layers and of the layers skipped by the early exit
+    """
+    sm.FLAGS.EARLY_EXIT_THRESHOLD = threshold
+    images = sm.placeholder_inputs()
+    logits = sm.inference(images)
+    exit_logits = tf.get_collection(sm.EARLY_EXIT_LOGITS)[0]
+
+    costs = tf.get_collection(sm.LAYER_COSTS)
+    total_flops = sum(cost[1] for cost in costs)
+    skipped_flops = sum(cost[1] for cost in costs if cost[0] in SKIPPED_LAYERS)
+
+    return images, logits, exit_logits, total_flops, skipped_flops
+
+
+def main(argv=None):  # pylint: disable=unused-argument
+    if not sm.FLAGS.EARLY_EXIT:
+        raise ValueError('The model has no early exit, set EARLY_EXIT = True in FLAGS.py')
+    ckpt = tf.train.get_checkpoint_state(FLAGS.checkpoint_dir)
+    if not (ckpt and ckpt.model_checkpoint_path):
+        raise ValueError('No checkpoint file found in ' + FLAGS.checkpoint_dir)
+
+    print('Loading eval pairs...')
+    data_dir = os.path.join(sm.FLAGS.data_dir, '')
+    calibration_locks, calibration_keys, calibration_labels = sm_input.eval_pairs(data_dir, 0, FLAGS.num_calibration)
+    locks, keys, labels = sm_input.eval_pairs(data_dir, FLAGS.num_calibration, FLAGS.num_examples)
+    print('Done.')
+
+    # A threshold above 1 disables the exits: every example goes through the whole model.
+    with tf.Graph().as_default():
+        images, logits, exit_logits, total_flops, skipped_flops = build(2.0)
+        with tf.Session() as sess:
+            tf.train.Saver().restore(sess, ckpt.model_checkpoint_path)
+            full, early = predictions(sess, images, logits, exit_logits, calibration_locks, calibration_keys)
+            threshold = calibrate(full, early, calibration_labels, FLAGS.max_accuracy_drop)
+
+            full, early = predictions(sess, images, logits, exit_logits, locks, keys)
+            batch = next(sm_input.pair_batches(locks, keys, sm.FLAGS.batch_size))
+            full_latency = np.median(time_runs(sess, logits, {images: batch}, FLAGS.num_runs))
+
+    with tf.Graph().as_default():
+        images, logits, _, _, _ = build(threshold)
+        with tf.Session() as sess:
+            tf.train.Saver().restore(sess, ckpt.model_checkpoint_path)
+            exit_latency = np.median(time_runs(sess, logits, {images: batch}, FLAGS.num_runs))
+
+    full_accuracy = np.mean((full.argmax(axis=1) == 1) == labels)
+    accuracy, exit_rate = routed_accuracy(full, early, labels, threshold)
+    flops_saved = exit_rate * skipped_flops
+
+    report = {
+        'threshold': threshold,
+        'num_examples': int(labels.size),
+        'exit_rate': float(exit_rate),
+        'accuracy_without_exits': float(full_accuracy),
+        'accuracy': float(accuracy),
+        'accuracy_delta': float(accuracy - full_accuracy),
+        'early_exit_accuracy': float(np.mean((early.argmax(axis=1) == 1) == labels)),
+        'mflops_per_pair_without_exits': total_flops / 1e6,
+        'mflops_per_pair_saved': flops_saved / 1e6,
+        'compute_saved': flops_saved / total_flops,
+        'batch_size': sm.FLAGS.batch_size,
+        'latency_ms_without_exits': 1e3 * full_latency,
+        'latency_ms': 1e3 * exit_latency,
+        'speedup': full_latency / exit_latency,
+    }
+
+    print('threshold = %.4f: %.1f%% of the pairs exit early' % (threshold, 100 * exit_rate))
+    print('accuracy = %.4f (%+.4f), %.2f of %.2f MFLOPs/pair saved (%.1f%%)' %
+          (accuracy, accuracy - full_accuracy, flops_saved / 1e6, total_flops / 1e6, 100 * report['compute_saved']))
+    print('%.2f ms/batch, x%.2f' % (1e3 * exit_latency, report['speedup']))
+    print('Set EARLY_EXIT_THRESHOLD = %.4f in FLAGS.py to use it.' % threshold)
+
+    with open(FLAGS.report, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    tf.app.run()
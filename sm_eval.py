@@ -41,7 +41,9 @@ import time
 import numpy as np
 import tensorflow as tf
 
+import graph_cache
 import sm
+import thread_config
 
 FLAGS = tf.app.flags.FLAGS
 
@@ -70,7 +72,7 @@ def eval_once(saver, summary_writer, top_k_op, summary_op):
     top_k_op: Top K op.
     summary_op: Summary op.
   """
-  with tf.Session() as sess:
+  with tf.Session(config=thread_config.session_config('inference')) as sess:
     ckpt = tf.train.get_checkpoint_state(FLAGS.checkpoint_dir)
     print("checkpoint dir =", ckpt.model_checkpoint_path)
     if ckpt and ckpt.model_checkpoint_path:
@@ -117,29 +119,42 @@ def eval_once(saver, summary_writer, top_k_op, summary_op):
     coord.join(threads)#, stop_grace_period_secs=10)
 
 
-def evaluate():
-  """Eval MSHAPES for a number of steps."""
-  with tf.Graph().as_default() as g:
-    # Get images and labels for CIFAR-10.
-    eval_data = FLAGS.eval_data == 'test'
-    images, labels = sm.inputs(eval_data=True)
+def build_eval_graph():
+  """Builds the eval graph in the default graph, see graph_cache.load_or_build().
+
+  Returns:
+    The top k op and the summary op by name, and the saver of the model.
+  """
+  # Get images and labels for CIFAR-10.
+  eval_data = FLAGS.eval_data == 'test'
+  images, labels = sm.inputs(eval_data=True)
+
+  # Build a Graph that computes the logits predictions from the
+  # inference model.
+  logits = sm.inference(images, eval=True)
 
-    # Build a Graph that computes the logits predictions from the
-    # inference model.
-    logits = sm.inference(images, eval=True)
+  # Calculate predictions.
+  top_k_op = tf.nn.in_top_k(logits, labels, 1)
 
-    # Calculate predictions.
-    top_k_op = tf.nn.in_top_k(logits, labels, 1)
+  # Restore the moving average version of the learned variables for eval.
+  # variable_averages = tf.train.ExponentialMovingAverage(
+  #     sm.MOVING_AVERAGE_DECAY)
+  # variables_to_restore = variable_averages.variables_to_restore()
+  # saver = tf.train.Saver(variables_to_restore)
+  saver = tf.train.Saver()
 
-    # Restore the moving average version of the learned variables for eval.
-    # variable_averages = tf.train.ExponentialMovingAverage(
-    #     sm.MOVING_AVERAGE_DECAY)
-    # variables_to_restore = variable_averages.variables_to_restore()
-    # saver = tf.train.Saver(variables_to_restore)
-    saver = tf.train.Saver()
+  # Build the summary operation based on the TF collection of Summaries.
+  summary_op = tf.summary.merge_all()
 
-    # Build the summary operation based on the TF collection of Summaries.
-    summary_op = tf.summary.merge_all()
+  return {'top_k_op': top_k_op, 'summary_op': summary_op}, [saver]
+
+
+def evaluate():
+  """Eval MSHAPES for a number of steps."""
+  with tf.Graph().as_default() as g:
+    fetches, savers = graph_cache.load_or_build('eval', build_eval_graph)
+    top_k_op, summary_op = fetches['top_k_op'], fetches['summary_op']
+    saver = savers[0]
 
     summary_writer = tf.summary.FileWriter(FLAGS.eval_dir, g)
 
@@ -151,6 +166,7 @@ def evaluate():
 
 
 def main(argv=None):  # pylint: disable=unused-argument
+  thread_config.apply_affinity('inference')
   if tf.gfile.Exists(FLAGS.eval_dir):
     tf.gfile.DeleteRecursively(FLAGS.eval_dir)
   tf.gfile.MakeDirs(FLAGS.eval_dir)
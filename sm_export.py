@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Export of a trained model as a frozen, pruned and constant-folded inference graph.
+
+The graph is built on a placeholder input (sm.placeholder_inputs()), so it has no input queue
+and no queue runners. The variables are restored and turned into constants, everything which
+does not lead to the outputs (summaries, and the training ops which are never built here) is
+pruned, and the graph is constant-folded with the graph transform tool when available. With
+FLAGS.NORMALIZATION == 'batch_norm', the batch normalizations are first folded into the
+convolutions, so the exported graph is pure conv+relu+pool.
+
+The exported graph has one input, 'images' of shape [batch_size, IMAGE_SIZE, IMAGE_SIZE, 6]
+with a dynamic batch size, and two outputs, 'logits' and 'probabilities'. Load it with
+sm_frozen.FrozenScorer, which does not need this repository's model code. With --weights_output,
+the weights are also written for the NumPy engine (sm_numpy.py), which does not need TensorFlow.
+
+Usage:
+    python sm_export.py --checkpoint_dir=./MSHAPES_train --output=./MSHAPES_export/frozen.pb
+    python sm_export.py --weights_output=./MSHAPES_export/weights.npz --check_numpy_parity
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import sm
+import sm_numpy
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_string('checkpoint_dir', './MSHAPES_train',
+                           """Directory where to read model checkpoints.""")
+tf.app.flags.DEFINE_string('output', './MSHAPES_export/frozen.pb',
+                           """Where to write the frozen graph.""")
+tf.app.flags.DEFINE_boolean('check_cold_start', True,
+                            """Whether to time the loading of the exported graph in a new process.""")
+tf.app.flags.DEFINE_string('weights_output', '',
+                           """If set, where to also write the weights for the NumPy engine (sm_numpy.py).""")
+tf.app.flags.DEFINE_boolean('check_numpy_parity', False,
+                            """Whether to check that the NumPy engine reproduces the TensorFlow graph.""")
+
+INPUT_NAME = 'images'
+OUTPUT_NAMES = ['logits', 'probabilities']
+
+
+def build_inference_graph():
+    """
+    Builds the inference model on a placeholder input in the default graph.
+
+    :return: the input placeholder and the output tensors
+    """
+    images = sm.placeholder_inputs()
+    logits = tf.identity(sm.inference(images), name=OUTPUT_NAMES[0])
+    probabilities = tf.nn.softmax(logits, name=OUTPUT_NAMES[1])
+
+    return images, [logits, probabilities]
+
+
+def fold_constants(graph_def):
+    """
+    Constant-folds a frozen graph with the graph transform tool. Without the tool, the graph is
+    returned as is; TensorFlow then folds the constants when the graph is first run.
+
+    :param graph_def: frozen GraphDef
+    :return: the transformed GraphDef
+    """
+    try:
+        from tensorflow.tools.graph_transforms import TransformGraph
+    except ImportError:
+        print('Graph transform tool not available, constants will not be folded at export')
+        return graph_def
+
+    transforms = ['remove_nodes(op=Identity, op=CheckNumerics)',
+                  'fold_constants(ignore_errors=true)',
+                  'strip_unused_nodes',
+                  'sort_by_execution_order']
+
+    return TransformGraph(graph_def, [INPUT_NAME], OUTPUT_NAMES, transforms)
+
+
+def check_numpy_parity(sess, images, logits, weights, num_examples=16, tolerance=1e-4):
+    """
+    Checks that the NumPy engine gives the same logits as the TensorFlow graph on random examples.
+
+    :param sess: session holding the restored model
+    :param images: the input placeholder
+    :param logits: the logits of the graph
+    :param weights: the weights given to the NumPy engine
+    :param num_examples: number of random examples
+    :param tolerance: largest difference allowed, relative to the largest logit
+    :raises: Exception if the logits differ
+    """
+    examples = np.random.uniform(0, 255, [num_examples, sm.IMAGE_SIZE, sm.IMAGE_SIZE, 6]).astype(np.float32)
+    expected = sess.run(logits, feed_dict={images: examples})
+    actual = sm_numpy.NumpyModel(weights, sm.FLAGS.model_version, sm.FLAGS.NORMALIZATION,
+                                 sm.FLAGS.TOWER).logits(examples)
+
+    difference = np.abs(actual - expected).max() / max(np.abs(expected).max(), 1.0)
+    print('NumPy engine vs TensorFlow: largest relative difference of the logits = %.2e' % difference)
+    if difference > tolerance:
+        raise Exception('The NumPy engine does not reproduce the TensorFlow graph (%.2e > %.2e)' %
+                        (difference, tolerance))
+
+
+def fold_batch_norms(values):
+    """
+    Folds the batch normalizations which follow convolutions (FLAGS.NORMALIZATION == 'batch_norm')
+    into the convolutions' weights and biases, so that the inference graph is pure conv+relu+pool.
+
+    :param values: dictionary from variable names to values
+    :return: a new dictionary, with the folded weights and biases and without the batch normalizations
+    """
+    folded = dict((name, value) for name, value in values.items() if '/batch_norm/' not in name)
+    for name in values:
+        if not name.endswith('/batch_norm/gamma'):
+            continue
+        scope = name[:-len('/batch_norm/gamma')]
+        scale = values[name] / np.sqrt(values[scope + '/batch_norm/moving_variance'] + sm.BATCH_NORM_EPSILON)
+        folded[scope + '/weights'] = values[scope + '/weights'] * scale
+        folded[scope + '/biases'] = ((values[scope + '/biases'] - values[scope + '/batch_norm/moving_mean']) * scale +
+                                     values[scope + '/batch_norm/beta'])
+
+    return folded
+
+
+def export(checkpoint_path, output, weights_output='', numpy_parity=False):
+    """
+    Writes the frozen inference graph of a checkpoint.
+
+    :param checkpoint_path: path of the checkpoint to export
+    :param output: path of the .pb file to write
+    :param weights_output: (optional) path of the .npz file to write the weights to, for sm_numpy.py
+    :param numpy_parity: (optional) whether to check that the NumPy engine reproduces the graph
+    """
+    for path in [output, weights_output]:
+        directory = os.path.dirname(path)
+        if directory and not tf.gfile.Exists(directory):
+            tf.gfile.MakeDirs(directory)
+
+    with tf.Graph().as_default():
+        build_inference_graph()
+        with tf.Session() as sess:
+            tf.train.Saver().restore(sess, checkpoint_path)
+            values = dict((v.op.name, sess.run(v)) for v in tf.global_variables())
+
+    if sm.FLAGS.NORMALIZATION == 'batch_norm':
+        values = fold_batch_norms(values)
+        sm.FLAGS.FOLD_BATCH_NORM = True
+
+    with tf.Graph().as_default() as g:
+        images, outputs = build_inference_graph()
+
+        with tf.Session() as sess:
+            for var in tf.global_variables():
+                var.load(values[var.op.name], sess)
+            graph_def = tf.graph_util.convert_variables_to_constants(sess, g.as_graph_def(), OUTPUT_NAMES)
+
+            weights = dict((v.op.name, values[v.op.name]) for v in tf.trainable_variables())
+            if numpy_parity:
+                check_numpy_parity(sess, images, outputs[0], weights)
+            if weights_output:
+                np.savez(weights_output, model_version=sm.FLAGS.model_version,
+                         normalization=sm.FLAGS.NORMALIZATION, tower=sm.FLAGS.TOWER, **weights)
+                print('Wrote %s' % weights_output)
+
+    num_nodes = len(g.as_graph_def().node)
+    num_frozen_nodes = len(graph_def.node)
+    graph_def = fold_constants(graph_def)
+    print('%d nodes in the graph, %d after freezing and pruning, %d after folding' %
+          (num_nodes, num_frozen_nodes, len(graph_def.node)))
+
+    with tf.gfile.GFile(output, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    print('Wrote %s (%.1f MB)' % (output, os.path.getsize(output) / 2.0 ** 20))
+
+
+def main(argv=None):  # pylint: disable=unused-argument
+    ckpt = tf.train.get_checkpoint_state(FLAGS.checkpoint_dir)
+    if not (ckpt and ckpt.model_checkpoint_path):
+        raise ValueError('No checkpoint file found in ' + FLAGS.checkpoint_dir)
+
+    export(ckpt.model_checkpoint_path, FLAGS.output, FLAGS.weights_output, FLAGS.check_numpy_parity)
+
+    if FLAGS.check_cold_start:
+        start_time = time.time()
+        subprocess.check_call([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                            'sm_frozen.py'),
+                               '--graph=' + FLAGS.output])
+        print('Process start to first prediction: %.3f sec' % (time.time() - start_time))
+
+
+if __name__ == '__main__':
+    tf.app.run()
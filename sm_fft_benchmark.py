@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Micro-benchmark of direct against FFT convolutions (sm._fft_conv2d) across kernel sizes.
+
+Both are run on the same random inputs and kernels, with the shapes of the canonical convolution of
+version 2 by default (3 to 8 channels on IMAGE_SIZE x IMAGE_SIZE inputs, 'VALID' padding), checked
+to agree, and timed. The crossover is the smallest kernel size from which the FFT is faster for
+every larger size; set FFT_MIN_KERNEL_SIZE in FLAGS.py to it (by default, 0, every convolution is
+direct).
+
+Usage:
+    python sm_fft_benchmark.py --kernel_sizes=3,5,7,9,11,15,19,23,27 --out=./sm_fft_benchmark.csv
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import tensorflow as tf
+
+import sm
+from utils import time_runs
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_string('kernel_sizes', '3,5,7,9,11,15,19,23,27',
+                           """Comma separated list of kernel sizes to measure.""")
+tf.app.flags.DEFINE_integer('batch_size', 128,
+                            """Number of images per batch.""")
+tf.app.flags.DEFINE_integer('in_channels', 3,
+                            """Number of input channels.""")
+tf.app.flags.DEFINE_integer('out_channels', 8,
+                            """Number of output channels.""")
+tf.app.flags.DEFINE_string('padding', 'VALID',
+                           """'SAME' or 'VALID'.""")
+tf.app.flags.DEFINE_integer('num_runs', 20,
+                            """Number of timed runs per kernel size and method.""")
+tf.app.flags.DEFINE_string('out', './sm_fft_benchmark.csv',
+                           """Where to write the results.""")
+
+
+def measure(kernel_size):
+    """
+    Times both methods at one kernel size.
+
+    :param kernel_size: width and height of the kernel
+    :return: median latency of the direct and of the FFT convolution in seconds, and their largest
+        difference relative to the largest output
+    """
+    with tf.Graph().as_default():
+        inputs = tf.Variable(tf.random_uniform([FLAGS.batch_size, sm.IMAGE_SIZE, sm.IMAGE_SIZE, FLAGS.in_channels]))
+        kernel = tf.Variable(tf.truncated_normal([kernel_size, kernel_size, FLAGS.in_channels, FLAGS.out_channels],
+                                                 stddev=5e-2))
+        direct = tf.nn.conv2d(inputs, kernel, [1, 1, 1, 1], padding=FLAGS.padding)
+        fft = sm._fft_conv2d(inputs, kernel, FLAGS.padding)
+
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            direct_value, fft_value = sess.run([direct, fft])
+            difference = np.abs(direct_value - fft_value).max() / np.abs(direct_value).max()
+
+            direct_latency = np.median(time_runs(sess, direct.op, num_runs=FLAGS.num_runs))
+            fft_latency = np.median(time_runs(sess, fft.op, num_runs=FLAGS.num_runs))
+
+    return direct_latency, fft_latency, difference
+
+
+def main(argv=None):  # pylint: disable=unused-argument
+    kernel_sizes = [int(k) for k in FLAGS.kernel_sizes.split(',')]
+
+    results = []
+    with open(FLAGS.out, 'w') as f:
+        f.write('kernel_size,direct_ms,fft_ms,speedup,relative_difference\n')
+        for kernel_size in kernel_sizes:
+            direct_latency, fft_latency, difference = measure(kernel_size)
+            results.append((kernel_size, fft_latency < direct_latency))
+            print('%dx%d: direct %.2f ms, FFT %.2f ms (x%.2f), relative difference %.1e' %
+                  (kernel_size, kernel_size, 1e3 * direct_latency, 1e3 * fft_latency,
+                   direct_latency / fft_latency, difference))
+            f.write('%d,%.3f,%.3f,%.3f,%.2e\n' % (kernel_size, 1e3 * direct_latency, 1e3 * fft_latency,
+                                                 direct_latency / fft_latency, difference))
+
+    crossover = None
+    for kernel_size, fft_faster in reversed(results):
+        if not fft_faster:
+            break
+        crossover = kernel_size
+    if crossover is None:
+        print('The FFT is not faster at the largest kernel size')
+    else:
+        print('The FFT is faster from %dx%d kernels: set FFT_MIN_KERNEL_SIZE = %d in FLAGS.py' %
+              (crossover, crossover, crossover))
+
+
+if __name__ == '__main__':
+    tf.app.run()
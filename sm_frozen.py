@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Loader for the frozen inference graphs written by sm_export.py.
+
+It only needs TensorFlow: no model code is imported, no graph is built, and no variables are
+restored, so a scoring process starts quickly. Run directly, it loads a graph, scores one example
+and prints where the start-up time went.
+
+Usage:
+    python sm_frozen.py --graph=./MSHAPES_export/frozen.pb
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+
+_start_time = time.time()
+
+import numpy as np
+import tensorflow as tf
+
+from graph_cache import import_contrib_ops
+
+_import_time = time.time()
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_string('graph', './MSHAPES_export/frozen.pb',
+                           """Path of the frozen graph to load.""")
+
+
+class FrozenScorer(object):
+    """Scores lock/key pairs with a frozen inference graph."""
+
+    def __init__(self, graph_path, config=None):
+        """
+        Loads a frozen graph and opens a session on it.
+
+        :param graph_path: path of the .pb file written by sm_export.py
+        :param config: (optional) tf.ConfigProto of the session
+        """
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(graph_path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+
+        import_contrib_ops(graph_def)
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        self.images = self.graph.get_tensor_by_name('images:0')
+        self.logits = self.graph.get_tensor_by_name('logits:0')
+        self.probabilities = self.graph.get_tensor_by_name('probabilities:0')
+        self.session = tf.Session(graph=self.graph, config=config)
+
+    @property
+    def input_shape(self):
+        """Shape of one example, [IMAGE_SIZE, IMAGE_SIZE, 6]."""
+        return self.images.get_shape().as_list()[1:]
+
+    def match_probability(self, examples):
+        """
+        Scores a batch of examples.
+
+        :param examples: array of shape [batch_size, IMAGE_SIZE, IMAGE_SIZE, 6], lock then key channels
+        :return: the probability of every pair to match, shape [batch_size]
+        """
+        return self.session.run(self.probabilities, feed_dict={self.images: examples})[:, 1]
+
+    def close(self):
+        self.session.close()
+
+
+def main(argv=None):  # pylint: disable=unused-argument
+    load_start = time.time()
+    scorer = FrozenScorer(FLAGS.graph)
+    load_end = time.time()
+    scorer.match_probability(np.zeros([1] + scorer.input_shape, dtype=np.float32))
+    first_prediction = time.time()
+
+    print('import: %.3f sec, load: %.3f sec, first prediction: %.3f sec, total: %.3f sec' %
+          (_import_time - _start_time, load_end - load_start, first_prediction - load_end,
+           first_prediction - _start_time))
+    scorer.close()
+
+
+if __name__ == '__main__':
+    tf.app.run()
@@ -14,8 +14,9 @@ import numpy as np
 from six.moves import xrange  # pylint: disable=redefined-builtin
 import tensorflow as tf
 
-from utils import print_progress_bar
+from utils import load_images, print_progress_bar
 import FLAGS
+import thread_config
 
 
 IMAGE_SIZE = FLAGS.IMAGE_SIZE
@@ -23,6 +24,13 @@ NUM_CLASSES = FLAGS.NUM_CLASSES
 NUM_EXAMPLES_PER_EPOCH_FOR_TRAIN = FLAGS.NUM_EXAMPLES_PER_EPOCH_FOR_TRAIN
 NUM_EXAMPLES_PER_EPOCH_FOR_EVAL = FLAGS.NUM_EXAMPLES_PER_EPOCH_FOR_EVAL
 
+# Number of threads preparing the examples, unless FLAGS.THREAD_CONFIG sets their input_threads.
+NUM_PREPROCESS_THREADS = 16
+# Number of batches the deterministic input pipeline prepares ahead of the training.
+NUM_PREFETCH_BATCHES = 4
+# Number of rounds of the Feistel networks which shuffle the deterministic input pipeline.
+FEISTEL_ROUNDS = 6
+
 
 def read_input_correct(filename_queue):
     """
@@ -78,29 +86,25 @@ def decode_input(file_path):
 
 
 
-def inputs(eval_data, data_dir, batch_size):
+def example_files(eval_data, data_dir):
     """
-    Constructs the input for MSHAPES.
+    Lists the files of the MSHAPES training or evaluation set.
 
     :param eval_data: boolean, indicating if we should use the training or the evaluation data set
     :param data_dir: Path to the MSHAPES data directory
-    :param batch_size: Number of images per batch
 
     :return:
-        images: Images. 4D tensor of [batch_size, IMAGE_SIZE, IMAGE_SIZE, 6] size
-        labels: Labels. 1D tensor of [batch_size] size.
+        lock_files: the lock halves
+        key_files_good: the keys matching lock_files
+        key_files_bad: keys which do not match lock_files
     """
-
     if not eval_data:
         index_beg = 1
         index_end = 2 * NUM_EXAMPLES_PER_EPOCH_FOR_TRAIN  # TODO: First of all, this should go to (at least) 30k.
-        num_examples_per_epoch = NUM_EXAMPLES_PER_EPOCH_FOR_TRAIN
     else:
         index_beg = 2 * NUM_EXAMPLES_PER_EPOCH_FOR_TRAIN + 1
         index_end = 2 * NUM_EXAMPLES_PER_EPOCH_FOR_TRAIN + 1 + 2 * NUM_EXAMPLES_PER_EPOCH_FOR_EVAL
-        num_examples_per_epoch = NUM_EXAMPLES_PER_EPOCH_FOR_EVAL
 
-    print('Enqueuing file names...')
     lock_files = [os.path.join(data_dir, 'images/%d_L.png' % i)
                   for i in xrange(index_beg, index_end, 2)]
     key_files_good = [os.path.join(data_dir, 'images/%d_K.png' % i)
@@ -108,10 +112,87 @@ def inputs(eval_data, data_dir, batch_size):
     key_files_bad = [os.path.join(data_dir, 'images/%d_K.png' % (i + 1))
                      for i in xrange(index_beg, index_end, 2)]
 
-    for q in [lock_files, key_files_good, key_files_bad]:
-        for f in q:
-            if not tf.gfile.Exists(f):
-                raise ValueError('Failed to find file: ' + f)
+    return lock_files, key_files_good, key_files_bad
+
+
+
+def eval_pairs(data_dir, begin, num):
+    """
+    Loads pairs of the evaluation set into memory, half of them matching and half of them not.
+
+    :param data_dir: Path to the MSHAPES data directory
+    :param begin: index of the first evaluation lock to use
+    :param num: number of pairs
+
+    :return:
+        locks: lock halves, uint8 array of shape [num, IMAGE_SIZE, IMAGE_SIZE, 3]
+        keys: key halves, same shape
+        labels: whether each pair matches, boolean array of shape [num]
+    """
+    lock_files, key_files_good, key_files_bad = example_files(True, data_dir)
+    lock_files = lock_files[begin:begin + num]
+    key_files = [good if i % 2 == 0 else bad
+                 for i, (good, bad) in enumerate(zip(key_files_good[begin:begin + num],
+                                                     key_files_bad[begin:begin + num]))]
+    labels = np.arange(len(lock_files)) % 2 == 0
+
+    return load_images(lock_files), load_images(key_files), labels
+
+
+
+def pair_batches(locks, keys, batch_size):
+    """
+    Iterates over 6-channel float batches of aligned pairs, as fed to sm.placeholder_inputs().
+
+    :param locks: lock halves, shape [num_pairs, IMAGE_SIZE, IMAGE_SIZE, 3]
+    :param keys: key halves, shape [num_pairs, IMAGE_SIZE, IMAGE_SIZE, 3]
+    :param batch_size: number of pairs per batch (the last one may be smaller)
+    """
+    for begin in xrange(0, len(locks), batch_size):
+        end = begin + batch_size
+        yield np.concatenate([locks[begin:end], keys[begin:end]], axis=3).astype(np.float32)
+
+
+
+def inputs(eval_data, data_dir, batch_size, shard=0, num_shards=1):
+    """
+    Constructs the input for MSHAPES.
+
+    :param eval_data: boolean, indicating if we should use the training or the evaluation data set
+    :param data_dir: Path to the MSHAPES data directory
+    :param batch_size: Number of images per batch
+    :param shard: (optional) index of the shard of the data set to read
+    :param num_shards: (optional) number of disjoint shards the data set is split into
+
+    :return:
+        images: Images. 4D tensor of [batch_size, IMAGE_SIZE, IMAGE_SIZE, 6] size
+        labels: Labels. 1D tensor of [batch_size] size.
+    """
+    return input_pipeline(eval_data, data_dir, batch_size, shard, num_shards)()
+
+
+def input_pipeline(eval_data, data_dir, batch_size, shard=0, num_shards=1):
+    """
+    Constructs the input pipeline for MSHAPES, see inputs().
+
+    :param eval_data: boolean, indicating if we should use the training or the evaluation data set
+    :param data_dir: Path to the MSHAPES data directory
+    :param batch_size: Number of images per batch
+    :param shard: (optional) index of the shard of the data set to read
+    :param num_shards: (optional) number of disjoint shards the data set is split into
+
+    :return: a function which dequeues a batch and returns its images and labels, as inputs(). Every
+        call builds new dequeue ops, e.g. in the body of a tf.while_loop.
+    """
+
+    if not eval_data and FLAGS.DETERMINISTIC_INPUT:
+        return deterministic_input_pipeline(data_dir, batch_size, shard, num_shards)
+
+    print('Enqueuing file names...')
+    lock_files, key_files_good, key_files_bad = [files[shard::num_shards]
+                                                 for files in example_files(eval_data, data_dir)]
+    num_examples_per_epoch = len(lock_files)
+    _check_files_exist([lock_files, key_files_good, key_files_bad])
 
     good_pairs_queue = tf.train.slice_input_producer([lock_files, key_files_good],
                                                      num_epochs=None, shuffle=True)
@@ -144,46 +225,178 @@ def inputs(eval_data, data_dir, batch_size):
                      tf.greater(correct_or_incorrect, fraction_of_correct): lambda:incorrect_label},
                     default=lambda:tf.constant(1), exclusive=True)
 
-    return _generate_image_and_label_batch(image, label, min_queue_examples, batch_size,shuffle=True)
+    return _generate_image_and_label_batch(image, label, min_queue_examples, batch_size,shuffle=True,
+                                           num_threads=_input_threads(eval_data))
+
+
+def deterministic_input_pipeline(data_dir, batch_size, shard=0, num_shards=1):
+    """
+    Constructs the training input pipeline for MSHAPES in a reproducible order, which resumes where it
+    stopped.
+
+    The n-th example of a shard only depends on the seed and on n: in epoch n // N, it is the lock at
+    n % N in a permutation of the N locks of the shard, with its key or with the key at the same
+    place in another permutation, whichever its label says. The pipeline starts from the position of
+    the shard in the input_positions variable, which the train op advances by the batches it consumes
+    (UPDATE_OPS): the position, hence the epoch, and the seed (input_seed) are saved with the
+    checkpoints, so that a restored run goes on with the next example it would have trained on.
+
+    The examples of a batch are decoded in parallel, and the batches are prepared one at a time,
+    ahead of the training, to keep their order.
+
+    :param data_dir: Path to the MSHAPES data directory
+    :param batch_size: Number of images per batch
+    :param shard: (optional) index of the shard of the data set to read
+    :param num_shards: (optional) number of disjoint shards the data set is split into
+
+    :return: a function which dequeues a batch and returns its images and labels, see input_pipeline().
+        Every batch it dequeues adds the update of the position to UPDATE_OPS.
+    """
+    lock_files, key_files_good, key_files_bad = [files[shard::num_shards]
+                                                 for files in example_files(False, data_dir)]
+    num_examples = len(lock_files)
+    _check_files_exist([lock_files, key_files_good, key_files_bad])
+
+    seed = tf.get_variable('input_seed', [], tf.int64, initializer=tf.constant_initializer(FLAGS.INPUT_SEED),
+                           trainable=False)
+    positions = tf.get_variable('input_positions', [num_shards], tf.int64, initializer=tf.zeros_initializer(),
+                                trainable=False)
+    # Position of the next batch to prepare, a local variable initialized (after a restore) to the
+    # position of the shard.
+    next_position = tf.Variable(positions[shard], trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                                name='next_position_%d' % shard)
+
+    position = tf.assign_add(next_position, batch_size, use_locking=True) - batch_size
+    n = position + tf.range(batch_size, dtype=tf.int64)
+    epochs, offsets = n // num_examples, n % num_examples
+    locks = _shuffled_indices(seed, epochs, offsets, num_examples, stream=0)
+    wrong_keys = _shuffled_indices(seed, epochs, offsets, num_examples, stream=1)
+
+    # Half of the pairs match, the label of every position is drawn from the seed too.
+    correct = tf.contrib.stateless.stateless_random_uniform([batch_size], seed=tf.stack([seed, -1 - position])) < 0.5
+    lock_batch = tf.gather(tf.constant(lock_files), locks)
+    key_batch = tf.where(correct, tf.gather(tf.constant(key_files_good), locks),
+                         tf.gather(tf.constant(key_files_bad), wrong_keys))
+
+    def decode_pair(files):
+        _, lock_image = decode_input(files[0])
+        _, key_image = decode_input(files[1])
+        return tf.concat([lock_image, key_image], axis=2)
+
+    images = tf.map_fn(decode_pair, tf.stack([lock_batch, key_batch], axis=1), dtype=tf.float32,
+                       parallel_iterations=_input_threads(False), back_prop=False)
+    images = tf.reshape(images, [batch_size, IMAGE_SIZE, IMAGE_SIZE, 6])
+    labels = tf.cast(correct, tf.int32)
+
+    # A single thread prepares the batches, in order.
+    queue = tf.FIFOQueue(NUM_PREFETCH_BATCHES, [tf.float32, tf.int32, tf.int64],
+                         shapes=[[batch_size, IMAGE_SIZE, IMAGE_SIZE, 6], [batch_size], []])
+    tf.train.add_queue_runner(tf.train.QueueRunner(queue, [queue.enqueue([images, labels, position])]))
+
+    def dequeue():
+        images, labels, position = queue.dequeue()
+        tf.add_to_collection(tf.GraphKeys.UPDATE_OPS,
+                             tf.scatter_update(positions, [shard], tf.reshape(position + batch_size, [1])))
+        return images, labels
+
+    return dequeue
+
+
+def _shuffled_indices(seed, epochs, offsets, num_examples, stream):
+    """
+    Looks up positions in the permutations of range(num_examples) drawn from the seed for every
+    epoch.
+
+    The permutations are never materialized: an offset is mapped by a Feistel network, keyed by the
+    seed, the epoch and the stream, which is a bijection of the smallest range of an even number of
+    bits holding num_examples; the indices out of range are mapped again (cycle walking), which
+    stays a bijection of range(num_examples) and takes less than 4 rounds on average. The cost is
+    in the batch size, not in num_examples.
+
+    :param seed: the int64 seed
+    :param epochs: 1D int64 tensor, the epoch of every position, which spans at most two epochs
+    :param offsets: 1D int64 tensor, the offsets in the permutations
+    :param num_examples: length of the permutations
+    :param stream: 0 or 1, to draw two independent permutations for every epoch
+    :return: 1D int64 tensor, the indices at the offsets
+    """
+    half_bits = (max(num_examples - 1, 1).bit_length() + 1) // 2
+    half_size = 2 ** half_bits
+
+    def feistel(x, keys):
+        left, right = x // half_size, x % half_size
+        for i in xrange(FEISTEL_ROUNDS):
+            # Multiplicative hashing of the half and the round key, which stays below 2 ** 63.
+            mixed = tf.bitwise.bitwise_xor(right, keys[i]) * 0x9E3779B1 // 2 ** 24 % half_size
+            left, right = right, tf.bitwise.bitwise_xor(left, mixed)
+        return left * half_size + right
+
+    def permutation(epoch):
+        keys = tf.contrib.stateless.stateless_random_uniform([FEISTEL_ROUNDS], dtype=tf.float64,
+                                                             seed=tf.stack([seed, 2 * epoch + stream]))
+        keys = tf.cast(keys * 2 ** 31, tf.int64)
+        return tf.while_loop(lambda x: tf.reduce_any(x >= num_examples),
+                             lambda x: tf.where(x >= num_examples, feistel(x, keys), x),
+                             [feistel(offsets, keys)], back_prop=False)
+
+    first_epoch = epochs[0]
+    return tf.where(tf.equal(epochs, first_epoch), permutation(first_epoch), permutation(first_epoch + 1))
+
+
+def _check_files_exist(file_lists):
+    """Raises a ValueError if a file of the lists is missing."""
+    for q in file_lists:
+        for f in q:
+            if not tf.gfile.Exists(f):
+                raise ValueError('Failed to find file: ' + f)
+
+
+def _input_threads(eval_data):
+    """
+    :param eval_data: boolean, indicating if the pipeline is the evaluation's or the training's
+    :return: the number of threads preparing the examples, from FLAGS.THREAD_CONFIG
+    """
+    config = thread_config.load('inference' if eval_data else 'train')
+    return config.get('input_threads') or NUM_PREPROCESS_THREADS
 
 
 def _generate_image_and_label_batch(image, label, min_queue_examples,
-                                    batch_size, shuffle):
-    """Construct a queued batch of images and labels.
+                                    batch_size, shuffle, num_threads=NUM_PREPROCESS_THREADS):
+    """Construct a queue of images and labels, to dequeue batches from.
     Args:
       image: 3-D Tensor of [height, width, 6] of type.float32.
-      label: 1-D Tensor of type.int32
+      label: 0-D Tensor of type.int32
       min_queue_examples: int32, minimum number of samples to retain
         in the queue that provides of batches of examples.
       batch_size: Number of images per batch.
       shuffle: boolean indicating whether to use a shuffling queue.
+      num_threads: number of threads enqueuing the examples.
     Returns:
-      images: Images. 4D tensor of [batch_size, height, width, 6] size.
-      labels: Labels. 1D tensor of [batch_size] size.
+      function which dequeues a batch, and returns
+        images: Images. 4D tensor of [batch_size, height, width, 6] size.
+        labels: Labels. 1D tensor of [batch_size] size.
     """
     print("Image dimensions: ", image.get_shape())
     # image = tf.reshape(image, [2 * IMAGE_SIZE, IMAGE_SIZE, 3])
 
     # Create a queue that shuffles the examples, and then
-    # read 'batch_size' images + labels from the example queue.
-    num_preprocess_threads = 16
+    # read 'batch_size' images + labels from the example queue. The queue is built as
+    # tf.train.shuffle_batch() and tf.train.batch() do, but can be dequeued from more than once.
+    num_preprocess_threads = num_threads
+    capacity = min_queue_examples + 6 * batch_size
+    shapes = [image.get_shape(), []]
     if shuffle:
-        images, label_batch = tf.train.shuffle_batch(
-            [image, label],
-            batch_size=batch_size,
-            num_threads=num_preprocess_threads,
-            capacity=min_queue_examples + 6 * batch_size,
-            min_after_dequeue=min_queue_examples)
+        queue = tf.RandomShuffleQueue(capacity, min_queue_examples, [tf.float32, tf.int32], shapes=shapes)
     else:
-        images, label_batch = tf.train.batch(
-            [image, label],
-            batch_size=batch_size,
-            num_threads=num_preprocess_threads,
-            capacity=min_queue_examples + 6 * batch_size)
+        queue = tf.FIFOQueue(capacity, [tf.float32, tf.int32], shapes=shapes)
+    tf.train.add_queue_runner(tf.train.QueueRunner(queue, [queue.enqueue([image, label])] * num_preprocess_threads))
 
     # Display the training images in the visualizer.
     # tf.summary.image('images', images)
 
-    print("Images dimensions: ", images.get_shape())
+    def dequeue():
+        images, label_batch = queue.dequeue_many(batch_size)
+        print("Images dimensions: ", images.get_shape())
+        return images, tf.reshape(label_batch, [-1])
 
-    return images, tf.reshape(label_batch, [batch_size])
+    return dequeue
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests of the deterministic input pipeline (sm_input.py) and of the training graph it feeds."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from PIL import Image
+import tensorflow as tf
+
+import sm
+import sm_input
+import sm_train
+
+# Number of training pairs of the synthetic data set.
+NUM_EXAMPLES = 8
+
+# FLAGS constants the tests change.
+SETTINGS = ['data_dir', 'batch_size', 'model_version', 'NORMALIZATION', 'TOWER', 'EARLY_EXIT', 'NUM_REPLICAS',
+            'ACCUMULATION_STEPS', 'STEPS_PER_FETCH', 'DETERMINISTIC_INPUT', 'DISTILL_FROM', 'use_fp16']
+
+
+class InputTest(tf.test.TestCase):
+
+    def setUp(self):
+        self._settings = dict((name, getattr(sm.FLAGS, name)) for name in SETTINGS)
+        self._num_examples = sm_input.NUM_EXAMPLES_PER_EPOCH_FOR_TRAIN
+        self._data_dir = tempfile.mkdtemp()
+
+        # The training set lists the pairs 1_L.png/1_K.png, 3_L.png/3_K.png, ..., with the keys 2_K.png,
+        # 4_K.png, ... as the wrong ones.
+        os.makedirs(os.path.join(self._data_dir, 'images'))
+        random = np.random.RandomState(0)
+        for i in range(1, 2 * NUM_EXAMPLES + 1):
+            for half in ('L', 'K'):
+                pixels = random.randint(0, 256, [sm.IMAGE_SIZE, sm.IMAGE_SIZE, 3]).astype(np.uint8)
+                Image.fromarray(pixels).save(os.path.join(self._data_dir, 'images', '%d_%s.png' % (i, half)))
+
+        sm_input.NUM_EXAMPLES_PER_EPOCH_FOR_TRAIN = NUM_EXAMPLES
+        sm.FLAGS.data_dir = self._data_dir
+        sm.FLAGS.batch_size = 2
+        sm.FLAGS.model_version = 0
+        sm.FLAGS.NORMALIZATION = 'lrn'
+        sm.FLAGS.TOWER = 'standard'
+        sm.FLAGS.EARLY_EXIT = False
+        sm.FLAGS.NUM_REPLICAS = 1
+        sm.FLAGS.ACCUMULATION_STEPS = 1
+        sm.FLAGS.STEPS_PER_FETCH = 1
+        sm.FLAGS.DETERMINISTIC_INPUT = True
+        sm.FLAGS.DISTILL_FROM = ''
+        sm.FLAGS.use_fp16 = False
+
+    def tearDown(self):
+        for name, value in self._settings.items():
+            setattr(sm.FLAGS, name, value)
+        sm_input.NUM_EXAMPLES_PER_EPOCH_FOR_TRAIN = self._num_examples
+        shutil.rmtree(self._data_dir)
+
+    def testShuffledIndicesArePermutations(self):
+        with tf.Graph().as_default() as graph, self.test_session(graph=graph) as sess:
+            seed = tf.constant(sm.FLAGS.INPUT_SEED, tf.int64)
+            for num_examples in [1, 2, 3, 5, 16, 17, 100, 1000]:
+                offsets = tf.range(num_examples, dtype=tf.int64)
+                for epoch in [0, 3]:
+                    epochs = tf.fill([num_examples], tf.constant(epoch, tf.int64))
+                    for stream in [0, 1]:
+                        indices = sess.run(sm_input._shuffled_indices(seed, epochs, offsets, num_examples, stream))
+                        # Every index of range(num_examples) comes up exactly once.
+                        self.assertAllEqual(np.arange(num_examples), np.sort(indices))
+
+    def _read_batches(self, num_batches, positions=None):
+        """
+        Reads batches from a new deterministic input pipeline.
+
+        :param num_batches: number of batches to read
+        :param positions: (optional) value of input_positions to start from, as restored from a checkpoint
+        :return: the images and labels of every batch, and the value of input_positions after the batches
+        """
+        with tf.Graph().as_default() as graph:
+            dequeue = sm_input.deterministic_input_pipeline(self._data_dir, sm.FLAGS.batch_size)
+            images, labels = dequeue()
+            update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
+            positions_variable = [v for v in tf.global_variables() if v.op.name == 'input_positions'][0]
+
+            with self.test_session(graph=graph) as sess:
+                sess.run(tf.global_variables_initializer())
+                if positions is not None:
+                    positions_variable.load(positions, sess)
+                # The position of the next batch to prepare starts from the restored one.
+                sess.run(tf.local_variables_initializer())
+                coord = tf.train.Coordinator()
+                threads = tf.train.start_queue_runners(coord=coord, sess=sess)
+                batches = [sess.run([images, labels, update_ops])[:2] for _ in range(num_batches)]
+                positions = sess.run(positions_variable)
+                coord.request_stop()
+                coord.join(threads, stop_grace_period_secs=10)
+        return batches, positions
+
+    def testResumeFromPositions(self):
+        # The third batch spans the first two epochs.
+        sm.FLAGS.batch_size = 3
+        batches, _ = self._read_batches(3)
+        _, positions = self._read_batches(2)
+        self.assertAllEqual([2 * sm.FLAGS.batch_size], positions)
+
+        resumed, _ = self._read_batches(1, positions)
+        self.assertAllEqual(batches[2][0], resumed[0][0])
+        self.assertAllEqual(batches[2][1], resumed[0][1])
+
+    def testTrainGraphWithReplicas(self):
+        sm.FLAGS.NUM_REPLICAS = 2
+        with tf.Graph().as_default() as graph:
+            fetches, _ = sm_train.build_train_graph()
+            # The replicas share the variables of the input order.
+            self.assertEqual(1, len([v for v in tf.global_variables() if v.op.name == 'READ/input_positions']))
+
+            with self.test_session(graph=graph, config=sm_train.session_config()) as sess:
+                sess.run(tf.global_variables_initializer())
+                sess.run(tf.local_variables_initializer())
+                coord = tf.train.Coordinator()
+                threads = tf.train.start_queue_runners(coord=coord, sess=sess)
+                sess.run(fetches['train_op'])
+                positions = sess.run([v for v in tf.global_variables() if v.op.name == 'READ/input_positions'][0])
+                coord.request_stop()
+                coord.join(threads, stop_grace_period_secs=10)
+
+        self.assertAllEqual([sm.FLAGS.batch_size] * 2, positions)
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Latency/throughput curve of the inference graph across batch sizes.
+
+The graph is built once with a dynamic batch dimension (sm.placeholder_inputs()) and fed with
+random examples of every batch size in turn. Weights are restored from --checkpoint_dir when a
+checkpoint is found; otherwise they are randomly initialized, which does not change the timings.
+With --frozen_graph, a graph exported by sm_export.py is measured instead, e.g. to compare the LRN
+model with the batch-normalized one, whose normalizations the export folds into the convolutions.
+
+Usage:
+    python sm_latency.py --batch_sizes=1,2,4,8,16,32,64,128,256,512,1024 --out=./sm_latency.csv
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import tensorflow as tf
+
+import sm
+import sm_frozen
+from utils import time_runs
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_string('checkpoint_dir', './MSHAPES_train',
+                           """Directory where to read model checkpoints.""")
+tf.app.flags.DEFINE_string('batch_sizes', '1,2,4,8,16,32,64,128,256,512,1024',
+                           """Comma separated list of batch sizes to measure.""")
+tf.app.flags.DEFINE_integer('num_runs', 20,
+                            """Number of timed runs per batch size.""")
+tf.app.flags.DEFINE_string('out', './sm_latency.csv',
+                           """Where to write the curve.""")
+tf.app.flags.DEFINE_string('frozen_graph', '',
+                           """If set, measure this graph exported by sm_export.py instead of a checkpoint.""")
+
+
+def measure(sess, images, logits, batch_size, num_runs):
+    """
+    Times the forward pass at one batch size.
+
+    :param sess: session holding the model
+    :param images: the input placeholder
+    :param logits: the output of the model
+    :param batch_size: the batch size to feed
+    :param num_runs: number of timed runs
+    :return: median and 90th percentile latency of one batch, in seconds
+    """
+    batch = np.random.uniform(0, 255, [batch_size, sm.IMAGE_SIZE, sm.IMAGE_SIZE, 6]).astype(np.float32)
+    durations = time_runs(sess, logits, {images: batch}, num_runs)
+
+    return np.median(durations), np.percentile(durations, 90)
+
+
+def write_curve(sess, images, logits, batch_sizes):
+    """Measures every batch size and writes the curve to FLAGS.out."""
+    with open(FLAGS.out, 'w') as f:
+        f.write('model_version,normalization,tower,batch_size,latency_ms,latency_p90_ms,examples_per_sec\n')
+        for batch_size in batch_sizes:
+            latency, latency_p90 = measure(sess, images, logits, batch_size, FLAGS.num_runs)
+            format_str = 'batch %d: %.2f ms/batch (p90 %.2f ms), %.1f examples/sec'
+            print(format_str % (batch_size, 1e3 * latency, 1e3 * latency_p90, batch_size / latency))
+            f.write('%d,%s,%s,%d,%.3f,%.3f,%.1f\n' % (sm.FLAGS.model_version, sm.FLAGS.NORMALIZATION, sm.FLAGS.TOWER,
+                                                      batch_size, 1e3 * latency, 1e3 * latency_p90,
+                                                      batch_size / latency))
+
+
+def main(argv=None):  # pylint: disable=unused-argument
+    batch_sizes = [int(b) for b in FLAGS.batch_sizes.split(',')]
+
+    if FLAGS.frozen_graph:
+        scorer = sm_frozen.FrozenScorer(FLAGS.frozen_graph)
+        write_curve(scorer.session, scorer.images, scorer.logits, batch_sizes)
+        return
+
+    with tf.Graph().as_default():
+        images = sm.placeholder_inputs()
+        logits = sm.inference(images)
+        saver = tf.train.Saver()
+
+        with tf.Session() as sess:
+            ckpt = tf.train.get_checkpoint_state(FLAGS.checkpoint_dir)
+            if ckpt and ckpt.model_checkpoint_path:
+                saver.restore(sess, ckpt.model_checkpoint_path)
+            else:
+                print('No checkpoint file found, using random weights')
+                sess.run(tf.global_variables_initializer())
+
+            write_curve(sess, images, logits, batch_sizes)
+
+
+if __name__ == '__main__':
+    tf.app.run()
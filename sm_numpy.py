@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Pure NumPy inference engine for trained models, for scoring workers that should not import
+TensorFlow.
+
+It reproduces sm.inference for model versions 0, 1 and 3 (version 2 needs image rotations and is
+not supported) from a weight file written by `sm_export.py --weights_output=...`. Convolutions are
+computed as im2col (a strided view of the patches) followed by one matrix product, in chunks of
+the batch to bound the memory used. sm_numpy_test.py tests it against the TensorFlow graph on
+random weights, and sm_export.py --check_numpy_parity on the exported checkpoint.
+
+Run directly, it reports start-up time, peak RSS and throughput:
+    python sm_numpy.py --weights=./MSHAPES_export/weights.npz
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+
+_start_time = time.time()
+
+import argparse
+import resource
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+import FLAGS
+
+_import_time = time.time()
+
+# Number of examples convolved at once, bounds the size of the im2col buffers.
+CHUNK_SIZE = 16
+
+# Parameters of the local response normalization of sm.py.
+LRN_DEPTH_RADIUS = 4
+LRN_BIAS = 1.0
+LRN_ALPHA = 0.001 / 9.0
+LRN_BETA = 0.75
+
+
+def _same_padding(size, ksize, stride):
+    """Padding (before, after) of TensorFlow's 'SAME' padding along one dimension."""
+    out = -(-size // stride)
+    total = max((out - 1) * stride + ksize - size, 0)
+    return total // 2, total - total // 2
+
+
+def conv2d(x, kernel, padding):
+    """
+    Stride 1 convolution, as tf.nn.conv2d.
+
+    :param x: input, shape [batch_size, height, width, in_channels]
+    :param kernel: filter, shape [kernel_height, kernel_width, in_channels, out_channels]
+    :param padding: 'SAME' or 'VALID'
+    :return: output, shape [batch_size, out_height, out_width, out_channels]
+    """
+    kh, kw = kernel.shape[:2]
+    if padding == 'SAME':
+        x = np.pad(x, ((0, 0), _same_padding(x.shape[1], kh, 1), _same_padding(x.shape[2], kw, 1), (0, 0)),
+                   mode='constant')
+    x = np.ascontiguousarray(x)
+    b, h, w, c = x.shape
+    oh, ow = h - kh + 1, w - kw + 1
+
+    out = np.empty([b, oh, ow, kernel.shape[3]], dtype=x.dtype)
+    for begin in range(0, b, CHUNK_SIZE):
+        chunk = x[begin:begin + CHUNK_SIZE]
+        s = chunk.strides
+        patches = as_strided(chunk, (chunk.shape[0], oh, ow, kh, kw, c), (s[0], s[1], s[2], s[1], s[2], s[3]))
+        out[begin:begin + CHUNK_SIZE] = np.tensordot(patches, kernel, axes=([3, 4, 5], [0, 1, 2]))
+
+    return out
+
+
+def max_pool(x, ksize, stride):
+    """
+    Max pooling with 'SAME' padding, as tf.nn.max_pool.
+
+    :param x: input, shape [batch_size, height, width, channels]
+    :param ksize: size of the (square) window
+    :param stride: stride in both dimensions
+    :return: output, shape [batch_size, ceil(height / stride), ceil(width / stride), channels]
+    """
+    oh, ow = -(-x.shape[1] // stride), -(-x.shape[2] // stride)
+    x = np.pad(x, ((0, 0), _same_padding(x.shape[1], ksize, stride), _same_padding(x.shape[2], ksize, stride),
+                   (0, 0)), mode='constant', constant_values=-np.inf)
+
+    out = None
+    for i in range(ksize):
+        for j in range(ksize):
+            window = x[:, i:i + stride * (oh - 1) + 1:stride, j:j + stride * (ow - 1) + 1:stride]
+            out = window if out is None else np.maximum(out, window)
+
+    return out
+
+
+def lrn(x):
+    """
+    Local response normalization across channels, as the tf.nn.lrn calls of sm.py.
+
+    :param x: input, shape [batch_size, height, width, channels]
+    :return: normalized input, same shape
+    """
+    channels = x.shape[3]
+    squared = np.pad(np.square(x), ((0, 0), (0, 0), (0, 0), (LRN_DEPTH_RADIUS, LRN_DEPTH_RADIUS)), mode='constant')
+    square_sum = squared[..., :channels].copy()
+    for i in range(1, 2 * LRN_DEPTH_RADIUS + 1):
+        square_sum += squared[..., i:i + channels]
+
+    return x / np.power(LRN_BIAS + LRN_ALPHA * square_sum, LRN_BETA)
+
+
+def relu(x):
+    return np.maximum(x, 0)
+
+
+def softmax(logits):
+    e = np.exp(logits - logits.max(axis=1, keepdims=True))
+    return e / e.sum(axis=1, keepdims=True)
+
+
+class NumpyModel(object):
+    """Inference model of sm.py evaluated with NumPy."""
+
+    def __init__(self, weights, model_version, normalization='lrn', tower='standard'):
+        """
+        :param weights: dictionary from variable names (e.g. 'FC1/weights') to float32 arrays
+        :param model_version: the version of the model, see FLAGS.model_version
+        :param normalization: FLAGS.NORMALIZATION of the model; batch normalizations must already be
+            folded into the convolutions, as sm_export.py does
+        :param tower: FLAGS.TOWER of the model, only 'standard' is supported
+        """
+        if model_version not in (0, 1, 3):
+            raise ValueError('Model version %d is not supported by the NumPy engine' % model_version)
+        if model_version == 1 and tower != 'standard':
+            raise ValueError('The %s towers are not supported by the NumPy engine' % tower)
+        if any(name.startswith('early_exit/') for name in weights):
+            raise ValueError('The early exit is not supported by the NumPy engine')
+        self.weights = dict((name, np.asarray(value, dtype=np.float32)) for name, value in weights.items())
+        self.model_version = model_version
+        self.normalization = normalization
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a weight file written by sm_export.py.
+
+        :param path: path of the .npz file
+        :return: the model
+        """
+        with np.load(path) as f:
+            weights = dict((name, f[name]) for name in f.files
+                           if name not in ('model_version', 'normalization', 'tower'))
+            model_version = int(f['model_version'])
+            normalization = str(f['normalization']) if 'normalization' in f.files else 'lrn'
+            tower = str(f['tower']) if 'tower' in f.files else 'standard'
+
+        return cls(weights, model_version, normalization, tower)
+
+    def _lrn(self, x):
+        return lrn(x) if self.normalization == 'lrn' else x
+
+    def _conv_relu(self, scope, x, padding='SAME'):
+        conv = conv2d(x, self.weights[scope + '/weights'], padding)
+        return relu(conv + self.weights[scope + '/biases'])
+
+    def _input_process(self, scope, images):
+        """As sm.input_process."""
+        norm1 = self._lrn(max_pool(self._conv_relu(scope + '/conv', images), 3, 2))
+        norm2 = self._lrn(self._conv_relu(scope + '/conv2', norm1))
+        return max_pool(norm2, 3, 2)
+
+    def _full_connection_layer(self, features):
+        """As sm.full_connection_layer, without dropout."""
+        reshape = features.reshape(features.shape[0], -1)
+        fc1 = relu(np.dot(reshape, self.weights['FC1/weights']) + self.weights['FC1/biases'])
+        fc2 = relu(np.dot(fc1, self.weights['FC2/weights']) + self.weights['FC2/biases'])
+        return np.dot(fc2, self.weights['softmax_linear/weights']) + self.weights['softmax_linear/biases']
+
+    def logits(self, images):
+        """
+        :param images: examples, shape [batch_size, IMAGE_SIZE, IMAGE_SIZE, 6]
+        :return: logits, shape [batch_size, NUM_CLASSES]
+        """
+        images = np.asarray(images, dtype=np.float32)
+
+        if self.model_version == 1:
+            features = np.concatenate([self._input_process('input/input_L', images[..., :3]),
+                                       self._input_process('input/input_K', images[..., 3:])], axis=3)
+        else:
+            if self.model_version == 3:
+                images = np.cross(images[..., :3], images[..., 3:])
+            norm1 = self._lrn(max_pool(self._conv_relu('conv1', images), 3, 2))
+            features = max_pool(self._lrn(self._conv_relu('conv2', norm1)), 3, 2)
+
+        return self._full_connection_layer(features)
+
+    def match_probability(self, images):
+        """
+        :param images: examples, shape [batch_size, IMAGE_SIZE, IMAGE_SIZE, 6]
+        :return: the probability of every pair to match, shape [batch_size]
+        """
+        return softmax(self.logits(images))[:, 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the NumPy inference engine.')
+    parser.add_argument('--weights', default='./MSHAPES_export/weights.npz',
+                        help='Weight file written by sm_export.py.')
+    parser.add_argument('--batch_size', type=int, default=128,
+                        help='Batch size of the throughput measurement.')
+    parser.add_argument('--num_runs', type=int, default=10,
+                        help='Number of timed batches.')
+    args = parser.parse_args()
+
+    load_start = time.time()
+    model = NumpyModel.load(args.weights)
+    load_end = time.time()
+    model.match_probability(np.zeros([1, FLAGS.IMAGE_SIZE, FLAGS.IMAGE_SIZE, 6], dtype=np.float32))
+    first_prediction = time.time()
+
+    print('import: %.3f sec, load: %.3f sec, first prediction: %.3f sec, total: %.3f sec' %
+          (_import_time - _start_time, load_end - load_start, first_prediction - load_end,
+           first_prediction - _start_time))
+
+    batch = np.random.uniform(0, 255, [args.batch_size, FLAGS.IMAGE_SIZE, FLAGS.IMAGE_SIZE, 6]).astype(np.float32)
+    start_time = time.time()
+    for _ in range(args.num_runs):
+        model.match_probability(batch)
+    duration = time.time() - start_time
+
+    print('%.1f examples/sec at batch size %d' % (args.num_runs * args.batch_size / duration, args.batch_size))
+    # ru_maxrss is in kilobytes on Linux.
+    print('peak RSS: %.1f MB' % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests of the NumPy inference engine (sm_numpy.py) against the TensorFlow graph of sm.py."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import tensorflow as tf
+
+import sm
+import sm_numpy
+
+# Largest difference of the logits allowed, relative to the largest logit (as sm_export.py).
+TOLERANCE = 1e-4
+
+# FLAGS constants the tests change.
+SETTINGS = ['model_version', 'NORMALIZATION', 'TOWER', 'QUANTIZE', 'EARLY_EXIT', 'FOLD_BATCH_NORM', 'use_fp16']
+
+
+class NumpyParityTest(tf.test.TestCase):
+
+    def setUp(self):
+        self._settings = dict((name, getattr(sm.FLAGS, name)) for name in SETTINGS)
+        sm.FLAGS.NORMALIZATION = 'lrn'
+        sm.FLAGS.TOWER = 'standard'
+        sm.FLAGS.QUANTIZE = False
+        sm.FLAGS.EARLY_EXIT = False
+        sm.FLAGS.FOLD_BATCH_NORM = False
+        sm.FLAGS.use_fp16 = False
+
+    def tearDown(self):
+        for name, value in self._settings.items():
+            setattr(sm.FLAGS, name, value)
+
+    def _check_parity(self, model_version):
+        sm.FLAGS.model_version = model_version
+        examples = np.random.RandomState(model_version).uniform(
+            0, 255, [4, sm.IMAGE_SIZE, sm.IMAGE_SIZE, 6]).astype(np.float32)
+
+        with tf.Graph().as_default():
+            tf.set_random_seed(model_version)
+            images = sm.placeholder_inputs()
+            logits = sm.inference(images)
+            with self.test_session() as sess:
+                sess.run(tf.global_variables_initializer())
+                expected = sess.run(logits, feed_dict={images: examples})
+                weights = dict((v.op.name, sess.run(v)) for v in tf.trainable_variables())
+
+        actual = sm_numpy.NumpyModel(weights, model_version).logits(examples)
+        self.assertEqual(expected.shape, actual.shape)
+        difference = np.abs(actual - expected).max() / max(np.abs(expected).max(), 1.0)
+        self.assertLess(difference, TOLERANCE)
+
+    def testVersion0(self):
+        self._check_parity(0)
+
+    def testVersion1(self):
+        self._check_parity(1)
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+All-pairs matching of N lock halves against M key halves.
+
+Every (lock, key) pair is scored by the trained network, tile by tile, where each tile holds
+FLAGS.batch_size pairs. Scores are written into a memory mapped [N, M] matrix so the
+job can be resumed (tiles that are already scored are skipped) and so N can grow into the tens
+of thousands without holding all pairs in memory. Finally the one-to-one assignment maximising
+the joint match likelihood is solved with the Hungarian method (scipy's linear_sum_assignment).
+
+Usage:
+    python sm_pairs.py --lock_dir=./box/locks --key_dir=./box/keys --out_dir=./box/pairs
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import glob
+import hashlib
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+from PIL import Image
+from six.moves import xrange  # pylint: disable=redefined-builtin
+import tensorflow as tf
+
+import sm
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_string('lock_dir', './pairs/locks',
+                           """Directory holding the lock halves as png files.""")
+tf.app.flags.DEFINE_string('key_dir', './pairs/keys',
+                           """Directory holding the key halves as png files.""")
+tf.app.flags.DEFINE_string('out_dir', './pairs/out',
+                           """Directory where to write the score matrix and the assignment.""")
+tf.app.flags.DEFINE_string('checkpoint_dir', './MSHAPES_train',
+                           """Directory where to read model checkpoints.""")
+tf.app.flags.DEFINE_integer('flush_every', 50,
+                            """How many tiles to score between two flushes of the score matrix.""")
+tf.app.flags.DEFINE_boolean('assign', True,
+                            """Whether to solve the one-to-one assignment once all pairs are scored.""")
+
+
+def list_images(directory):
+    """
+    Lists the png files of a directory in a stable order.
+
+    :param directory: the directory to list
+    :return: a sorted list of file paths
+    """
+    return sorted(glob.glob(os.path.join(directory, '*.png')))
+
+
+def files_hash(files, *extra):
+    """
+    :param files: list of file paths
+    :param extra: other strings the hash depends on
+    :return: a hash of the paths, sizes and modification times of the files and of the extra strings
+    """
+    key = hashlib.sha1()
+    for f in files:
+        stat = os.stat(f)
+        key.update(('%s\0%d\0%d\n' % (f, stat.st_size, int(stat.st_mtime))).encode('utf-8'))
+    for s in extra:
+        key.update(('%s\n' % s).encode('utf-8'))
+
+    return key.hexdigest()[:16]
+
+
+def image_stack(files, cache_prefix):
+    """
+    Decodes a list of png files into a uint8 array of shape [len(files), IMAGE_SIZE, IMAGE_SIZE, 3]
+    backed by a .npy memory map, so that the images are decoded only once and never all held in memory.
+
+    The cache is <cache_prefix>-<hash of the files>.npy, so that it is only reused for the same files.
+    It is decoded into a temporary file which is renamed once complete: an interrupted decode is never
+    reused.
+
+    :param files: list of png file paths
+    :param cache_prefix: prefix of the .npy file used as cache
+    :return: the memory mapped image stack
+    """
+    cache_path = '%s-%s.npy' % (cache_prefix, files_hash(files))
+    if not os.path.exists(cache_path):
+        shape = (len(files), sm.IMAGE_SIZE, sm.IMAGE_SIZE, 3)
+        tmp_path = cache_path + '.tmp'
+        stack = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=shape)
+        for i, f in enumerate(files):
+            stack[i] = np.asarray(Image.open(f).convert('RGB'), dtype=np.uint8)
+        stack.flush()
+        del stack
+        os.rename(tmp_path, cache_path)
+
+    return np.load(cache_path, mmap_mode='r')
+
+
+def score_matrix(path_prefix, lock_files, key_files, checkpoint_path):
+    """
+    Opens the memory mapped score matrix, creating it filled with NaN (i.e. "not scored yet") if needed.
+
+    The matrix is <path_prefix>-<hash>.npy, where the hash is the one of the files and of the
+    checkpoint, so that a matrix is only resumed for the same pairs and the same model. Its pairs are
+    NaN until scored, so that an interrupted scoring resumes safely; a new matrix is filled in a
+    temporary file which is renamed once complete.
+
+    :param path_prefix: prefix of the .npy file holding the matrix
+    :param lock_files: the locks, one per row
+    :param key_files: the keys, one per column
+    :param checkpoint_path: the checkpoint which scores the pairs
+    :return: the path of the matrix, and a float32 memory map of shape [num_locks, num_keys]
+    """
+    path = '%s-%s.npy' % (path_prefix, files_hash(lock_files + key_files, len(lock_files), checkpoint_path))
+    if not os.path.exists(path):
+        tmp_path = path + '.tmp'
+        scores = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32,
+                                           shape=(len(lock_files), len(key_files)))
+        scores[:] = np.nan
+        scores.flush()
+        del scores
+        os.rename(tmp_path, path)
+
+    return path, np.load(path, mmap_mode='r+')
+
+
+def tile_batch(locks, keys, begin, end):
+    """
+    Builds the 6-channel input batch of the pairs with flat indices [begin, end) of the score matrix.
+
+    :param locks: lock image stack
+    :param keys: key image stack
+    :param begin: first flat pair index
+    :param end: one past the last flat pair index
+    :return: float32 array of shape [end - begin, IMAGE_SIZE, IMAGE_SIZE, 6]
+    """
+    flat = np.arange(begin, end)
+    lock_index, key_index = np.divmod(flat, keys.shape[0])
+
+    return np.concatenate([locks[lock_index], keys[key_index]], axis=3).astype(np.float32)
+
+
+def latest_checkpoint():
+    """:return: the path of the checkpoint of FLAGS.checkpoint_dir"""
+    ckpt = tf.train.get_checkpoint_state(FLAGS.checkpoint_dir)
+    if not (ckpt and ckpt.model_checkpoint_path):
+        raise ValueError('No checkpoint file found in ' + FLAGS.checkpoint_dir)
+
+    return ckpt.model_checkpoint_path
+
+
+def score_all_pairs(locks, keys, scores, checkpoint_path):
+    """
+    Scores every pair that is not yet in the score matrix.
+
+    :param locks: lock image stack
+    :param keys: key image stack
+    :param scores: the memory mapped score matrix, updated in place
+    :param checkpoint_path: the checkpoint to score with
+    :return: the number of pairs scored
+    """
+    batch_size = sm.FLAGS.batch_size
+    num_pairs = scores.size
+    flat_scores = scores.reshape(-1)
+
+    with tf.Graph().as_default():
+        images = sm.placeholder_inputs()
+        # eval=False keeps the dropout of full_connection_layer disabled, so the scores are deterministic.
+        logits = sm.inference(images)
+        match_prob = tf.nn.softmax(logits)[:, 1]
+        saver = tf.train.Saver()
+
+        with tf.Session() as sess:
+            saver.restore(sess, checkpoint_path)
+
+            scored = 0
+            tiles = 0
+            start_time = time.time()
+            for begin in xrange(0, num_pairs, batch_size):
+                end = min(begin + batch_size, num_pairs)
+                if np.isfinite(flat_scores[begin:end]).all():
+                    continue
+
+                batch = tile_batch(locks, keys, begin, end)
+                flat_scores[begin:end] = sess.run(match_prob, feed_dict={images: batch})
+                scored += end - begin
+                tiles += 1
+
+                if tiles % FLAGS.flush_every == 0:
+                    scores.flush()
+                    duration = time.time() - start_time
+                    format_str = '%s: %d/%d pairs (%.1f pairs/sec)'
+                    print(format_str % (datetime.now(), begin + batch_size, num_pairs, scored / duration))
+
+            scores.flush()
+            duration = time.time() - start_time
+
+    if scored > 0:
+        print('%s: scored %d pairs in %.1f sec (%.1f pairs/sec)' % (datetime.now(), scored, duration,
+                                                                   scored / duration))
+    else:
+        print('%s: all %d pairs were already scored' % (datetime.now(), num_pairs))
+
+    return scored
+
+
+def assign(scores):
+    """
+    Solves the optimal one-to-one assignment between locks and keys, maximising the sum of the
+    log match probabilities (i.e. the joint likelihood of the pairing).
+
+    :param scores: score matrix of shape [num_locks, num_keys], match probabilities
+    :return: lock indices, key indices and the scores of the assigned pairs
+    """
+    try:
+        from scipy.optimize import linear_sum_assignment
+    except ImportError:
+        raise Exception("scipy is needed to solve the assignment (pip install scipy).")
+
+    scores = np.asarray(scores, dtype=np.float64)
+    cost = -np.log(np.clip(scores, 1e-12, 1.0))
+    lock_index, key_index = linear_sum_assignment(cost)
+
+    return lock_index, key_index, scores[lock_index, key_index]
+
+
+def main(argv=None):  # pylint: disable=unused-argument
+    lock_files = list_images(FLAGS.lock_dir)
+    key_files = list_images(FLAGS.key_dir)
+    if not lock_files or not key_files:
+        raise ValueError('No png files found in %s or %s' % (FLAGS.lock_dir, FLAGS.key_dir))
+
+    if not tf.gfile.Exists(FLAGS.out_dir):
+        tf.gfile.MakeDirs(FLAGS.out_dir)
+
+    print('Decoding %d locks and %d keys...' % (len(lock_files), len(key_files)))
+    locks = image_stack(lock_files, os.path.join(FLAGS.out_dir, 'locks'))
+    keys = image_stack(key_files, os.path.join(FLAGS.out_dir, 'keys'))
+    print('Done.')
+
+    checkpoint_path = latest_checkpoint()
+    scores_path, scores = score_matrix(os.path.join(FLAGS.out_dir, 'scores'), lock_files, key_files,
+                                       checkpoint_path)
+    print('Score matrix: ' + scores_path)
+    score_all_pairs(locks, keys, scores, checkpoint_path)
+
+    if FLAGS.assign:
+        start_time = time.time()
+        lock_index, key_index, pair_scores = assign(scores)
+        print('%s: assignment solved in %.1f sec, mean match probability = %.3f' %
+              (datetime.now(), time.time() - start_time, float(np.mean(pair_scores))))
+
+        with open(os.path.join(FLAGS.out_dir, 'assignment.csv'), 'w') as f:
+            f.write('lock,key,score\n')
+            for l, k, s in zip(lock_index, key_index, pair_scores):
+                f.write('%s,%s,%.6f\n' % (lock_files[l], key_files[k], s))
+
+
+if __name__ == '__main__':
+    tf.app.run()
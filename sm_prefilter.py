@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Cheap, non-learned geometric prefilter for lock/key pairs.
+
+Each piece is a shape cut along a straight line, so its cut edge shows up as a long straight
+run of boundary pixels. For every piece we look for the straightest edges of its mask (the
+directions in which the most mask pixels lie on the supporting line), and take the profile of
+the mask along each of these edges, i.e. which positions along the edge are covered by boundary
+pixels within a thin band of it. Measuring the profile in the frame of the edge
+makes it rotation invariant.
+
+Two pieces which match share their cut edge, so their edge profiles have the same length and
+shape up to a shift and a flip. A pair is scored by the peak of the normalized 1D cross
+correlation of the profiles; pairs below FLAGS.PREFILTER_THRESHOLD are rejected without running
+the network.
+
+Only NumPy is needed here; everything is vectorized over pieces.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+import FLAGS
+
+
+IMAGE_SIZE = FLAGS.IMAGE_SIZE
+
+# Number of edge directions tried, evenly spread over 360 degrees.
+NUM_ANGLES = 180
+# Number of candidate straight edges kept per piece. The cut edge is not always the longest
+# straight edge (e.g. the base of a cut triangle), so the two best are compared.
+NUM_EDGES = 2
+# Directions closer than this (in degrees) to an already chosen edge are not chosen again.
+EDGE_SUPPRESSION_DEGREES = 30.0
+# Thickness, in pixels, of the band along an edge in which the profile is measured.
+EDGE_BAND = 2.0
+# Length of the profiles; long enough for the diagonal of the image.
+PROFILE_LENGTH = int(np.ceil(np.sqrt(2.0) * IMAGE_SIZE)) + 1
+# Number of pieces processed at once, bounds the memory used by edge_profiles().
+CHUNK_SIZE = 64
+
+
+def _grid(height, width):
+    """
+    Projections of the pixel grid on the normals and the tangents of all edge directions.
+
+    :return: normal and tangent coordinates, both of shape [NUM_ANGLES, height * width]
+    """
+    ys, xs = np.mgrid[0:height, 0:width].astype(np.float32)
+    xs = xs.reshape(-1) - (width - 1) / 2.0
+    ys = ys.reshape(-1) - (height - 1) / 2.0
+
+    theta = 2 * np.pi * np.arange(NUM_ANGLES, dtype=np.float32) / NUM_ANGLES
+    cos, sin = np.cos(theta)[:, None], np.sin(theta)[:, None]
+
+    return xs * cos + ys * sin, ys * cos - xs * sin
+
+
+def _boundary(mask, depth):
+    """
+    Pixels of the masks which are at most depth steps (4-neighbourhood) away from the outside.
+
+    :param mask: boolean array of shape [num_pieces, height, width]
+    :param depth: thickness of the boundary
+    :return: boolean array of the same shape
+    """
+    interior = mask
+    for _ in range(depth):
+        padded = np.pad(interior, ((0, 0), (1, 1), (1, 1)), mode='constant')
+        interior = (padded[:, 1:-1, 1:-1] & padded[:, :-2, 1:-1] & padded[:, 2:, 1:-1] &
+                    padded[:, 1:-1, :-2] & padded[:, 1:-1, 2:])
+
+    return mask & ~interior
+
+
+def edge_profiles(images):
+    """
+    Computes the profiles of the NUM_EDGES straightest edges of each piece. A profile is 1 at the
+    positions along the edge which the edge covers and 0 elsewhere.
+
+    :param images: pieces, array of shape [num_pieces, height, width, channels]; the background is black
+    :return: float32 array of shape [num_pieces, NUM_EDGES, PROFILE_LENGTH]
+    """
+    num_pieces, height, width = images.shape[:3]
+    normal, tangent = _grid(height, width)
+    suppression = int(round(EDGE_SUPPRESSION_DEGREES * NUM_ANGLES / 360.0))
+    angle_index = np.arange(NUM_ANGLES)
+    # The band of an edge must lie within the boundary pixels kept.
+    depth = int(np.ceil(EDGE_BAND)) + 1
+
+    profiles = np.zeros([num_pieces, NUM_EDGES, PROFILE_LENGTH], dtype=np.float32)
+
+    for begin in range(0, num_pieces, CHUNK_SIZE):
+        chunk = np.asarray(images[begin:begin + CHUNK_SIZE])
+        boundary = _boundary(chunk.max(axis=3) > 0, depth).reshape(chunk.shape[0], -1)
+        pieces = np.arange(chunk.shape[0])
+
+        # Only the pixels near the boundary matter; gather them into a [pieces, length] array padded with
+        # invalid entries, so the rest of the work is on a few hundred pixels per piece.
+        length = max(int(boundary.sum(axis=1).max()), 1)
+        pixels = np.argsort(~boundary, axis=1, kind='stable')[:, :length]
+        valid = np.take_along_axis(boundary, pixels, axis=1)
+
+        # Supporting line of the boundary in every direction, and how many pixels lie on it.
+        projected = np.where(valid[:, None, :], normal[:, pixels].transpose(1, 0, 2), -np.inf)
+        support = projected.max(axis=2)
+        on_edge = projected >= support[:, :, None] - EDGE_BAND
+        straightness = on_edge.sum(axis=2).astype(np.float32)
+        straightness[~valid.any(axis=1)] = 0
+
+        for e in range(NUM_EDGES):
+            best = straightness.argmax(axis=1)
+
+            # Positions, along the edge, of the pixels in the band of the edge.
+            band = on_edge[pieces, best] & valid
+            bins = np.floor(tangent[best[:, None], pixels] + PROFILE_LENGTH / 2.0).astype(np.int64)
+            bins = np.clip(bins, 0, PROFILE_LENGTH - 1)
+            profiles[(begin + pieces)[:, None].repeat(length, axis=1)[band], e, bins[band]] = 1
+
+            # Do not pick the same edge (or a direction close to it) twice.
+            distance = np.abs(angle_index[None, :] - best[:, None])
+            distance = np.minimum(distance, NUM_ANGLES - distance)
+            straightness[distance <= suppression] = -1
+
+    return profiles
+
+
+def edge_correlation(lock_profiles, key_profiles):
+    """
+    Scores pairs of pieces by the peak of the normalized cross correlation of their edge profiles,
+    over all shifts, both orientations of the key edge and all pairs of candidate edges.
+
+    :param lock_profiles: profiles of the locks, shape [num_pairs, NUM_EDGES, PROFILE_LENGTH]
+    :param key_profiles: profiles of the keys, shape [num_pairs, NUM_EDGES, PROFILE_LENGTH]
+    :return: scores in [0, 1], shape [num_pairs]
+    """
+    n = 2 * PROFILE_LENGTH
+    lock_profiles = lock_profiles[:, :, None, :]
+    key_profiles = key_profiles[:, None, :, :]
+
+    lock_fft = np.fft.rfft(lock_profiles, n)
+    correlation = np.fft.irfft(lock_fft * np.conj(np.fft.rfft(key_profiles, n)), n).max(axis=3)
+    flipped = np.fft.irfft(lock_fft * np.conj(np.fft.rfft(key_profiles[..., ::-1], n)), n).max(axis=3)
+
+    norm = np.sqrt((lock_profiles ** 2).sum(axis=3) * (key_profiles ** 2).sum(axis=3))
+    score = np.maximum(correlation, flipped) / np.maximum(norm, 1e-12)
+
+    return score.reshape(score.shape[0], -1).max(axis=1)
+
+
+def prefilter(locks, keys, threshold=FLAGS.PREFILTER_THRESHOLD):
+    """
+    Runs the prefilter on aligned pairs of pieces.
+
+    :param locks: lock halves, shape [num_pairs, height, width, 3]
+    :param keys: key halves, shape [num_pairs, height, width, 3]
+    :param threshold: pairs scoring below it are rejected
+    :return: the scores and a boolean array telling which pairs should go on to the network
+    """
+    scores = edge_correlation(edge_profiles(locks), edge_profiles(keys))
+
+    return scores, scores >= threshold
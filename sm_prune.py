@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Structured channel pruning of the convolutions of a trained model.
+
+1. The channels of every convolution of the towers (versions 1 and 2: input_L/conv, input_L/conv2
+   and the same for input_K; versions 0 and 3: conv1 and conv2) are ranked, either by the L1 norm
+   of their kernel ('magnitude', scaled by the batch normalization if any) or by their mean ReLU
+   activation over a sample of the eval set ('activation'). Dead channels come last with both.
+2. For every ratio of --keep_ratios, the lowest ranked channels are removed physically: the
+   kernels, biases and batch normalizations of the layer lose their output channels, and the next
+   convolution (or FC1) loses the matching inputs. The optimizer slots and moving averages of the
+   checkpoint are sliced the same way, and the learning rate schedule goes on from its global step.
+3. The thinner model is fine-tuned for --fine_tune_steps on the training set and saved in
+   --out_dir/keep_<percent>, next to channels.json, the FLAGS.CHANNELS it must be built with.
+4. The report gives, for the full model and every ratio, the FLOPs, the accuracy on the eval set
+   before and after fine-tuning and the latency, to pick the trade-off.
+
+Usage:
+    python sm_prune.py --checkpoint_dir=./MSHAPES_train --keep_ratios=0.75,0.5,0.25 --criterion=activation
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+
+import numpy as np
+from six.moves import xrange  # pylint: disable=redefined-builtin
+import tensorflow as tf
+
+import sm
+import sm_input
+from utils import time_runs
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_string('checkpoint_dir', './MSHAPES_train',
+                           """Directory where to read the model checkpoint.""")
+tf.app.flags.DEFINE_string('out_dir', './MSHAPES_pruned',
+                           """Directory where to write the pruned checkpoints.""")
+tf.app.flags.DEFINE_string('keep_ratios', '0.75,0.5,0.25',
+                           """Comma separated list of the fractions of channels to keep in every layer.""")
+tf.app.flags.DEFINE_string('criterion', 'activation',
+                           """How to rank the channels: 'magnitude' or 'activation'.""")
+tf.app.flags.DEFINE_integer('fine_tune_steps', 2000,
+                            """Number of training steps after pruning.""")
+tf.app.flags.DEFINE_integer('num_calibration', 512,
+                            """Number of eval pairs used to measure the activations.""")
+tf.app.flags.DEFINE_integer('num_examples', 2048,
+                            """Number of eval pairs used to measure the accuracy.""")
+tf.app.flags.DEFINE_integer('num_runs', 20,
+                            """Number of timed runs for the latency.""")
+tf.app.flags.DEFINE_string('report', './sm_prune.json',
+                           """Where to write the report.""")
+
+
+def prunable_chains():
+    """
+    Lists the prunable convolutions of the model of FLAGS.model_version.
+
+    :return: a list of chains, one per tower: the variable scopes of convolutions which feed each
+        other, in order. The last convolution of every chain feeds FC1, in the order of the chains.
+    """
+    if sm.FLAGS.EARLY_EXIT:
+        raise ValueError('Models with an early exit cannot be pruned')
+    if sm.FLAGS.model_version in (0, 3):
+        return [['conv1', 'conv2']]
+    if sm.FLAGS.model_version == 1 and sm.FLAGS.TOWER != 'standard':
+        raise ValueError('Only the standard towers can be pruned, not the %s ones' % sm.FLAGS.TOWER)
+
+    return [['input/%s/conv' % tower, 'input/%s/conv2' % tower] for tower in ('input_L', 'input_K')]
+
+
+def magnitude_scores(values, scope):
+    """
+    :param values: dictionary from variable names to values
+    :param scope: variable scope of a convolution
+    :return: the L1 norm of the kernel of every output channel, scaled by the batch normalization
+    """
+    scores = np.abs(values[scope + '/weights']).sum(axis=(0, 1, 2))
+    if scope + '/batch_norm/gamma' in values:
+        scores *= np.abs(values[scope + '/batch_norm/gamma']) / np.sqrt(
+            values[scope + '/batch_norm/moving_variance'] + sm.BATCH_NORM_EPSILON)
+
+    return scores
+
+
+def activation_scores(sess, images, scopes, locks, keys):
+    """
+    Measures the mean activation of every channel of the convolutions over a sample of pairs.
+
+    :param sess: session holding the restored model
+    :param images: the input placeholder
+    :param scopes: variable scopes of the convolutions
+    :param locks: lock halves of the sample
+    :param keys: key halves of the sample
+    :return: dictionary from scopes to the mean activation of every output channel
+    """
+    relu_ops = [op for op in tf.get_default_graph().get_operations() if op.type == 'Relu']
+    activations = []
+    for scope in scopes:
+        ops = [op for op in relu_ops if op.name.startswith(scope + '/')]
+        if len(ops) != 1:
+            raise ValueError('Expected one ReLU in %s, found %d' % (scope, len(ops)))
+        # Sum over the batch of the mean over the image.
+        activations.append(tf.reduce_sum(tf.reduce_mean(ops[0].outputs[0], axis=[1, 2]), axis=0))
+
+    sums = [0.0] * len(scopes)
+    for batch in sm_input.pair_batches(locks, keys, sm.FLAGS.batch_size):
+        sums = [s + v for s, v in zip(sums, sess.run(activations, feed_dict={images: batch}))]
+
+    return dict((scope, s / len(locks)) for scope, s in zip(scopes, sums))
+
+
+def _is_variable_or_slot(name, prefix):
+    """
+    :param name: name of a variable of the checkpoint
+    :param prefix: name of a variable, or of a variable scope
+    :return: whether name is the variable or one of its slots, which hold the variable's path as
+        components of their own: train_op/<variable>/Adam, train_op/<variable>/ExponentialMovingAverage,
+        train_op/accumulate/<variable>, ...
+    """
+    return ('/' + name + '/').find('/' + prefix + '/') >= 0
+
+
+def _take(values, prefix, indices, axis):
+    """Slices, in place, the variables named prefix (or under the scope prefix) and their slots along an axis."""
+    for name in values:
+        if _is_variable_or_slot(name, prefix):
+            values[name] = np.take(values[name], indices, axis=axis)
+
+
+def prune_values(values, chains, keep):
+    """
+    Removes channels from the values of a checkpoint.
+
+    :param values: dictionary from variable names to values, with the optimizer slots and moving averages
+    :param chains: the prunable convolutions, see prunable_chains()
+    :param keep: dictionary from the scopes of the convolutions to the indices of the channels to keep
+    :return: a new dictionary, with the pruned values
+    """
+    pruned = dict(values)
+    fc_inputs = []
+    offset = 0
+    for chain in chains:
+        for i, scope in enumerate(chain):
+            _take(pruned, scope + '/weights', keep[scope], axis=3)
+            _take(pruned, scope + '/biases', keep[scope], axis=0)
+            _take(pruned, scope + '/batch_norm', keep[scope], axis=0)
+            if i + 1 < len(chain):
+                _take(pruned, chain[i + 1] + '/weights', keep[scope], axis=2)
+
+        # The features of the last convolutions are concatenated along the channels, then flattened.
+        fc_inputs.append(keep[chain[-1]] + offset)
+        offset += values[chain[-1] + '/biases'].shape[0]
+
+    fc_inputs = np.concatenate(fc_inputs)
+    for name in values:
+        if _is_variable_or_slot(name, 'FC1/weights'):
+            units = values[name].shape[1]
+            pruned[name] = values[name].reshape([-1, offset, units])[:, fc_inputs, :].reshape([-1, units])
+
+    return pruned
+
+
+def load_values(sess, values):
+    """Loads the values into the variables of the default graph which have one."""
+    for var in tf.global_variables():
+        if var.op.name in values:
+            var.load(values[var.op.name], sess)
+
+
+def fine_tune(values, checkpoint_path):
+    """
+    Fine-tunes a pruned model on the training set, as sm_train.py does, and saves it.
+
+    :param values: the pruned values, with FLAGS.CHANNELS set accordingly
+    :param checkpoint_path: where to save the fine-tuned checkpoint
+    :return: the fine-tuned values
+    """
+    with tf.Graph().as_default():
+        global_step = tf.contrib.framework.get_or_create_global_step()
+        with tf.device('/cpu:0'):
+            images, labels = sm.inputs(eval_data=False)
+        logits = sm.inference(images, training=True)
+        loss = sm.loss(logits, labels)
+        train_op = sm.train(loss, global_step)
+
+        with tf.Session() as sess:
+            tf.global_variables_initializer().run()
+            load_values(sess, values)
+            tf.local_variables_initializer().run()
+
+            coord = tf.train.Coordinator()
+            threads = tf.train.start_queue_runners(coord=coord, sess=sess)
+            for i in xrange(FLAGS.fine_tune_steps):
+                _, loss_value = sess.run([train_op, loss])
+                if (i + 1) % sm.FLAGS.log_frequency == 0:
+                    print('fine-tuning step %d, loss = %.2f' % (i + 1, loss_value))
+            coord.request_stop()
+            coord.join(threads)
+
+            tf.train.Saver().save(sess, checkpoint_path)
+            return dict((v.op.name, sess.run(v)) for v in tf.global_variables())
+
+
+def evaluate(values, locks, keys, labels):
+    """
+    Measures a model on eval pairs.
+
+    :param values: list of dictionaries of values to evaluate, with the same FLAGS.CHANNELS
+    :return: the accuracy of every dictionary of values, the median latency of a FLAGS.batch_size
+        batch in seconds, and the FLOPs per example of the convolutional and FC layers
+    """
+    with tf.Graph().as_default():
+        images = sm.placeholder_inputs()
+        logits = sm.inference(images)
+        flops = sum(cost[1] for cost in tf.get_collection(sm.LAYER_COSTS))
+
+        accuracies = []
+        with tf.Session() as sess:
+            for v in values:
+                load_values(sess, v)
+                correct = [np.argmax(sess.run(logits, feed_dict={images: batch}), axis=1) == 1
+                           for batch in sm_input.pair_batches(locks, keys, sm.FLAGS.batch_size)]
+                accuracies.append(float(np.mean(np.concatenate(correct) == labels)))
+
+            batch = next(sm_input.pair_batches(locks, keys, sm.FLAGS.batch_size))
+            latency = np.median(time_runs(sess, logits, {images: batch}, FLAGS.num_runs))
+
+    return accuracies, latency, flops
+
+
+def main(argv=None):  # pylint: disable=unused-argument
+    if FLAGS.criterion not in ('magnitude', 'activation'):
+        raise ValueError('Unknown criterion: ' + FLAGS.criterion)
+    ckpt = tf.train.get_checkpoint_state(FLAGS.checkpoint_dir)
+    if not (ckpt and ckpt.model_checkpoint_path):
+        raise ValueError('No checkpoint file found in ' + FLAGS.checkpoint_dir)
+    if sm.FLAGS.CHANNELS:
+        raise ValueError('The model to prune must be built with its full depths, set CHANNELS = {} in FLAGS.py')
+
+    chains = prunable_chains()
+    scopes = [scope for chain in chains for scope in chain]
+    reader = tf.train.NewCheckpointReader(ckpt.model_checkpoint_path)
+    values = dict((name, reader.get_tensor(name)) for name in reader.get_variable_to_shape_map())
+
+    print('Loading eval pairs...')
+    data_dir = os.path.join(sm.FLAGS.data_dir, '')
+    calibration_locks, calibration_keys, _ = sm_input.eval_pairs(data_dir, 0, FLAGS.num_calibration)
+    locks, keys, labels = sm_input.eval_pairs(data_dir, FLAGS.num_calibration, FLAGS.num_examples)
+    print('Done.')
+
+    if FLAGS.criterion == 'magnitude':
+        scores = dict((scope, magnitude_scores(values, scope)) for scope in scopes)
+    else:
+        with tf.Graph().as_default():
+            images = sm.placeholder_inputs()
+            sm.inference(images)
+            with tf.Session() as sess:
+                tf.train.Saver().restore(sess, ckpt.model_checkpoint_path)
+                scores = activation_scores(sess, images, scopes, calibration_locks, calibration_keys)
+    for scope in scopes:
+        print('%s: %d of %d channels are dead' % (scope, np.sum(scores[scope] == 0), scores[scope].size))
+
+    (accuracy,), full_latency, full_flops = evaluate([values], locks, keys, labels)
+    rows = [{'keep_ratio': 1.0, 'channels': dict((scope, int(scores[scope].size)) for scope in scopes),
+             'mflops': full_flops / 1e6, 'accuracy_pruned': accuracy, 'accuracy_fine_tuned': accuracy,
+             'latency_ms': 1e3 * full_latency, 'speedup': 1.0, 'checkpoint': ckpt.model_checkpoint_path}]
+
+    for keep_ratio in [float(r) for r in FLAGS.keep_ratios.split(',')]:
+        # The channels with the highest scores are kept, in their original order.
+        keep = {}
+        for scope in scopes:
+            num_channels = max(int(round(keep_ratio * scores[scope].size)), 1)
+            keep[scope] = np.sort(np.argsort(-scores[scope])[:num_channels])
+        sm.FLAGS.CHANNELS = dict((scope, len(keep[scope])) for scope in scopes)
+        pruned = prune_values(values, chains, keep)
+
+        out_dir = os.path.join(FLAGS.out_dir, 'keep_%d' % round(100 * keep_ratio))
+        if not tf.gfile.Exists(out_dir):
+            tf.gfile.MakeDirs(out_dir)
+        fine_tuned = fine_tune(pruned, os.path.join(out_dir, 'MSHAPES_train'))
+        with open(os.path.join(out_dir, 'channels.json'), 'w') as f:
+            json.dump(sm.FLAGS.CHANNELS, f, indent=2, sort_keys=True)
+
+        (accuracy_pruned, accuracy_fine_tuned), latency, flops = evaluate([pruned, fine_tuned], locks, keys, labels)
+        rows.append({'keep_ratio': keep_ratio, 'channels': sm.FLAGS.CHANNELS, 'mflops': flops / 1e6,
+                     'accuracy_pruned': accuracy_pruned, 'accuracy_fine_tuned': accuracy_fine_tuned,
+                     'latency_ms': 1e3 * latency, 'speedup': full_latency / latency, 'checkpoint': out_dir})
+    sm.FLAGS.CHANNELS = {}
+
+    print('%-6s %10s %10s %12s %12s %8s' % ('keep', 'MFLOPs', 'ms/batch', 'acc. pruned', 'fine-tuned', 'speedup'))
+    for row in rows:
+        print('%-6.2f %10.2f %10.2f %12.4f %12.4f %8.2f' % (row['keep_ratio'], row['mflops'], row['latency_ms'],
+                                                            row['accuracy_pruned'], row['accuracy_fine_tuned'],
+                                                            row['speedup']))
+    print('To use a pruned checkpoint, set CHANNELS in FLAGS.py to the channels.json next to it.')
+
+    with open(FLAGS.report, 'w') as f:
+        json.dump({'model_version': sm.FLAGS.model_version, 'criterion': FLAGS.criterion,
+                   'num_examples': int(labels.size), 'batch_size': sm.FLAGS.batch_size,
+                   'fine_tune_steps': FLAGS.fine_tune_steps, 'models': rows}, f, indent=2)
+
+
+if __name__ == '__main__':
+    tf.app.run()
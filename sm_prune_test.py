@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests of the channel pruning (sm_prune.py) on the variables of a real training graph."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import tensorflow as tf
+
+import sm
+import sm_prune
+
+# FLAGS constants the tests change.
+SETTINGS = ['model_version', 'NORMALIZATION', 'TOWER', 'EARLY_EXIT', 'ACCUMULATION_STEPS', 'CHANNELS', 'use_fp16']
+
+
+class PruneTest(tf.test.TestCase):
+
+    def setUp(self):
+        self._settings = dict((name, getattr(sm.FLAGS, name)) for name in SETTINGS)
+        sm.FLAGS.NORMALIZATION = 'batch_norm'
+        sm.FLAGS.TOWER = 'standard'
+        sm.FLAGS.EARLY_EXIT = False
+        # Adds the gradient accumulators to the Adam slots and moving averages.
+        sm.FLAGS.ACCUMULATION_STEPS = 2
+        sm.FLAGS.CHANNELS = {}
+        sm.FLAGS.use_fp16 = False
+
+    def tearDown(self):
+        for name, value in self._settings.items():
+            setattr(sm.FLAGS, name, value)
+
+    @staticmethod
+    def _build_train_graph():
+        global_step = tf.contrib.framework.get_or_create_global_step()
+        images = sm.placeholder_inputs()
+        labels = tf.placeholder(tf.int32, [None], name='labels')
+        sm.train(sm.loss(sm.inference(images, training=True), labels), global_step)
+
+    def _check_pruning(self, model_version):
+        sm.FLAGS.model_version = model_version
+        with tf.Graph().as_default():
+            self._build_train_graph()
+            values = dict((v.op.name, np.random.rand(*v.get_shape().as_list()).astype(v.dtype.as_numpy_dtype))
+                          for v in tf.global_variables())
+
+        chains = sm_prune.prunable_chains()
+        keep = {}
+        for chain in chains:
+            for scope in chain:
+                depth = values[scope + '/weights'].shape[3]
+                keep[scope] = np.arange(0, depth, 2)
+        pruned = sm_prune.prune_values(values, chains, keep)
+
+        # Every slot of a pruned variable is pruned with it.
+        for scope in keep:
+            slots = [name for name in values if name.startswith('train_op/') and scope + '/weights' in name]
+            self.assertGreaterEqual(len(slots), 4, slots)
+
+        sm.FLAGS.CHANNELS = dict((scope, len(indices)) for scope, indices in keep.items())
+        with tf.Graph().as_default():
+            self._build_train_graph()
+            variables = tf.global_variables()
+            self.assertEqual(sorted(v.op.name for v in variables), sorted(pruned))
+            for var in variables:
+                self.assertEqual(var.get_shape().as_list(), list(pruned[var.op.name].shape), var.op.name)
+
+            with self.test_session() as sess:
+                sess.run(tf.global_variables_initializer())
+                sm_prune.load_values(sess, pruned)
+
+    def testVersion0(self):
+        self._check_pruning(0)
+
+    def testVersion1(self):
+        self._check_pruning(1)
+
+
+if __name__ == '__main__':
+    tf.test.main()
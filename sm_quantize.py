@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Post-training 8-bit quantization of a sm_train checkpoint for CPU inference.
+
+1. The float model is restored and run on a calibration sample of the eval set, recording the
+   range of the inputs of every convolutional and fully connected layer (sm.LAYER_INPUTS).
+2. The model is rebuilt with FLAGS.QUANTIZE, where these layers run in 8 bits
+   (sm._quantized_conv2d), and the calibrated ranges are written into its QUANTIZATION_RANGES
+   variables. The kernels are quantized once, here, into the uint8 variables of QUANTIZED_KERNELS,
+   which replace the float kernels. The result is saved as a new checkpoint in --out_dir.
+3. Both models are evaluated on another slice of the eval set; the accuracy delta, the latency
+   and the size of the checkpoint of the variables of each model, as written on disk, are reported,
+   so the float or the int8 model can be chosen per deployment.
+
+To serve the int8 checkpoint, set QUANTIZE = True in FLAGS.py. It cannot be trained.
+
+Usage:
+    python sm_quantize.py --checkpoint_dir=./MSHAPES_train --out_dir=./MSHAPES_int8
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+
+import sm
+import sm_input
+from utils import time_runs
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_string('checkpoint_dir', './MSHAPES_train',
+                           """Directory where to read the float model checkpoint.""")
+tf.app.flags.DEFINE_string('out_dir', './MSHAPES_int8',
+                           """Directory where to write the int8 model checkpoint.""")
+tf.app.flags.DEFINE_integer('num_calibration', 512,
+                            """Number of eval pairs used to calibrate the activation ranges.""")
+tf.app.flags.DEFINE_integer('num_examples', 2048,
+                            """Number of eval pairs used to compare the models.""")
+tf.app.flags.DEFINE_integer('num_runs', 20,
+                            """Number of timed runs for the latency.""")
+tf.app.flags.DEFINE_string('report', './sm_quantize.json',
+                           """Where to write the report.""")
+
+
+def evaluate(sess, images, logits, locks, keys, labels):
+    """
+    Measures the accuracy and the latency of a model.
+
+    :return: accuracy, and median latency of a FLAGS.batch_size batch in seconds
+    """
+    correct = []
+    for batch in sm_input.pair_batches(locks, keys, sm.FLAGS.batch_size):
+        correct.append(np.argmax(sess.run(logits, feed_dict={images: batch}), axis=1) == 1)
+    accuracy = np.mean(np.concatenate(correct) == labels)
+
+    batch = next(sm_input.pair_batches(locks, keys, sm.FLAGS.batch_size))
+    latency = np.median(time_runs(sess, logits, {images: batch}, FLAGS.num_runs))
+
+    return accuracy, latency
+
+
+def calibrate(sess, images, locks, keys):
+    """
+    Records the range of the inputs of every layer over the calibration sample.
+
+    :return: a [num_layers, 2] array of [min, max]
+    """
+    layer_inputs = tf.get_collection(sm.LAYER_INPUTS)
+    ranges = np.array([[np.inf, -np.inf]] * len(layer_inputs))
+
+    for batch in sm_input.pair_batches(locks, keys, sm.FLAGS.batch_size):
+        values = sess.run(layer_inputs, feed_dict={images: batch})
+        ranges[:, 0] = np.minimum(ranges[:, 0], [v.min() for v in values])
+        ranges[:, 1] = np.maximum(ranges[:, 1], [v.max() for v in values])
+
+    # Quantized ranges must contain 0 and must not be empty.
+    ranges[:, 0] = np.minimum(ranges[:, 0], 0.0)
+    ranges[:, 1] = np.maximum(ranges[:, 1], ranges[:, 0] + 1e-6)
+
+    return ranges
+
+
+def quantize_kernel(kernel):
+    """
+    Quantizes a float kernel to quint8 as tf.quantize_v2 (MIN_COMBINED) does over the kernel's range.
+
+    :param kernel: float array
+    :return: the uint8 array, and the float min and max of the range
+    """
+    kernel_min = min(float(kernel.min()), 0.0)
+    epsilon = max(1.0, abs(float(kernel.min())), abs(float(kernel.max()))) / 100.0
+    kernel_max = max(float(kernel.max()), kernel_min + epsilon, 0.0)
+    scale = 255.0 / (kernel_max - kernel_min)
+    quantized = np.clip(np.round((kernel - kernel_min) * scale), 0, 255).astype(np.uint8)
+
+    return quantized, kernel_min, kernel_max
+
+
+def checkpoint_bytes(checkpoint_path):
+    """
+    :param checkpoint_path: the prefix of a checkpoint
+    :return: the size on disk of its data and index files
+    """
+    return sum(tf.gfile.Stat(f).length for f in tf.gfile.Glob(checkpoint_path + '.*')
+               if not f.endswith('.meta'))
+
+
+def main(argv=None):  # pylint: disable=unused-argument
+    ckpt = tf.train.get_checkpoint_state(FLAGS.checkpoint_dir)
+    if not (ckpt and ckpt.model_checkpoint_path):
+        raise ValueError('No checkpoint file found in ' + FLAGS.checkpoint_dir)
+
+    print('Loading eval pairs...')
+    data_dir = os.path.join(sm.FLAGS.data_dir, '')
+    calibration_locks, calibration_keys, _ = sm_input.eval_pairs(data_dir, 0, FLAGS.num_calibration)
+    locks, keys, labels = sm_input.eval_pairs(data_dir, FLAGS.num_calibration, FLAGS.num_examples)
+    print('Done.')
+
+    # Float model: calibration and reference.
+    sm.FLAGS.QUANTIZE = False
+    with tf.Graph().as_default():
+        images = sm.placeholder_inputs()
+        logits = sm.inference(images)
+        with tf.Session() as sess:
+            saver = tf.train.Saver()
+            saver.restore(sess, ckpt.model_checkpoint_path)
+            ranges = calibrate(sess, images, calibration_locks, calibration_keys)
+            float_accuracy, float_latency = evaluate(sess, images, logits, locks, keys, labels)
+
+            # The training checkpoint also holds the optimizer's slots: the variables of the
+            # inference graph are saved alone to be measured.
+            tmp_dir = tempfile.mkdtemp()
+            try:
+                float_bytes = checkpoint_bytes(saver.save(sess, os.path.join(tmp_dir, 'MSHAPES_float'),
+                                                          write_meta_graph=False))
+            finally:
+                shutil.rmtree(tmp_dir)
+
+    # Int8 model.
+    sm.FLAGS.QUANTIZE = True
+    with tf.Graph().as_default():
+        images = sm.placeholder_inputs()
+        logits = sm.inference(images)
+        range_vars = tf.get_collection(sm.QUANTIZATION_RANGES)
+        assert len(range_vars) == 2 * len(ranges), 'float and int8 graphs have different layers'
+        kernel_vars = tf.get_collection(sm.QUANTIZED_KERNELS)
+
+        float_vars = [v for v in tf.global_variables() if v not in range_vars and v not in kernel_vars]
+        reader = tf.train.NewCheckpointReader(ckpt.model_checkpoint_path)
+        with tf.Session() as sess:
+            tf.train.Saver(var_list=float_vars).restore(sess, ckpt.model_checkpoint_path)
+            for var, value in zip(range_vars, ranges.reshape(-1)):
+                var.load(value, sess)
+            for i in range(0, len(kernel_vars), 4):
+                float_kernel, q_kernel, kernel_min, kernel_max = kernel_vars[i:i + 4]
+                quantized, min_value, max_value = quantize_kernel(reader.get_tensor(float_kernel.op.name))
+                q_kernel.load(quantized, sess)
+                kernel_min.load(min_value, sess)
+                kernel_max.load(max_value, sess)
+            int8_accuracy, int8_latency = evaluate(sess, images, logits, locks, keys, labels)
+
+            if not tf.gfile.Exists(FLAGS.out_dir):
+                tf.gfile.MakeDirs(FLAGS.out_dir)
+            int8_bytes = checkpoint_bytes(tf.train.Saver().save(sess, os.path.join(FLAGS.out_dir, 'MSHAPES_int8')))
+
+    report = {
+        'model_version': sm.FLAGS.model_version,
+        'num_examples': int(labels.size),
+        'batch_size': sm.FLAGS.batch_size,
+        'float': {'accuracy': float_accuracy, 'latency_ms': 1e3 * float_latency, 'checkpoint_bytes': float_bytes},
+        'int8': {'accuracy': int8_accuracy, 'latency_ms': 1e3 * int8_latency, 'checkpoint_bytes': int8_bytes},
+        'accuracy_delta': int8_accuracy - float_accuracy,
+        'speedup': float_latency / int8_latency,
+        'layer_ranges': ranges.tolist(),
+    }
+
+    print('float: accuracy = %.4f, %.2f ms/batch, %.2f MB checkpoint' %
+          (float_accuracy, 1e3 * float_latency, float_bytes / 2.0 ** 20))
+    print('int8:  accuracy = %.4f, %.2f ms/batch, %.2f MB checkpoint' %
+          (int8_accuracy, 1e3 * int8_latency, int8_bytes / 2.0 ** 20))
+    print('accuracy delta = %+.4f, speedup = x%.2f' % (report['accuracy_delta'], report['speedup']))
+
+    with open(FLAGS.report, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    tf.app.run()
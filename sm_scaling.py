@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Scaling efficiency of synchronous data-parallel training (FLAGS.NUM_REPLICAS) from 1 to N replicas.
+
+For every number of replicas of --replicas, the training graph of sm_train.py is built (without the
+graph cache) and trained for --num_steps steps on the training set, from scratch, after
+--num_warmup untimed steps. The throughput is the number of training examples per second over all
+the replicas, and the efficiency of N replicas is their throughput over N times the throughput of
+one replica. The other training constants are taken from FLAGS.py.
+
+The replicas are CPU devices of one process and share its thread pools, which are not pinned to
+sockets: this measures the scaling over the cores the process runs on, not the scaling over sockets
+(see the README), as the report states.
+
+Usage:
+    python sm_scaling.py --replicas=1,2,4 --num_steps=50 --out=./sm_scaling
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import csv
+import json
+
+import numpy as np
+import tensorflow as tf
+
+import sm
+import sm_train
+from utils import time_runs
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_string('replicas', '1,2,4',
+                           """Comma separated list of the numbers of replicas to measure.""")
+tf.app.flags.DEFINE_integer('num_steps', 50,
+                            """Number of timed training steps per number of replicas.""")
+tf.app.flags.DEFINE_integer('num_warmup', 5,
+                            """Number of training steps before timing.""")
+tf.app.flags.DEFINE_string('out', './sm_scaling',
+                           """Prefix of the .json and .csv files to write.""")
+
+COLUMNS = ['num_replicas', 'batch_size', 'global_batch_size', 'sec_per_step', 'examples_per_sec',
+           'speedup', 'efficiency']
+
+# Written with the results, which do not measure socket scaling.
+NOTE = ('The replicas share the thread pools of one process, which are not pinned to sockets: this is the '
+        'scaling over the cores of the process, not over sockets.')
+
+
+def measure(num_replicas):
+    """
+    Trains with a number of replicas and times the steps.
+
+    :param num_replicas: FLAGS.NUM_REPLICAS
+    :return: the median duration of a training step, in seconds (a run of the train op goes through
+        STEPS_PER_FETCH steps)
+    """
+    sm.FLAGS.NUM_REPLICAS = num_replicas
+
+    with tf.Graph().as_default():
+        fetches, _ = sm_train.build_train_graph()
+        with tf.Session(config=sm_train.session_config()) as sess:
+            sess.run(tf.global_variables_initializer())
+            sess.run(tf.local_variables_initializer())
+            coord = tf.train.Coordinator()
+            threads = tf.train.start_queue_runners(coord=coord, sess=sess)
+
+            durations = time_runs(sess, fetches['train_op'], num_runs=FLAGS.num_steps, num_warmup=FLAGS.num_warmup)
+
+            coord.request_stop()
+            coord.join(threads, stop_grace_period_secs=10)
+
+    return np.median(durations) / sm.FLAGS.STEPS_PER_FETCH
+
+
+def main(argv=None):  # pylint: disable=unused-argument
+    if sm.FLAGS.DISTILL_FROM:
+        raise ValueError('Measure the scaling without distillation, set DISTILL_FROM = \'\' in FLAGS.py')
+    replicas = [int(n) for n in FLAGS.replicas.split(',')]
+    if replicas[0] != 1:
+        replicas.insert(0, 1)
+
+    rows = []
+    for num_replicas in replicas:
+        sec_per_step = measure(num_replicas)
+        examples_per_sec = num_replicas * sm.FLAGS.batch_size / sec_per_step
+        base = rows[0]['examples_per_sec'] if rows else examples_per_sec
+        rows.append({
+            'num_replicas': num_replicas,
+            'batch_size': sm.FLAGS.batch_size,
+            'global_batch_size': num_replicas * sm.FLAGS.batch_size,
+            'sec_per_step': sec_per_step,
+            'examples_per_sec': examples_per_sec,
+            'speedup': examples_per_sec / base,
+            'efficiency': examples_per_sec / (num_replicas * base),
+        })
+        print('%d replica(s): %.3f sec/step, %.1f examples/sec' % (num_replicas, sec_per_step, examples_per_sec))
+
+    with open(FLAGS.out + '.json', 'w') as f:
+        json.dump({'note': NOTE, 'rows': rows}, f, indent=2)
+    with open(FLAGS.out + '.csv', 'w') as f:
+        writer = csv.DictWriter(f, COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    print('%-9s %14s %9s %11s' % ('replicas', 'examples/sec', 'speedup', 'efficiency'))
+    for row in rows:
+        print('%-9d %14.1f %9.2f %10.1f%%' % (row['num_replicas'], row['examples_per_sec'], row['speedup'],
+                                               100 * row['efficiency']))
+    print(NOTE)
+    print('Wrote %s.json and %s.csv' % (FLAGS.out, FLAGS.out))
+
+
+if __name__ == '__main__':
+    tf.app.run()
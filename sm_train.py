@@ -10,71 +10,435 @@ from __future__ import division
 from __future__ import print_function
 
 import base64
+import json
+import os
+import signal
+import threading
 import time
 from datetime import datetime
 
+from six.moves import queue
+from six.moves import xrange  # pylint: disable=redefined-builtin
 import tensorflow as tf
 import numpy as np
 
+import checkpointing
+import graph_cache
+import memory_monitor
+import metrics
 import sm
+import step_profiler
+import thread_config
 from utils import *
 
 
-def train():
-    with tf.Graph().as_default():
+def cluster_task():
+    """
+    Reads the cluster of asynchronous training and the task of this process from the TF_CONFIG
+    environment variable, e.g. {"cluster": {"ps": ["localhost:2222"], "worker": ["localhost:2223",
+    "localhost:2224"]}, "task": {"type": "worker", "index": 0}}, as set by sm_cluster.py.
+
+    :return: the tf.train.ClusterSpec, the job name ('ps' or 'worker') and the task index, or None,
+        None and 0 when training in a single process
+    """
+    tf_config = json.loads(os.environ.get('TF_CONFIG', '{}'))
+    if not tf_config.get('cluster'):
+        return None, None, 0
+
+    return tf.train.ClusterSpec(tf_config['cluster']), tf_config['task']['type'], int(tf_config['task']['index'])
+
+
+def replica_loss(dequeue, input_device='/cpu:0'):
+    """
+    Builds the model and the loss of one replica, on the next batch of its input pipeline.
+
+    :param dequeue: the function dequeuing a batch of the replica, see sm.input_pipeline()
+    :param input_device: (optional) the device of the input pipeline
+    :return: the loss, and the Saver of the teacher with distillation (None otherwise)
+    """
+    with tf.device(input_device):
+        images, labels = dequeue()
+
+    # Build a Graph that computes the logits predictions from the
+    # inference model.
+    logits = sm.inference(images, training=True)
+
+    # Calculate loss. With distillation, the teacher scores the same batch.
+    if FLAGS.DISTILL_FROM:
+        teacher_logits, teacher_saver = sm.teacher_inference(images)
+        return sm.distillation_loss(logits, labels, teacher_logits), teacher_saver
+
+    return sm.loss(logits, labels), None
+
+
+def session_config():
+    """
+    :return: the tf.ConfigProto of the training session, with one CPU device per replica and the
+        thread pools of FLAGS.THREAD_CONFIG
+    """
+    return thread_config.session_config('train', device_count={'CPU': FLAGS.NUM_REPLICAS},
+                                        allow_soft_placement=True,
+                                        log_device_placement=FLAGS.log_device_placement)
+
+
+def build_train_graph(cluster=None, task_index=0):
+    """
+    Builds the training graph in the default graph, see graph_cache.load_or_build().
+
+    :param cluster: (optional) the tf.train.ClusterSpec of asynchronous training: the variables are
+        then placed on the parameter servers, and the rest of the graph on this worker
+    :param task_index: (optional) the index of this worker in the cluster
+    :return: the train op, which runs FLAGS.STEPS_PER_FETCH steps, the mean loss since the last reset
+        and the op resetting it (which also runs the train op), the global step, the summary op and
+        the snapshot op of the checkpoints by name, and the savers of the model, of its checkpoints
+        (see checkpointing.snapshot()) and, with distillation, of the teacher
+    """
+    if FLAGS.STEPS_PER_FETCH > 1 and FLAGS.DISTILL_FROM:
+        raise ValueError('The teacher of distillation cannot be built in the loop of STEPS_PER_FETCH > 1 steps')
+    num_workers = cluster.num_tasks('worker') if cluster else 1
+    num_shards = num_workers * FLAGS.NUM_REPLICAS
+    device = tf.train.replica_device_setter(worker_device='/job:worker/task:%d' % task_index,
+                                            cluster=cluster) if cluster else None
+
+    with tf.device(device):
         global_step = tf.contrib.framework.get_or_create_global_step()
 
-        with tf.device('/cpu:0'):
-            images, labels = sm.inputs(eval_data=False)
-
-        # Build a Graph that computes the logits predictions from the
-        # inference model.
-        logits = sm.inference(images)
-
-        # Calculate loss.
-        loss = sm.loss(logits, labels)
+        # The input pipeline of every replica, which reads its own shard.
+        pipelines = []
+        for i in xrange(FLAGS.NUM_REPLICAS):
+            with tf.device('/cpu:%d' % i):
+                pipelines.append(sm.input_pipeline(eval_data=False, shard=task_index * FLAGS.NUM_REPLICAS + i,
+                                                   num_shards=num_shards))
+
+        def build_replica_losses():
+            if FLAGS.NUM_REPLICAS == 1:
+                loss, teacher_saver = replica_loss(pipelines[0])
+                return [loss], teacher_saver
+
+            # Synchronous data parallelism: one replica per CPU device (see session_config()); the
+            # variables are shared and stay on /cpu:0. The devices share the thread pools of the
+            # process: the replicas are not placed on NUMA nodes.
+            replica_losses = []
+            for i in xrange(FLAGS.NUM_REPLICAS):
+                with tf.device('/cpu:%d' % i), tf.name_scope('%s_%d' % (sm.TOWER_NAME, i)):
+                    with tf.variable_scope(tf.get_variable_scope(), reuse=i > 0):
+                        replica, replica_teacher_saver = replica_loss(pipelines[i], input_device='/cpu:%d' % i)
+                replica_losses.append(replica)
+                if i == 0:
+                    teacher_saver = replica_teacher_saver
+            return replica_losses, teacher_saver
+
+        replica_losses, teacher_saver = build_replica_losses()
+        loss = tf.add_n(replica_losses) / FLAGS.NUM_REPLICAS if FLAGS.NUM_REPLICAS > 1 else replica_losses[0]
         tf.summary.scalar('loss', loss)
 
-        # Build a Graph that trains the model with one batch of examples and
-        # updates the model parameters.
-        train_op = sm.train(loss, global_step)
-
-        saver = tf.train.Saver(var_list=(tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)))
-        summary_op_merged = tf.summary.merge_all()
+        # Build a Graph that trains the model with one batch of examples per replica and
+        # updates the model parameters. In a cluster, every worker applies its own updates
+        # asynchronously. With STEPS_PER_FETCH > 1, the train op runs that many steps in a loop.
+        if FLAGS.STEPS_PER_FETCH > 1:
+            run_loss = sm.train_loop(replica_losses, lambda: build_replica_losses()[0], global_step,
+                                     FLAGS.STEPS_PER_FETCH)
+            train_op = run_loss.op
+        else:
+            train_op = sm.train_replicas(replica_losses, global_step)
+            run_loss = loss
+
+    # The train op also sums the loss of its steps in the graph, whose mean is only fetched on logging
+    # steps. The sum is local to the worker.
+    with tf.device('/job:worker/task:%d' % task_index if cluster else None):
+        with tf.variable_scope('train_loss'):
+            loss_sum = tf.get_variable('sum', [], loss.dtype, initializer=tf.zeros_initializer(), trainable=False,
+                                       collections=[tf.GraphKeys.LOCAL_VARIABLES])
+            loss_count = tf.get_variable('count', [], loss.dtype, initializer=tf.zeros_initializer(),
+                                         trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES])
+        with tf.control_dependencies([train_op]):
+            train_step = tf.group(tf.assign_add(loss_sum, run_loss),
+                                  tf.assign_add(loss_count, float(FLAGS.STEPS_PER_FETCH)))
+        with tf.control_dependencies([train_step]):
+            mean_loss = tf.identity(loss_sum) / tf.maximum(tf.identity(loss_count), 1.0)
+        with tf.control_dependencies([mean_loss]):
+            reset_loss = tf.group(tf.assign(loss_sum, 0.0), tf.assign(loss_count, 0.0))
+
+    # The teacher, if any, is not saved with the student. In a cluster, every parameter server
+    # saves its own variables.
+    var_list = [v for v in tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
+                if not v.op.name.startswith(sm.TEACHER_SCOPE + '/')]
+    snapshot_op, snapshot_saver = checkpointing.snapshot(var_list, max_to_keep=FLAGS.KEEP_CHECKPOINTS,
+                                                         sharded=cluster is not None)
+    savers = [tf.train.Saver(var_list=var_list, sharded=cluster is not None), snapshot_saver]
+    if FLAGS.DISTILL_FROM:
+        savers.append(teacher_saver)
+
+    return {'train_op': train_step, 'mean_loss': mean_loss, 'reset_loss': reset_loss, 'global_step': global_step,
+            'summary_op': tf.summary.merge_all(), 'snapshot_op': snapshot_op}, savers
+
+
+class AsyncSummaryWriter(object):
+    """Writes serialized summaries from a background thread, so that parsing and writing them does
+    not hold up the training loop."""
+
+    def __init__(self, writer, max_queue=16):
+        """
+        :param writer: the tf.summary.FileWriter to write to
+        :param max_queue: (optional) number of summaries waiting to be written before add_summary() blocks
+        """
+        self._writer = writer
+        self._queue = queue.Queue(max_queue)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add_summary(self, summary_str, global_step):
+        self._queue.put((summary_str, global_step))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            self._writer.add_summary(*item)
+
+    def close(self):
+        """Writes the remaining summaries and closes the writer."""
+        self._queue.put(None)
+        self._thread.join()
+        self._writer.close()
+
+
+class PreemptionHandler(object):
+    """Turns a SIGTERM into a request to stop training, which leaves a deadline to write a final
+    checkpoint before the process is killed."""
+
+    def __init__(self, deadline_secs):
+        """
+        :param deadline_secs: number of seconds between the SIGTERM and the kill
+        """
+        self.deadline_secs = deadline_secs
+        self.signal_time = None
+        signal.signal(signal.SIGTERM, self._handle)
+
+    def _handle(self, signum, frame):  # pylint: disable=unused-argument
+        self.signal_time = time.time()
+        print('%s: SIGTERM received, writing a final checkpoint within %d sec' %
+              (datetime.now(), self.deadline_secs))
+
+    @property
+    def preempted(self):
+        return self.signal_time is not None
+
+    def remaining_secs(self):
+        """:return: the number of seconds left before the kill"""
+        return max(0.0, self.signal_time + self.deadline_secs - time.time())
+
+
+def start_metrics(sess, queues, checkpointer, task_index=0):
+    """
+    Exports the live metrics of the training, see FLAGS.METRICS_PORT and FLAGS.METRICS_FILE. The
+    training loop sets the step, the loss and the throughput; the depths of the input queues and the
+    latencies of the checkpoints are collected when the metrics are exported.
+
+    :param sess: the training session
+    :param queues: the queues of its graph, see memory_monitor.queue_sizes()
+    :param checkpointer: the checkpointing.AsyncCheckpointer, or None if this worker does not save
+    :param task_index: (optional) the index of this worker in a cluster
+    :return: the metrics.Registry, or None if the metrics are not exported
+    """
+    if not FLAGS.METRICS_PORT and not FLAGS.METRICS_FILE:
+        return None
+
+    registry = metrics.Registry()
+    registry.describe('sm_train_global_step', 'Global step of the training.')
+    registry.describe('sm_train_loss', 'Mean training loss of the last fetch.')
+    registry.describe('sm_train_examples_total', 'Training examples processed by this worker.', 'counter')
+    registry.describe('sm_train_examples_per_second', 'Training examples per second over the last logging period.')
+    registry.describe('sm_train_input_queue_elements', 'Elements in the input queue.')
+    registry.describe('sm_train_input_queue_capacity', 'Capacity of the input queue.')
+    registry.describe('sm_train_checkpoint_snapshot_seconds', 'Duration of the last checkpoint snapshot.')
+    registry.describe('sm_train_checkpoint_save_seconds', 'Duration of the last checkpoint save, in the background.')
+
+    def collect():
+        samples = []
+        sizes = sess.run([size for _, size, _, _ in queues]) if queues else []
+        for (name, _, _, capacity), elements in zip(queues, sizes):
+            samples.append(('sm_train_input_queue_elements', elements, {'queue': name}))
+            samples.append(('sm_train_input_queue_capacity', capacity, {'queue': name}))
+        if checkpointer is not None and checkpointer.save_secs is not None:
+            samples.append(('sm_train_checkpoint_snapshot_seconds', checkpointer.snapshot_secs, None))
+            samples.append(('sm_train_checkpoint_save_seconds', checkpointer.save_secs, None))
+        return samples
+
+    registry.add_collector(collect)
+    if FLAGS.METRICS_PORT:
+        registry.serve(FLAGS.METRICS_PORT + task_index)
+    if FLAGS.METRICS_FILE:
+        root, ext = os.path.splitext(FLAGS.METRICS_FILE)
+        registry.write_periodically(root + ('-worker%d' % task_index if task_index else '') + ext,
+                                    FLAGS.METRICS_FILE_SECS)
+
+    return registry
+
+
+def initialize(sess, savers):
+    """
+    Initializes the variables of the training graph: the student from the latest checkpoint of
+    train_dir if there is one (the training resumes, or in a cluster the parameter servers
+    restarted), else from RESTORE_FROM if set, else from scratch; and the teacher from its
+    checkpoint.
+
+    :param sess: the session
+    :param savers: the savers of build_train_graph()
+    """
+    sess.run(tf.global_variables_initializer())
+
+    ckpt = tf.train.get_checkpoint_state(FLAGS.train_dir)
+    if ckpt and ckpt.model_checkpoint_path:
+        checkpoint_path = ckpt.model_checkpoint_path
+    else:
+        checkpoint_path = FLAGS.RESTORE_FROM if FLAGS.RESTORE else ''
+    if checkpoint_path:
+        print('Resuming from ' + checkpoint_path)
+        savers[0].restore(sess, checkpoint_path)
+
+    if FLAGS.DISTILL_FROM:
+        teacher_ckpt = tf.train.get_checkpoint_state(FLAGS.DISTILL_FROM)
+        if not (teacher_ckpt and teacher_ckpt.model_checkpoint_path):
+            raise ValueError('No teacher checkpoint file found in ' + FLAGS.DISTILL_FROM)
+        savers[2].restore(sess, teacher_ckpt.model_checkpoint_path)
+
+
+def train(cluster=None, server=None, task_index=0):
+    """
+    Trains the model in this process, or as a worker of asynchronous training in a cluster.
+
+    :param cluster: (optional) the tf.train.ClusterSpec, see cluster_task()
+    :param server: (optional) the tf.train.Server of this worker
+    :param task_index: (optional) the index of this worker. Worker 0 is the chief: it initializes the
+        variables, unless they already are (the worker restarted), and writes the checkpoints and
+        the summaries. The other workers wait for the variables to be initialized.
+    :return: whether the training stopped on a SIGTERM
+    """
+    is_chief = task_index == 0
+    preemption = PreemptionHandler(FLAGS.PREEMPTION_DEADLINE_SECS)
+    kind = 'train' if cluster is None else 'train-worker%d-of-%d-ps%d' % (
+        task_index, cluster.num_tasks('worker'), cluster.num_tasks('ps'))
 
-        with tf.Session() as sess:
-            train_writer = tf.summary.FileWriter(sm.FLAGS.train_dir, sess.graph)
+    with tf.Graph().as_default():
+        fetches, savers = graph_cache.load_or_build(kind, lambda: build_train_graph(cluster, task_index))
+        summary_op_merged = fetches['summary_op']
+        mean_loss, reset_loss, global_step = fetches['mean_loss'], fetches['reset_loss'], fetches['global_step']
+        uninitialized_variables = tf.report_uninitialized_variables(tf.global_variables())
+        # The sizes of the queues, for the memory profiling and the metrics.
+        queues = memory_monitor.queue_sizes(tf.get_default_graph())
+
+        with tf.Session(server.target if server else '', config=session_config()) as sess:
+            train_writer = AsyncSummaryWriter(tf.summary.FileWriter(sm.FLAGS.train_dir, sess.graph)) \
+                if is_chief else None
             tf.set_random_seed(42)
-            tf.global_variables_initializer().run()
+            if is_chief and sess.run(uninitialized_variables).size:
+                initialize(sess, savers)
+            while sess.run(uninitialized_variables).size:
+                print('Waiting for the chief worker to initialize the variables...')
+                time.sleep(1)
+            # The local variables, e.g. the position of the input pipeline, start from the restored ones.
+            sess.run(tf.local_variables_initializer())
+
+            checkpointer = checkpointing.AsyncCheckpointer(
+                sess, fetches['snapshot_op'], savers[1], os.path.join(FLAGS.train_dir, 'MSHAPES_train'),
+                every_steps=FLAGS.CHECKPOINT_STEPS, every_secs=FLAGS.CHECKPOINT_SECS,
+                keep_best=FLAGS.KEEP_BEST_CHECKPOINTS) if is_chief else None
 
             coord = tf.train.Coordinator()
             threads = tf.train.start_queue_runners(coord=coord, sess=sess)
 
+            profiler = step_profiler.StepProfiler(
+                os.path.join(FLAGS.train_dir, 'profile' if cluster is None else 'profile-worker%d' % task_index),
+                FLAGS.PROFILE_STEPS, window=FLAGS.PROFILE_WINDOW)
+            memory_report = 'memory.json' if cluster is None else 'memory-worker%d.json' % task_index
+            memory = memory_monitor.MemoryMonitor(sess, queues, os.path.join(FLAGS.train_dir, memory_report),
+                                                  FLAGS.MEMORY_PROFILE_SECS) if FLAGS.MEMORY_PROFILE_SECS else None
+            exporter = start_metrics(sess, queues, checkpointer, task_index)
+
+            # In a cluster, the workers stop together when the shared global step reaches max_steps.
+            # With gradient accumulation, the global step counts the updates, not the runs.
+            step = sess.run(global_step)
+            i = 0
+            last_log = 0
+            last_profile = 0
+            losses = []
             start_time = time.time()
-            for i in xrange(FLAGS.max_steps):
-                _, my_loss = sess.run([train_op, loss])
-                ml = np.array(my_loss)
-
-                if (i + 1) % FLAGS.log_frequency == 0 and i != 0:  # Every 1000 steps, save the results and send an email
+            while i < FLAGS.max_steps * FLAGS.ACCUMULATION_STEPS and step < FLAGS.max_steps and \
+                    not preemption.preempted:
+                # Every run goes through the STEPS_PER_FETCH steps of the train op in the graph, and
+                # fetches the global step and the mean loss of the steps, which the graph sums.
+                i += FLAGS.STEPS_PER_FETCH
+
+                # Summaries are computed on logging steps only, on the batch of the train op. The run
+                # which fetches is the one traced on profiling steps.
+                log_step = i // FLAGS.log_frequency > last_log // FLAGS.log_frequency
+                profile_step = profiler.due(i - FLAGS.STEPS_PER_FETCH, i)
+                run_kwargs = profiler.run_kwargs() if profile_step else {}
+                run_start = time.time()
+                if log_step and is_chief:
+                    _, loss_value, step, summary_str = sess.run([reset_loss, mean_loss, global_step,
+                                                                 summary_op_merged], **run_kwargs)
+                else:
+                    _, loss_value, step = sess.run([reset_loss, mean_loss, global_step], **run_kwargs)
+                if profile_step:
+                    profiler.add(step, time.time() - run_start, i - last_profile)
+                    last_profile = i
+                    if memory:
+                        memory.add_step_stats(run_kwargs['run_metadata'].step_stats)
+                losses.append(loss_value)
+                if exporter:
+                    exporter.set('sm_train_global_step', step)
+                    exporter.set('sm_train_loss', loss_value)
+                    exporter.inc('sm_train_examples_total',
+                                 FLAGS.STEPS_PER_FETCH * FLAGS.batch_size * FLAGS.NUM_REPLICAS)
+                if is_chief:
+                    with profiler.time('checkpoint'):
+                        checkpointer.step(step, loss_value)
+
+                if log_step:  # Every 1000 steps, save the results and send an email
                     current_time = time.time()
                     duration = current_time - start_time
                     start_time = current_time
 
-                    loss_value = ml
-                    examples_per_sec = FLAGS.log_frequency * FLAGS.batch_size / duration
-                    sec_per_batch = float(duration / FLAGS.log_frequency)
+                    loss_value = np.mean(losses)
+                    examples_per_sec = (i - last_log) * FLAGS.batch_size * FLAGS.NUM_REPLICAS / duration
+                    sec_per_batch = float(duration / (i - last_log))
+                    last_log = i
+                    losses = []
+                    if exporter:
+                        exporter.set('sm_train_examples_per_second', examples_per_sec)
 
                     format_str = ('%s: step %d, loss = %.2f (%.1f examples/sec; %.3f '
                                   'sec/batch)')
-                    print(format_str % (datetime.now(), (i + 1), loss_value,
+                    print(format_str % (datetime.now(), step, loss_value,
                                         examples_per_sec, sec_per_batch))
 
-                    saver.save(sess, './MSHAPES_train/MSHAPES_train')  # , global_step=i)
-                    summary_str = sess.run(summary_op_merged)
-                    train_writer.add_summary(summary_str, i)
+                    if is_chief:
+                        with profiler.time('summary_write'):
+                            train_writer.add_summary(summary_str, step)
+
+            # The final checkpoint comes first: on a SIGTERM, it is what must be written before the kill.
+            if is_chief:
+                if preemption.preempted:
+                    if not checkpointer.close(step, timeout=preemption.remaining_secs()):
+                        print('The final checkpoint could not be written in time, the previous one is kept')
+                else:
+                    checkpointer.close(step)
+            if memory:
+                memory.close()
+            if exporter:
+                exporter.close()
 
             coord.request_stop()
-            coord.join(threads)
+            if preemption.preempted:
+                coord.join(threads, stop_grace_period_secs=preemption.remaining_secs(), ignore_live_threads=True)
+            else:
+                coord.join(threads)
+            if is_chief:
+                train_writer.close()
 
         # class _LoggerHook(tf.train.SessionRunHook):
         #     """Logs loss and runtime."""
@@ -113,9 +477,19 @@ def train():
         #         mon_sess.run(train_op)
 
         print('Finished.')
+        return preemption.preempted
 
 
 def main(argv=None):
+    thread_config.apply_affinity('train')
+
+    # A parameter server of asynchronous training only serves its variables.
+    cluster, job_name, task_index = cluster_task()
+    if job_name == 'ps':
+        server = tf.train.Server(cluster, job_name='ps', task_index=task_index, config=session_config())
+        server.join()
+        return
+
     print("Hello, world! v5")
 
     # notify("Running simple4train/train.py", subject="Hi!!!")
@@ -142,16 +516,27 @@ def main(argv=None):
     # verify_dataset()
     # print("All tests passed.")
 
-    # Clean up directories
-    print("Cleaning up directories...")
-    if tf.gfile.Exists(FLAGS.train_dir):
-        tf.gfile.DeleteRecursively(FLAGS.train_dir)
-    tf.gfile.MakeDirs(FLAGS.train_dir)
-    print("Done.")
+    # Clean up directories, unless resuming (sm_cluster.py does it once for the whole cluster, as the
+    # workers may restart)
+    if cluster is None and not FLAGS.RESTORE:
+        print("Cleaning up directories...")
+        if tf.gfile.Exists(FLAGS.train_dir):
+            tf.gfile.DeleteRecursively(FLAGS.train_dir)
+        print("Done.")
+    if not tf.gfile.Exists(FLAGS.train_dir):
+        tf.gfile.MakeDirs(FLAGS.train_dir)
 
     # Train the network!!
     print('Begin training...')
-    train()
+    if cluster is None:
+        preempted = train()
+    else:
+        server = tf.train.Server(cluster, job_name='worker', task_index=task_index, config=session_config())
+        preempted = train(cluster, server, task_index)
+
+    # Exit as killed by the SIGTERM, so that a scheduler (or sm_cluster.py) restarts the run.
+    if preempted:
+        return 128 + signal.SIGTERM
 
 
 
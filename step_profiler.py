@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Per-step timing breakdown of the training loop.
+
+Every few steps, one run of the train op is traced (RunOptions FULL_TRACE): its Chrome trace is
+written to timeline-<global step>.json, to open in chrome://tracing, and its ops are split into
+phases:
+    input       dequeuing the batches, i.e. waiting for the input pipeline
+    forward     the model and the loss
+    backward    the gradients
+    update      applying the gradients, and the other updates of the variables: moving averages,
+                gradient accumulators, UPDATE_OPS (batch normalizations, input positions)
+    summaries   computing the summaries, e.g. histograms and sparsities
+    transfer    sending tensors between devices or tasks
+The ops are classified by type and name scope. The time of a phase is the wall time during which at
+least one of its ops runs, so that parallel ops are not counted twice, and phases may overlap. The
+time spent outside the session runs, e.g. snapshotting the checkpoints, is measured around the calls
+with time(). The mean of the last traced runs by phase, and their slowest op types, are printed and
+written to summary.json.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import contextlib
+import json
+import os
+import time
+from datetime import datetime
+
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+PHASES = ['input', 'forward', 'backward', 'update', 'summaries', 'transfer']
+
+# Name scopes of the ops computing the summaries, e.g. the sparsity of the activations.
+SUMMARY_SCOPES = ('zero_fraction',)
+# Name scopes of the ops updating variables other than the optimizer's: the training op (learning
+# rate, loss averages), the moving averages of the variables and of the batch normalizations, and the
+# gradient accumulators.
+UPDATE_SCOPES = ('train_op', 'ExponentialMovingAverage', 'AssignMovingAvg', 'accumulate')
+# Types of the ops of the update ops (UPDATE_OPS), e.g. the position of the input pipeline.
+UPDATE_TYPES = ('Assign', 'AssignAdd', 'AssignSub', 'ScatterUpdate')
+
+# Number of op types by time written to the summary.
+NUM_TOP_OPS = 10
+
+
+def op_type(node_stats):
+    """
+    :param node_stats: the NodeExecStats of an op
+    :return: the type of the op, from its timeline label 'name = Type(inputs)'
+    """
+    label = node_stats.timeline_label
+    if ' = ' in label:
+        return label.split(' = ', 1)[1].split('(', 1)[0]
+
+    return node_stats.node_name
+
+
+def phase(node_stats):
+    """
+    :param node_stats: the NodeExecStats of an op
+    :return: the phase of PHASES the op belongs to, from its type and its name scopes
+    """
+    kind = op_type(node_stats)
+    scopes = node_stats.node_name.split('/')
+    if kind.startswith('QueueDequeue'):
+        return 'input'
+    if kind.endswith('Summary') or any(scope in SUMMARY_SCOPES for scope in scopes):
+        return 'summaries'
+    if kind in ('_Send', '_Recv', '_HostSend', '_HostRecv'):
+        return 'transfer'
+    if 'gradients' in scopes:
+        return 'backward'
+    if kind.startswith(('Apply', 'ResourceApply', 'SparseApply')) or kind in UPDATE_TYPES or \
+            any(scope in UPDATE_SCOPES for scope in scopes):
+        return 'update'
+
+    return 'forward'
+
+
+def union_length(intervals):
+    """
+    :param intervals: (start, end) pairs
+    :return: the length of their union
+    """
+    length = 0
+    last_end = None
+    for start, end in sorted(intervals):
+        if last_end is None or start > last_end:
+            length += end - start
+            last_end = end
+        elif end > last_end:
+            length += end - last_end
+            last_end = end
+
+    return length
+
+
+def breakdown(step_stats):
+    """
+    :param step_stats: the StepStats of a traced run
+    :return: the wall time of every phase and the total time of every op type, in milliseconds
+    """
+    intervals = collections.defaultdict(list)
+    ops = collections.defaultdict(float)
+    for dev_stats in step_stats.dev_stats:
+        # GPU streams repeat the ops of their device.
+        if '/stream:' in dev_stats.device or '/memcpy' in dev_stats.device:
+            continue
+        for node_stats in dev_stats.node_stats:
+            if node_stats.node_name == '_SOURCE':
+                continue
+            start = node_stats.all_start_micros
+            intervals[phase(node_stats)].append((start, start + node_stats.all_end_rel_micros))
+            ops[op_type(node_stats)] += node_stats.all_end_rel_micros / 1000.0
+
+    return dict((name, union_length(intervals[name]) / 1000.0) for name in PHASES), dict(ops)
+
+
+class StepProfiler(object):
+    """Traces one run of the train op every few steps, and keeps a rolling summary of the traces."""
+
+    def __init__(self, log_dir, every_steps, window=10):
+        """
+        :param log_dir: directory of the Chrome traces and of the summary
+        :param every_steps: number of runs of the train op between traced runs, 0 to trace none
+        :param window: (optional) number of last traced runs the summary is over
+        """
+        self._log_dir = log_dir
+        self._every_steps = every_steps
+        self._profiles = collections.deque(maxlen=window)
+        self._host = collections.defaultdict(float)
+        self._run_metadata = None
+
+    def due(self, last_run, run):
+        """
+        :param last_run: the number of runs of the train op at the last call
+        :param run: the number of runs of the train op now
+        :return: whether the next run is to be traced
+        """
+        return bool(self._every_steps) and run // self._every_steps > last_run // self._every_steps
+
+    def run_kwargs(self):
+        """:return: the options and the metadata of a traced Session.run()"""
+        self._run_metadata = tf.RunMetadata()
+        return {'options': tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), 'run_metadata': self._run_metadata}
+
+    @contextlib.contextmanager
+    def time(self, name):
+        """Measures the time spent in a block outside the session runs, e.g. time('checkpoint')."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self._host[name] += 1000.0 * (time.time() - start)
+
+    def add(self, global_step, wall_secs, num_runs):
+        """
+        Called after a traced run: writes its Chrome trace and updates the summary.
+
+        :param global_step: the global step after the run
+        :param wall_secs: the duration of the traced run, as seen by the training loop
+        :param num_runs: the number of runs of the train op since the last traced run, over which the
+            times of time() are averaged
+        """
+        if not tf.gfile.Exists(self._log_dir):
+            tf.gfile.MakeDirs(self._log_dir)
+        trace = timeline.Timeline(self._run_metadata.step_stats).generate_chrome_trace_format()
+        with tf.gfile.GFile(os.path.join(self._log_dir, 'timeline-%d.json' % global_step), 'w') as f:
+            f.write(trace)
+
+        phases, ops = breakdown(self._run_metadata.step_stats)
+        host = dict((name, value / max(num_runs, 1)) for name, value in self._host.items())
+        self._profiles.append({'global_step': int(global_step), 'wall': 1000.0 * wall_secs, 'phases': phases,
+                               'ops': ops, 'host': host})
+        self._host = collections.defaultdict(float)
+        self._run_metadata = None
+        self._write_summary()
+
+    def summary(self):
+        """
+        :return: the mean, over the last traced runs, of their wall time, of the time of every phase
+            and of the slowest op types, and of the time per run of every block of time(), in
+            milliseconds
+        """
+        def mean(key):
+            totals = collections.defaultdict(float)
+            for profile in self._profiles:
+                for name, value in profile[key].items():
+                    totals[name] += value
+            return dict((name, total / len(self._profiles)) for name, total in totals.items())
+
+        ops = mean('ops')
+        return {
+            'global_steps': [profile['global_step'] for profile in self._profiles],
+            'wall': sum(profile['wall'] for profile in self._profiles) / len(self._profiles),
+            'phases': mean('phases'),
+            'top_ops': sorted(ops.items(), key=lambda item: -item[1])[:NUM_TOP_OPS],
+            'host': mean('host'),
+        }
+
+    def _write_summary(self):
+        summary = self.summary()
+        with tf.gfile.GFile(os.path.join(self._log_dir, 'summary.json'), 'w') as f:
+            json.dump(summary, f, indent=2)
+
+        wall = max(summary['wall'], 1e-6)
+        phases = ', '.join('%s %.1f ms (%.0f%%)' % (name, summary['phases'][name], 100 * summary['phases'][name] / wall)
+                           for name in PHASES if summary['phases'].get(name))
+        top_ops = ', '.join('%s %.1f ms' % item for item in summary['top_ops'][:3])
+        host = ''.join(', %s %.1f ms' % item for item in sorted(summary['host'].items()))
+        print('%s: profile of %d traced step(s): %.1f ms/step: %s; top ops: %s%s' % (
+            datetime.now(), len(summary['global_steps']), summary['wall'], phases, top_ops, host))
@@ -5,6 +5,7 @@ from PIL import Image
 import matplotlib.pyplot as plt
 import sm_input
 import FLAGS
+import thread_config
 
 # print("Hello")
 #
@@ -34,7 +35,7 @@ def testDeconcat():
     print dc1
     print dc2
 
-    sess = tf.Session()
+    sess = tf.Session(config=thread_config.session_config('inference'))
     init_op = tf.initialize_all_variables()
     sess.run(init_op)
     print sess.run(dc1)
@@ -63,7 +64,7 @@ def testImshow():
         rotation = tf.nn.max_pool(concat, ksize=[1,1,1,DISCRETE_ORIENTATION_NUMBER], strides=[1,1,1,DISCRETE_ORIENTATION_NUMBER], padding='SAME')
 
 
-    sess = tf.Session()
+    sess = tf.Session(config=thread_config.session_config('inference'))
     sess.run(tf.global_variables_initializer())
     merged_summary_op = tf.summary.merge_all()
     sess.run(merged_summary_op)
@@ -87,7 +88,7 @@ def testCross():
         b = tf.Variable(tf.truncated_normal([2,4,4,3]), dtype=tf.float32)
         c = tf.cross(a, b)
         init_op = tf.global_variables_initializer()
-        with tf.Session() as sess:
+        with tf.Session(config=thread_config.session_config('inference')) as sess:
             print c.get_shape()
             sess.run(init_op)
             print sess.run(c)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Thread configuration of the sessions and of the input pipelines, as tuned by sm_autotune.py.
+
+FLAGS.THREAD_CONFIG is a JSON file with one section per kind of run, 'train' (sm_train.py) and
+'inference' (sm_eval.py), e.g.
+    {"train": {"intra_op_parallelism_threads": 16, "inter_op_parallelism_threads": 2,
+               "input_threads": 8, "cpu_affinity": [0, 1, ..., 31]}}
+A missing file, section or setting leaves the TensorFlow default (0 threads, i.e. one per core),
+16 input threads and no CPU affinity.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+
+import tensorflow as tf
+
+import FLAGS
+
+KINDS = ('train', 'inference')
+
+DEFAULTS = {
+    'intra_op_parallelism_threads': 0,
+    'inter_op_parallelism_threads': 0,
+    'input_threads': 16,
+    'cpu_affinity': None,
+}
+
+# Configuration used instead of the file, see override().
+_override = {}
+
+
+def load(kind):
+    """
+    :param kind: 'train' or 'inference'
+    :return: the thread configuration of the kind of run, with the DEFAULTS for missing settings
+    """
+    config = dict(DEFAULTS)
+    if kind in _override:
+        config.update(_override[kind])
+    elif FLAGS.THREAD_CONFIG and os.path.exists(FLAGS.THREAD_CONFIG):
+        with open(FLAGS.THREAD_CONFIG) as f:
+            config.update(json.load(f).get(kind, {}))
+
+    return config
+
+
+def override(kind, config):
+    """Uses a configuration instead of the file's in this process, e.g. while measuring it."""
+    _override[kind] = config
+
+
+def save(kind, config):
+    """Writes the configuration of a kind of run to the file, keeping the other kinds."""
+    sections = {}
+    if os.path.exists(FLAGS.THREAD_CONFIG):
+        with open(FLAGS.THREAD_CONFIG) as f:
+            sections = json.load(f)
+    sections[kind] = config
+    with open(FLAGS.THREAD_CONFIG, 'w') as f:
+        json.dump(sections, f, indent=2, sort_keys=True)
+
+
+def session_config(kind, **kwargs):
+    """
+    :param kind: 'train' or 'inference'
+    :param kwargs: other fields of the tf.ConfigProto
+    :return: a tf.ConfigProto with the thread pools of the kind of run
+    """
+    config = load(kind)
+    return tf.ConfigProto(intra_op_parallelism_threads=config['intra_op_parallelism_threads'],
+                          inter_op_parallelism_threads=config['inter_op_parallelism_threads'], **kwargs)
+
+
+def apply_affinity(kind):
+    """Pins this process to the CPUs of the configuration of a kind of run, if any. Call it before the
+    first session, whose thread pools the other sessions share."""
+    cpus = load(kind)['cpu_affinity']
+    if not cpus:
+        return
+    if not hasattr(os, 'sched_setaffinity'):
+        raise EnvironmentError('CPU affinity needs Python 3 on Linux, remove cpu_affinity from ' + FLAGS.THREAD_CONFIG)
+    os.sched_setaffinity(0, cpus)
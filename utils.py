@@ -6,11 +6,13 @@ import os
 import pwd
 import socket
 import sys
+import time
 import urllib
 import zipfile
 from random import randint
 from time import gmtime, strftime
 
+import numpy as np
 import requests
 from PIL import Image
 from six.moves import urllib as smurllib
@@ -198,3 +200,40 @@ def print_progress_bar(iteration, total, prefix='', suffix='', decimals=1, lengt
         print()
         print()
         sys.stdout.write("")
+
+
+
+def load_images(files):
+    """
+    Decodes png files into a single array.
+
+    :param files: list of paths to png files, all of the same size
+
+    :return: a uint8 array of shape [len(files), height, width, 3]
+    """
+    return np.stack([np.asarray(Image.open(f).convert('RGB'), dtype=np.uint8) for f in files])
+
+
+
+def time_runs(sess, fetches, feed_dict=None, num_runs=20, num_warmup=2):
+    """
+    Times repeated session runs.
+
+    :param sess: the session
+    :param fetches: what to run
+    :param feed_dict: (optional) the feed dictionary
+    :param num_runs: (optional) number of timed runs
+    :param num_warmup: (optional) number of runs before timing, which pay for memory allocation
+
+    :return: a list with the duration of every timed run, in seconds
+    """
+    for _ in range(num_warmup):
+        sess.run(fetches, feed_dict=feed_dict)
+
+    durations = []
+    for _ in range(num_runs):
+        start_time = time.time()
+        sess.run(fetches, feed_dict=feed_dict)
+        durations.append(time.time() - start_time)
+
+    return durations